@@ -1,15 +1,47 @@
 #from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 import psycopg2
+import psycopg2.pool
+import psycopg2.errors
 from psycopg2 import extras
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import atexit
+import base64
+import click
+import csv
+import functools
+import gzip
+import hashlib
 import os
+import queue
+import random
+import select
+import socket
+import tempfile
+import threading
+import time
+import weakref
 import pandas as pd
 from urllib.parse import urlparse
 import io
+import itertools
+import math
+import joblib
 from sklearn.linear_model import LinearRegression
 from collections import OrderedDict
 import numpy as np
+import openpyxl
+import xlsxwriter
+import zipfile
+import zlib
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pa_parquet
+except ImportError:  # Parquet es opcional
+    pa = pa_csv = pa_parquet = None
 
 # Inicializar la aplicación Flask
 app = Flask(__name__)
@@ -26,41 +58,19 @@ def entrenar_modelos():
     try:
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Obtener datos históricos de mortalidad
-                cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_muerte, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(muertos_hembras + muertos_machos) AS total_muertes
-                    FROM muertes_destetados
-                    WHERE fecha_muerte IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
-                ''')
-                mortalidad_data = cursor.fetchall()
-
-                # Obtener datos históricos de nacimientos
+                # Series mensuales de toda la granja desde metricas_mensuales
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_nacimiento, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(nacidos) AS total_nacidos
-                    FROM partos
-                    WHERE fecha_nacimiento IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
+                    SELECT metrica, TO_CHAR(mes, 'YYYY-MM') AS mes, SUM(valor)::float AS total
+                    FROM metricas_mensuales
+                    WHERE metrica IN ('muertos_destetados', 'nacidos', 'ventas_destetados')
+                    GROUP BY metrica, 2
+                    ORDER BY metrica, 2
                 ''')
-                nacimientos_data = cursor.fetchall()
+                series = cursor.fetchall()
 
-                # Obtener datos históricos de ganancias
-                cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_venta, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(costo_venta) AS total_ganancias
-                    FROM ventas_destetados
-                    WHERE fecha_venta IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
-                ''')
-                ganancias_data = cursor.fetchall()
+        mortalidad_data = [(fila['mes'], fila['total']) for fila in series if fila['metrica'] == 'muertos_destetados']
+        nacimientos_data = [(fila['mes'], fila['total']) for fila in series if fila['metrica'] == 'nacidos']
+        ganancias_data = [(fila['mes'], fila['total']) for fila in series if fila['metrica'] == 'ventas_destetados']
 
         # Verificar que hay suficientes datos para entrenar
         if len(mortalidad_data) < 2:
@@ -103,605 +113,2689 @@ def entrenar_modelos():
         print(f"Error al entrenar los modelos: {str(e)}")
         return None, None, None
     
-# Función para obtener la conexión a la base de datos CORREGIDA
-def get_db_connection():
+# === POOL DE CONEXIONES ===
+# Cada worker de gunicorn mantiene su propio pool; se crea la primera vez que se
+# pide una conexión dentro del proceso (después del fork) y se recrea si el PID cambia.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))          # segundos esperando una conexión libre
+DB_POOL_PING_INACTIVA = float(os.environ.get('DB_POOL_PING_INACTIVA', 30))  # verificar conexiones inactivas más de N segundos
+DB_POOL_VIDA_MAXIMA = float(os.environ.get('DB_POOL_VIDA_MAXIMA', 1800))   # reciclar conexiones más antiguas que N segundos
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pool_cupos = None
+# conexión -> (creada, ultimo_uso). Con claves débiles una conexión cerrada y
+# recolectada no deja su entrada a otra que reciba la misma dirección de memoria
+_pool_tiempos = weakref.WeakKeyDictionary()
+
+def _parametros_conexion():
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
         raise ValueError("No se ha configurado DATABASE_URL")
 
     url = urlparse(database_url)
-    conn = psycopg2.connect(
-        dbname=url.path[1:],  # Eliminar el '/' inicial
-        user=url.username,
-        password=url.password,
-        host=url.hostname,
-        port=url.port
-    )
-    return conn
-def init_ventas_table():
-    """Crear la tabla ventas si no existe"""
+    return {
+        'dbname': url.path[1:],  # Eliminar el '/' inicial
+        'user': url.username,
+        'password': url.password,
+        'host': url.hostname,
+        'port': url.port
+    }
+
+def obtener_pool():
+    """Devolver el pool del proceso actual, creándolo si aún no existe"""
+    global _pool, _pool_pid, _pool_cupos
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Las conexiones heredadas del proceso padre no se cierran aquí:
+            # el socket es compartido y cerrarlo afectaría al padre.
+            _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **_parametros_conexion())
+            _pool_pid = pid
+            _pool_cupos = threading.BoundedSemaphore(DB_POOL_MAX)
+            _pool_tiempos.clear()
+    return _pool
+
+def cerrar_pool():
+    """Cerrar todas las conexiones del pool del proceso actual"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_tiempos.clear()
+
+atexit.register(cerrar_pool)
+
+def _descartar_conexion(pool, conn):
+    _pool_tiempos.pop(conn, None)
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS ventas (
-                        id SERIAL PRIMARY KEY,
-                        tipo_venta VARCHAR(20) NOT NULL CHECK (tipo_venta IN ('destetados', 'descarte')),
-                        galpon VARCHAR(50),
-                        poza VARCHAR(50),
-                        hembras_vendidas INTEGER DEFAULT 0,
-                        machos_vendidos INTEGER DEFAULT 0,
-                        costo_total DECIMAL(10, 2) NOT NULL,
-                        fecha_venta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        mover_engorde BOOLEAN DEFAULT FALSE,
-                        engorde_galpon VARCHAR(50),
-                        engorde_poza VARCHAR(50),
-                        fecha_movimiento DATE,
-                        dias_engorde INTEGER,
-                        observaciones TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
+        pool.putconn(conn, close=True)
+    except psycopg2.pool.PoolError:
+        pass
+
+def _conexion_valida(conn):
+    """Detectar conexiones rotas o demasiado antiguas antes de entregarlas"""
+    if conn.closed:
+        return False
+
+    ahora = time.monotonic()
+    creada, ultimo_uso = _pool_tiempos.get(conn, (ahora, ahora))
+    if ahora - creada > DB_POOL_VIDA_MAXIMA:
+        return False
+    if ahora - ultimo_uso > DB_POOL_PING_INACTIVA:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+def _tomar_conexion(pool):
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _conexion_valida(conn):
+            ahora = time.monotonic()
+            creada = _pool_tiempos.get(conn, (ahora, ahora))[0]
+            _pool_tiempos[conn] = (creada, ahora)
+            return conn
+        _descartar_conexion(pool, conn)
+    raise psycopg2.OperationalError("No se pudo obtener una conexión válida del pool")
+
+# Función para obtener la conexión a la base de datos
+@contextmanager
+def get_db_connection():
+    """Prestar una conexión del pool; al salir se confirma (o revierte) y se devuelve al pool"""
+    pool = obtener_pool()
+    cupos = _pool_cupos
+    if not cupos.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"Tiempo de espera agotado ({DB_POOL_TIMEOUT}s) esperando una conexión libre")
+
+    conn = None
+    try:
+        conn = _tomar_conexion(pool)
+        try:
+            yield conn
+            if not conn.closed:
                 conn.commit()
-                app.logger.info("Tabla ventas verificada/creada correctamente")
-    except Exception as e:
-        app.logger.error("Error al crear tabla ventas", exc_info=e)
-init_ventas_table()
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+    finally:
+        if conn is not None:
+            if conn.closed:
+                _descartar_conexion(pool, conn)
+            else:
+                _pool_tiempos[conn] = (_pool_tiempos.get(conn, (time.monotonic(),))[0], time.monotonic())
+                pool.putconn(conn)
+                # El pool cierra las conexiones que sobran por encima de DB_POOL_MIN
+                if conn.closed:
+                    _pool_tiempos.pop(conn, None)
+        cupos.release()
+
 # Función para validar valores positivos
 def validate_positive_values(**kwargs):
     for key, value in kwargs.items():
         if value < 0:
             raise ValueError(f"{key} no puede ser negativo")
 
-# Función para crear o actualizar las tablas en la base de datos
-def crear_o_actualizar_tablas():
+# Orden de prioridad de las notificaciones; la misma expresión se usa en el
+# índice notificaciones_pendientes_idx (migraciones/0003) y en el listado para que el índice aplique
+RANGO_PRIORIDAD_SQL = "CASE prioridad WHEN 'urgente' THEN 1 WHEN 'alta' THEN 2 WHEN 'media' THEN 3 ELSE 4 END"
+
+# === CATÁLOGO DE ESQUEMA ===
+# Las columnas de conteo de partos cambiaron entre versiones de la base
+# (nacidos, nacidos_hembras/machos, crias_nacidas_*). Se resuelven una sola vez
+# por proceso y se vuelven a leer después de cada DDL.
+TABLAS_CATALOGO = ('reproductores', 'partos', 'destetes', 'muertes_destetados', 'ventas')
+
+_catalogo_esquema = None
+_catalogo_lock = threading.Lock()
+
+def resolver_expresiones_esquema(columnas):
+    """Construir las expresiones SQL del dashboard a partir de {tabla: [columnas]}"""
+    catalogo = {
+        'columnas': columnas,
+        'nacidos': None,
+        'muertos_partos': None,
+        'muertos_destetados': None,
+        'orden_reproductores': 'id'
+    }
+
+    parto_cols = columnas.get('partos')
+    if parto_cols:
+        if 'nacidos' in parto_cols:
+            catalogo['nacidos'] = 'nacidos'
+        elif 'nacidos_hembras' in parto_cols and 'nacidos_machos' in parto_cols:
+            catalogo['nacidos'] = 'nacidos_hembras + nacidos_machos'
+        elif 'crias_nacidas_hembras' in parto_cols and 'crias_nacidas_machos' in parto_cols:
+            catalogo['nacidos'] = 'crias_nacidas_hembras + crias_nacidas_machos'
+        else:
+            columna_nacidos = None
+            for c in parto_cols:
+                if any(k in c.lower() for k in ('nac', 'cria', 'bebe', 'parto')) and not c.lower().startswith('fecha'):
+                    columna_nacidos = c
+                    break
+            # Sin columna reconocible se cuenta un nacido por registro
+            catalogo['nacidos'] = columna_nacidos or '1'
+
+        expr = [f'COALESCE({c}, 0)' for c in ('muertos_bebes', 'muertos_reproductores') if c in parto_cols]
+        if expr:
+            catalogo['muertos_partos'] = ' + '.join(expr)
+
+    md_cols = columnas.get('muertes_destetados')
+    if md_cols and 'muertos_hembras' in md_cols and 'muertos_machos' in md_cols:
+        catalogo['muertos_destetados'] = 'muertos_hembras + muertos_machos'
+
+    repro_cols = columnas.get('reproductores') or []
+    posibles_fecha = ['fecha_ingreso', 'fecha_registro', 'created_at', 'tiempo_reproductores', 'fecha', 'fecha_creacion']
+    catalogo['orden_reproductores'] = next((c for c in posibles_fecha if c in repro_cols), 'id')
+
+    return catalogo
+
+def cargar_catalogo_esquema(cursor):
+    """Leer las columnas de las tablas del dashboard en una sola consulta"""
+    cursor.execute('''
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = ANY(%s)
+        ORDER BY table_name, ordinal_position
+    ''', (list(TABLAS_CATALOGO),))
+    columnas = {}
+    for tabla, columna in cursor.fetchall():
+        columnas.setdefault(tabla, []).append(columna)
+    return resolver_expresiones_esquema(columnas)
+
+def obtener_catalogo_esquema(refrescar=False):
+    """Catálogo de esquema del proceso; solo consulta information_schema la primera vez"""
+    global _catalogo_esquema
+    if _catalogo_esquema is not None and not refrescar:
+        return _catalogo_esquema
+
+    with _catalogo_lock:
+        if _catalogo_esquema is None or refrescar:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    _catalogo_esquema = cargar_catalogo_esquema(cursor)
+    return _catalogo_esquema
+
+def invalidar_catalogo_esquema():
+    """Forzar una nueva lectura del catálogo en la próxima consulta"""
+    global _catalogo_esquema
+    _catalogo_esquema = None
+
+# === INVENTARIO POR POZA ===
+# inventario_poza guarda contadores acumulados por galpón/poza. Cada ruta que
+# registra o edita eventos aplica su delta en la misma transacción, así el
+# dashboard y las notificaciones leen una fila por poza en vez del historial.
+CONTADORES_INVENTARIO = ('reproductores_total', 'nacidos', 'destetados', 'muertos', 'vendidos')
+# vendidos cuenta los cuyes de descarte vendidos desde la poza. La misma regla
+# vale para el formulario, la importación y la reconstrucción: las ventas de
+# destetados no cuentan aunque una fila antigua tenga galpón y poza.
+VENDIDOS_INVENTARIO = ("CASE WHEN tipo_venta = 'descarte' "
+                       "THEN COALESCE(hembras_vendidas, 0) + COALESCE(machos_vendidos, 0) ELSE 0 END")
+
+def construir_consulta_inventario(catalogo):
+    """Consulta que recalcula el inventario completo desde las tablas de eventos"""
+    orden = catalogo['orden_reproductores']
+    nacidos = catalogo['nacidos'] or '0'
+    muertos_partos = catalogo['muertos_partos'] or '0'
+
+    partes = [f'''
+        SELECT galpon, poza,
+               SUM(hembras + machos) AS reproductores_total,
+               (ARRAY_AGG(hembras + machos ORDER BY {orden} DESC, id DESC))[1] AS reproductores,
+               0 AS nacidos, 0 AS destetados, 0 AS muertos, 0 AS vendidos
+        FROM reproductores
+        GROUP BY galpon, poza
+    ''', '''
+        SELECT galpon, poza, 0, 0, 0, SUM(destetados_hembras + destetados_machos), 0, 0
+        FROM destetes
+        GROUP BY galpon, poza
+    ''']
+    if 'partos' in catalogo['columnas']:
+        partes.append(f'''
+        SELECT galpon, poza, 0, 0, SUM({nacidos}), 0, SUM({muertos_partos}), 0
+        FROM partos
+        GROUP BY galpon, poza
+    ''')
+    if catalogo['muertos_destetados']:
+        partes.append(f'''
+        SELECT galpon, poza, 0, 0, 0, 0, SUM({catalogo['muertos_destetados']}), 0
+        FROM muertes_destetados
+        GROUP BY galpon, poza
+    ''')
+    if 'ventas' in catalogo['columnas']:
+        partes.append(f'''
+        SELECT galpon, poza, 0, 0, 0, 0, 0, SUM({VENDIDOS_INVENTARIO})
+        FROM ventas
+        WHERE galpon IS NOT NULL AND galpon <> '' AND poza IS NOT NULL AND poza <> ''
+        GROUP BY galpon, poza
+    ''')
+
+    return f'''
+        WITH eventos AS ({' UNION ALL '.join(partes)})
+        SELECT galpon::text AS galpon, poza::text AS poza,
+               COALESCE(SUM(reproductores), 0) AS reproductores,
+               COALESCE(SUM(reproductores_total), 0) AS reproductores_total,
+               COALESCE(SUM(nacidos), 0) AS nacidos,
+               COALESCE(SUM(destetados), 0) AS destetados,
+               COALESCE(SUM(muertos), 0) AS muertos,
+               COALESCE(SUM(vendidos), 0) AS vendidos
+        FROM eventos
+        GROUP BY galpon, poza
+    '''
+
+def actualizar_inventario_poza(cursor, galpon, poza, reproductores=None, **deltas):
+    """Sumar deltas a los contadores de una poza (crea la fila si no existe)
+
+    reproductores, si se indica, reemplaza la cantidad actual de reproductores
+    de la poza; el resto de argumentos se suman a los contadores acumulados.
+    """
+    desconocidos = set(deltas) - set(CONTADORES_INVENTARIO)
+    if desconocidos:
+        raise ValueError(f"Contadores de inventario desconocidos: {', '.join(sorted(desconocidos))}")
+
+    valores = [int(deltas.get(c) or 0) for c in CONTADORES_INVENTARIO]
+    asignaciones = [f'{c} = inventario_poza.{c} + EXCLUDED.{c}' for c in CONTADORES_INVENTARIO]
+    if reproductores is not None:
+        asignaciones.append('reproductores = EXCLUDED.reproductores')
+
+    cursor.execute(f'''
+        INSERT INTO inventario_poza (galpon, poza, reproductores, {', '.join(CONTADORES_INVENTARIO)}, actualizado)
+        VALUES (%s, %s, %s, {', '.join(['%s'] * len(CONTADORES_INVENTARIO))}, NOW())
+        ON CONFLICT (galpon, poza) DO UPDATE
+        SET {', '.join(asignaciones)}, actualizado = NOW()
+    ''', (str(galpon), str(poza), int(reproductores or 0), *valores))
+
+def recalcular_reproductores_poza(cursor, galpon, poza):
+    """Recalcular los reproductores de una poza tras editar un registro existente"""
+    orden = obtener_catalogo_esquema()['orden_reproductores']
+    cursor.execute(f'''
+        INSERT INTO inventario_poza (galpon, poza, reproductores, reproductores_total, actualizado)
+        SELECT %s, %s,
+               COALESCE((ARRAY_AGG(hembras + machos ORDER BY {orden} DESC, id DESC))[1], 0),
+               COALESCE(SUM(hembras + machos), 0),
+               NOW()
+        FROM reproductores
+        WHERE galpon = %s AND poza = %s
+        ON CONFLICT (galpon, poza) DO UPDATE
+        SET reproductores = EXCLUDED.reproductores,
+            reproductores_total = EXCLUDED.reproductores_total,
+            actualizado = NOW()
+    ''', (str(galpon), str(poza), galpon, poza))
+
+def reconstruir_inventario_poza(cursor):
+    """Recalcular inventario_poza desde cero; devuelve la cantidad de pozas"""
+    consulta = construir_consulta_inventario(obtener_catalogo_esquema())
+    # Las rutas que registran eventos esperan al final de la reconstrucción: así
+    # cada evento queda en el recálculo o se suma después, nunca en ambos
+    cursor.execute('LOCK TABLE inventario_poza IN EXCLUSIVE MODE')
+    cursor.execute('DELETE FROM inventario_poza')
+    cursor.execute(f'''
+        INSERT INTO inventario_poza (galpon, poza, reproductores, {', '.join(CONTADORES_INVENTARIO)})
+        SELECT galpon, poza, reproductores, {', '.join(CONTADORES_INVENTARIO)}
+        FROM ({consulta}) recalculado
+        ON CONFLICT (galpon, poza) DO NOTHING
+    ''')
+    return cursor.rowcount
+
+def verificar_inventario_poza(cursor):
+    """Comparar inventario_poza con el historial; devuelve las diferencias encontradas"""
+    consulta = construir_consulta_inventario(obtener_catalogo_esquema())
+    columnas = ('reproductores',) + CONTADORES_INVENTARIO
+    cursor.execute(f'''
+        SELECT COALESCE(e.galpon, i.galpon), COALESCE(e.poza, i.poza),
+               {', '.join(f'COALESCE(e.{c}, 0), COALESCE(i.{c}, 0)' for c in columnas)}
+        FROM ({consulta}) e
+        FULL OUTER JOIN inventario_poza i ON i.galpon = e.galpon AND i.poza = e.poza
+    ''')
+
+    diferencias = []
+    for fila in cursor.fetchall():
+        galpon, poza, valores = fila[0], fila[1], fila[2:]
+        for n, columna in enumerate(columnas):
+            esperado, actual = int(valores[2 * n]), int(valores[2 * n + 1])
+            if esperado != actual:
+                diferencias.append({
+                    'galpon': galpon,
+                    'poza': poza,
+                    'columna': columna,
+                    'esperado': esperado,
+                    'actual': actual
+                })
+    return diferencias
+
+@app.cli.command('reconstruir-inventario')
+def reconstruir_inventario_comando():
+    """Recalcular inventario_poza desde el historial completo"""
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            # Crear tabla de reproductores si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS reproductores (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    hembras INTEGER NOT NULL,
-                    machos INTEGER NOT NULL,
-                    tiempo_reproductores INTEGER NOT NULL,
-                    fecha_ingreso TEXT NOT NULL
-                )
-            ''')
-
-            # Crear tabla de partos si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS partos (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    numero_parto INTEGER NOT NULL,
-                    nacidos INTEGER NOT NULL,
-                    muertos_bebes INTEGER NOT NULL,
-                    muertos_reproductores INTEGER NOT NULL,
-                    fecha_nacimiento TEXT NOT NULL
-                )
-            ''')
+            pozas = reconstruir_inventario_poza(cursor)
+    print(f"✅ Inventario reconstruido: {pozas} pozas")
 
-            # Crear tabla de destetes si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS destetes (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    destetados_hembras INTEGER NOT NULL,
-                    destetados_machos INTEGER NOT NULL,
-                    fecha_destete TEXT NOT NULL
-                )
-            ''')
+@app.cli.command('verificar-inventario')
+def verificar_inventario_comando():
+    """Verificar que inventario_poza coincide con el historial"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            diferencias = verificar_inventario_poza(cursor)
+
+    if not diferencias:
+        print("✅ Inventario consistente")
+        return
+    for d in diferencias:
+        print(f"⚠️  Galpón {d['galpon']} Poza {d['poza']}: {d['columna']} esperado={d['esperado']} actual={d['actual']}")
+    raise SystemExit(1)
+
+# === MÉTRICAS MENSUALES ===
+# metricas_mensuales (migración 0011) guarda los totales por mes, galpón, poza y
+# métrica. Cada escritura recalcula solo los meses que tocó (normalmente el
+# actual) de las métricas de esa tabla, en la misma transacción; /resultados,
+# entrenar_modelos() y los modelos por poza leen de aquí en lugar de agrupar todo
+# el historial.
+# Cada término va con COALESCE: un NULL en una columna no debe anular la suma de la fila.
+METRICAS_MENSUALES = {
+    'partos': {'nacidos': 'COALESCE(nacidos, 0)',
+               'muertos_partos': 'COALESCE(muertos_bebes, 0) + COALESCE(muertos_reproductores, 0)',
+               'partos': '1'},
+    'destetes': {'destetados': 'COALESCE(destetados_hembras, 0) + COALESCE(destetados_machos, 0)'},
+    'muertes_destetados': {'muertos_destetados': 'COALESCE(muertos_hembras, 0) + COALESCE(muertos_machos, 0)'},
+    'ventas': {'ventas_destetados': "CASE WHEN tipo_venta = 'destetados' THEN COALESCE(costo_total, 0) ELSE 0 END",
+               'ventas_descarte': "CASE WHEN tipo_venta = 'descarte' THEN COALESCE(costo_total, 0) ELSE 0 END",
+               'vendidos_destetados': "CASE WHEN tipo_venta = 'destetados' "
+                                      "THEN COALESCE(hembras_vendidas, 0) + COALESCE(machos_vendidos, 0) ELSE 0 END"},
+    'gastos': {'gastos': 'COALESCE(monto, 0)'},
+}
+METRICAS_SIN_POZA = ('gastos',)   # sus filas usan galpon y poza ''
+CLAVE_BLOQUEO_METRICAS = 720150003
+
+def refrescar_metricas_mensuales(cursor, tabla, meses=None):
+    """Recalcular las métricas de una tabla en los meses indicados (todos si meses es None)"""
+    metricas = METRICAS_MENSUALES.get(tabla)
+    if not metricas:
+        return
+    fecha = LISTADOS_ANALISIS[tabla]['fecha']
+    por_poza = tabla not in METRICAS_SIN_POZA
+
+    filtro, parametros = '', []
+    if meses is not None:
+        meses = sorted({datetime(m.year, m.month, 1) for m in meses if m})
+        if not meses:
+            return
+        # Dos escrituras del mismo mes no deben recalcularlo a la vez
+        for mes in meses:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', (CLAVE_BLOQUEO_METRICAS, mes.year * 12 + mes.month))
+        hasta = meses[-1] + timedelta(days=32)
+        filtro = f"WHERE {fecha} >= %s AND {fecha} < %s AND date_trunc('month', {fecha}) = ANY(%s)"
+        parametros = [meses[0], datetime(hasta.year, hasta.month, 1), meses]
+
+    cursor.execute(
+        f"DELETE FROM metricas_mensuales WHERE metrica = ANY(%s) {'AND mes = ANY(%s::date[])' if meses else ''}",
+        [list(metricas)] + ([meses] if meses else [])
+    )
+    galpon, poza = ('galpon', 'poza') if por_poza else ("''", "''")
+    cursor.execute(f'''
+        INSERT INTO metricas_mensuales (metrica, mes, galpon, poza, valor)
+        SELECT m.metrica, t.mes, t.galpon, t.poza, m.valor
+        FROM (
+            SELECT date_trunc('month', {fecha})::date AS mes,
+                   COALESCE({galpon}, '') AS galpon, COALESCE({poza}, '') AS poza,
+                   {', '.join(f'COALESCE(SUM({expresion}), 0) AS v{n}' for n, expresion in enumerate(metricas.values()))}
+            FROM {tabla}
+            {filtro}
+            GROUP BY 1, 2, 3
+        ) t
+        CROSS JOIN LATERAL (VALUES {', '.join(f"('{metrica}', t.v{n}::numeric)" for n, metrica in enumerate(metricas))}) AS m(metrica, valor)
+        WHERE t.mes IS NOT NULL
+    ''', parametros)
+
+def reconstruir_metricas_mensuales(cursor):
+    """Recalcular metricas_mensuales desde el historial completo; devuelve las filas"""
+    # Como en reconstruir_inventario_poza: los refrescos de las rutas esperan al
+    # final de la reconstrucción y recalculan su mes sobre el resultado
+    cursor.execute('LOCK TABLE metricas_mensuales IN EXCLUSIVE MODE')
+    cursor.execute('DELETE FROM metricas_mensuales')
+    for tabla in METRICAS_MENSUALES:
+        refrescar_metricas_mensuales(cursor, tabla)
+    cursor.execute('SELECT COUNT(*) FROM metricas_mensuales')
+    return cursor.fetchone()[0]
+
+@app.cli.command('reconstruir-metricas')
+def reconstruir_metricas_comando():
+    """Recalcular metricas_mensuales desde el historial completo"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            filas = reconstruir_metricas_mensuales(cursor)
+    print(f"✅ Métricas mensuales reconstruidas: {filas} filas")
+
+# === MIGRACIÓN DE FECHAS A TIPOS NATIVOS ===
+# Las tablas de eventos guardaban las fechas como TEXT. La migración las pasa a
+# TIMESTAMP sin bloquear la tabla durante el relleno:
+#   1. se agrega una columna <fecha>__nueva TIMESTAMP (sin reescribir la tabla),
+#   2. se rellena por lotes de id, confirmando cada lote,
+#   3. en una transacción corta se completan las filas nuevas y se intercambian columnas.
+# Las filas cuya fecha no se puede interpretar se informan y detienen el
+# intercambio de esa columna, salvo que se fuerce (se guardan en fechas_no_convertidas).
+COLUMNAS_FECHA = (
+    ('reproductores', 'fecha_ingreso'),
+    ('partos', 'fecha_nacimiento'),
+    ('destetes', 'fecha_destete'),
+    ('muertes_destetados', 'fecha_muerte'),
+    ('ventas_destetados', 'fecha_venta'),
+    ('ventas_descarte', 'fecha_venta'),
+    ('gastos', 'fecha_gasto'),
+)
+MIGRACION_FECHAS_LOTE = int(os.environ.get('MIGRACION_FECHAS_LOTE', 5000))
+
+FORMATOS_FECHA_LEGADOS = (
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y',
+    '%d-%m-%Y',
+)
+
+def parsear_fecha_legada(valor):
+    """Interpretar una fecha guardada como texto (ISO o DD/MM/YYYY); None si no es válida"""
+    if valor is None:
+        return None
+    if isinstance(valor, datetime):
+        return valor
+
+    texto = str(valor).strip()
+    if not texto:
+        return None
 
-            # Crear tabla de muertes de destetados si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS muertes_destetados (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    muertos_hembras INTEGER NOT NULL,
-                    muertos_machos INTEGER NOT NULL,
-                    fecha_muerte TEXT NOT NULL
-                )
-            ''')
+    try:
+        fecha = datetime.fromisoformat(texto)
+    except ValueError:
+        fecha = None
+        for formato in FORMATOS_FECHA_LEGADOS:
+            try:
+                fecha = datetime.strptime(texto, formato)
+                break
+            except ValueError:
+                continue
+
+    if fecha is not None and fecha.tzinfo is not None:
+        # NOW() guardado como texto incluye la zona horaria: normalizar a UTC
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+def columnas_fecha_pendientes(cursor):
+    """Columnas de COLUMNAS_FECHA que todavía no son TIMESTAMP"""
+    cursor.execute('''
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND data_type NOT IN ('timestamp without time zone', 'timestamp with time zone', 'date')
+    ''')
+    existentes = set(cursor.fetchall())
+    return [(tabla, columna) for tabla, columna in COLUMNAS_FECHA if (tabla, columna) in existentes]
+
+def _convertir_filas(cursor, tabla, columna, filas):
+    """Escribir en la columna nueva las fechas interpretadas; devuelve las filas inválidas"""
+    validas, invalidas = [], []
+    for fila_id, valor in filas:
+        fecha = parsear_fecha_legada(valor)
+        if fecha is None:
+            invalidas.append((fila_id, valor))
+        else:
+            validas.append((fila_id, fecha))
+
+    if validas:
+        psycopg2.extras.execute_values(cursor, f'''
+            UPDATE {tabla} SET {columna}__nueva = v.fecha
+            FROM (VALUES %s) AS v(id, fecha)
+            WHERE {tabla}.id = v.id
+        ''', validas, template='(%s, %s::timestamp)')
+    return invalidas
+
+def indices_columna(cursor, tabla, columna):
+    """Definiciones (CREATE INDEX ...) de los índices que dependen de tabla.columna"""
+    cursor.execute('''
+        SELECT DISTINCT d.objid, pg_get_indexdef(d.objid)
+        FROM pg_depend d
+        JOIN pg_index x ON x.indexrelid = d.objid
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.classid = 'pg_class'::regclass
+        AND d.refclassid = 'pg_class'::regclass
+        AND d.refobjid = %s::regclass
+        AND a.attname = %s
+        ORDER BY d.objid
+    ''', (tabla, columna))
+    return [definicion for _, definicion in cursor.fetchall()]
+
+def migrar_columna_fecha(tabla, columna, lote=MIGRACION_FECHAS_LOTE, forzar=False):
+    """Convertir tabla.columna a TIMESTAMP; devuelve (convertida, filas_invalidas)"""
+    nueva = f'{columna}__nueva'
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS {nueva} TIMESTAMP')
 
-            # Crear tabla de ventas de destetados si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS ventas_destetados (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    hembras_vendidas INTEGER NOT NULL,
-                    machos_vendidos INTEGER NOT NULL,
-                    costo_venta REAL NOT NULL,
-                    fecha_venta TEXT NOT NULL
-                )
-            ''')
+    # Relleno por lotes: cada lote es una transacción corta
+    invalidas = []
+    ultimo_id = 0
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f'''
+                    SELECT id, {columna} FROM {tabla}
+                    WHERE id > %s AND {nueva} IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                ''', (ultimo_id, lote))
+                filas = cursor.fetchall()
+                if not filas:
+                    break
+                invalidas.extend(_convertir_filas(cursor, tabla, columna, filas))
+                ultimo_id = filas[-1][0]
+        print(f"  {tabla}.{columna}: convertidas hasta id {ultimo_id}")
+
+    # Intercambio: bloqueo breve para incluir las filas escritas durante el relleno
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {tabla} IN SHARE ROW EXCLUSIVE MODE')
+            cursor.execute(f'SELECT id, {columna} FROM {tabla} WHERE {nueva} IS NULL AND id > %s ORDER BY id', (ultimo_id,))
+            invalidas.extend(_convertir_filas(cursor, tabla, columna, cursor.fetchall()))
+
+            if invalidas and not forzar:
+                conn.rollback()
+                return False, invalidas
+
+            if invalidas:
+                psycopg2.extras.execute_values(cursor, '''
+                    INSERT INTO fechas_no_convertidas (tabla, columna, fila_id, valor) VALUES %s
+                ''', [(tabla, columna, fila_id, valor) for fila_id, valor in invalidas])
+
+            # DROP COLUMN se lleva los índices de la columna (migraciones 0006 y 0009):
+            # se vuelven a crear sobre la columna nueva con el mismo nombre
+            indices = indices_columna(cursor, tabla, columna)
+            cursor.execute(f'ALTER TABLE {tabla} DROP COLUMN {columna}')
+            cursor.execute(f'ALTER TABLE {tabla} RENAME COLUMN {nueva} TO {columna}')
+            cursor.execute(f'ALTER TABLE {tabla} ALTER COLUMN {columna} SET DEFAULT CURRENT_TIMESTAMP')
+            if not invalidas:
+                cursor.execute(f'ALTER TABLE {tabla} ALTER COLUMN {columna} SET NOT NULL')
+            for definicion in indices:
+                cursor.execute(definicion)
+
+    return True, invalidas
+
+def migrar_fechas(lote=MIGRACION_FECHAS_LOTE, forzar=False):
+    """Migrar todas las columnas de fecha pendientes; devuelve {tabla.columna: filas_invalidas}"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            pendientes = columnas_fecha_pendientes(cursor)
+
+    resultado = {}
+    for tabla, columna in pendientes:
+        convertida, invalidas = migrar_columna_fecha(tabla, columna, lote=lote, forzar=forzar)
+        resultado[f'{tabla}.{columna}'] = {'convertida': convertida, 'invalidas': invalidas}
+
+    invalidar_catalogo_esquema()
+    return resultado
+
+@app.cli.command('migrar-fechas')
+@click.option('--lote', default=MIGRACION_FECHAS_LOTE, show_default=True, help='Filas por lote de relleno')
+@click.option('--forzar', is_flag=True, help='Convertir aunque haya fechas inválidas (quedan en NULL)')
+def migrar_fechas_comando(lote, forzar):
+    """Convertir las columnas de fecha TEXT a TIMESTAMP"""
+    resultado = migrar_fechas(lote=lote, forzar=forzar)
+    if not resultado:
+        print("✅ Todas las columnas de fecha ya son TIMESTAMP")
+        return
+
+    fallos = False
+    for nombre, estado in resultado.items():
+        if estado['convertida']:
+            print(f"✅ {nombre} convertida ({len(estado['invalidas'])} fechas inválidas en fechas_no_convertidas)")
+        else:
+            fallos = True
+            print(f"⚠️  {nombre} no convertida: {len(estado['invalidas'])} fechas inválidas")
+            for fila_id, valor in estado['invalidas'][:20]:
+                print(f"     id={fila_id} valor={valor!r}")
+    if fallos:
+        raise SystemExit(1)
+
+# === MIGRACIONES DE ESQUEMA ===
+# El esquema se define en archivos migraciones/NNNN_descripcion.sql que se aplican
+# en orden con 'flask migrar' (comando previo al despliegue). Cada migración corre
+# en su propia transacción y queda registrada en schema_version. Al arrancar, los
+# workers solo comparan la versión registrada con la última disponible: no ejecutan DDL.
+DIRECTORIO_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migraciones')
+MIGRAR_AL_INICIAR = os.environ.get('MIGRAR_AL_INICIAR', '0') == '1'
+CLAVE_BLOQUEO_MIGRACIONES = 720150002
+MARCA_SIN_TRANSACCION = '-- sin-transaccion'
+# Una migración que cambia los datos de origen de las tablas derivadas lo declara
+# con una línea '-- reconstruir: inventario_poza, metricas_mensuales'
+MARCA_RECONSTRUIR = '-- reconstruir:'
+TABLAS_DERIVADAS = ('inventario_poza', 'metricas_mensuales')
+# Desde esta versión las migraciones (y la reconstrucción de las métricas) operan
+# sobre las fechas como TIMESTAMP: antes hay que ejecutar 'flask migrar-fechas'
+MIGRACION_REQUIERE_FECHAS = 12
+
+def listar_migraciones(directorio=DIRECTORIO_MIGRACIONES):
+    """Migraciones disponibles como lista ordenada de (version, nombre, ruta)"""
+    migraciones = []
+    for archivo in os.listdir(directorio):
+        nombre, extension = os.path.splitext(archivo)
+        prefijo = nombre.split('_', 1)[0]
+        if extension != '.sql' or not prefijo.isdigit():
+            continue
+        migraciones.append((int(prefijo), nombre, os.path.join(directorio, archivo)))
+    migraciones.sort()
+
+    versiones = [version for version, _, _ in migraciones]
+    if len(versiones) != len(set(versiones)):
+        raise ValueError("Hay dos migraciones con el mismo número de versión")
+    return migraciones
+
+def sentencias_migracion(sql):
+    """Separar una migración en sentencias (sin líneas de comentario ni vacías)
+
+    Una sentencia termina en una línea que acaba en ';' fuera de un bloque $$ ... $$.
+    """
+    sentencias, actual, en_bloque = [], [], False
+    for linea in sql.splitlines():
+        texto = linea.strip()
+        if not texto or (texto.startswith('--') and not en_bloque):
+            continue
+        actual.append(linea)
+        if texto.count('$$') % 2:
+            en_bloque = not en_bloque
+        if texto.endswith(';') and not en_bloque:
+            sentencias.append('\n'.join(actual).rstrip().rstrip(';'))
+            actual = []
+    if actual:
+        sentencias.append('\n'.join(actual))
+    return sentencias
+
+def ejecutar_migracion(conn, cursor, sql):
+    """Ejecutar el SQL de una migración en la transacción actual
+
+    Las migraciones que empiezan con '-- sin-transaccion' (p. ej. CREATE INDEX
+    CONCURRENTLY) se ejecutan sentencia por sentencia en modo autocommit.
+    """
+    if not sql.lstrip().startswith(MARCA_SIN_TRANSACCION):
+        cursor.execute(sql)
+        return
+
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for sentencia in sentencias_migracion(sql):
+            cursor.execute(sentencia)
+    finally:
+        conn.autocommit = False
+
+def tablas_a_reconstruir(sql):
+    """Tablas derivadas que la migración pide recalcular desde el historial"""
+    tablas = set()
+    for linea in sql.splitlines():
+        texto = linea.strip()
+        if texto.startswith(MARCA_RECONSTRUIR):
+            tablas.update(t.strip() for t in texto[len(MARCA_RECONSTRUIR):].split(',') if t.strip())
+    desconocidas = tablas - set(TABLAS_DERIVADAS)
+    if desconocidas:
+        raise ValueError(f"Tablas a reconstruir desconocidas: {', '.join(sorted(desconocidas))}")
+    return tablas
+
+def version_esquema(cursor):
+    """Última versión aplicada; 0 si schema_version no existe"""
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return cursor.fetchone()[0]
+
+def aplicar_migraciones(hasta=None):
+    """Aplicar las migraciones pendientes en orden; devuelve los nombres aplicados"""
+    aplicadas, reconstruir = [], set()
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # Un solo proceso migra a la vez (despliegues simultáneos)
+            cursor.execute('SELECT pg_advisory_lock(%s)', (CLAVE_BLOQUEO_MIGRACIONES,))
+            try:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        nombre TEXT NOT NULL,
+                        checksum TEXT NOT NULL,
+                        aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                conn.commit()
 
-            # Crear tabla de ventas de descarte si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS ventas_descarte (
-                    id SERIAL PRIMARY KEY,
-                    galpon TEXT NOT NULL,
-                    poza TEXT NOT NULL,
-                    cuyes_vendidos INTEGER NOT NULL,
-                    costo_venta REAL NOT NULL,
-                    fecha_venta TEXT NOT NULL
-                )
-            ''')
+                cursor.execute('SELECT version, checksum FROM schema_version')
+                registradas = dict(cursor.fetchall())
+                fechas_pendientes = columnas_fecha_pendientes(cursor)
 
-            # Crear tabla de gastos si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS gastos (
-                    id SERIAL PRIMARY KEY,
-                    descripcion TEXT NOT NULL,
-                    monto REAL NOT NULL,
-                    tipo TEXT NOT NULL,
-                    fecha_gasto TEXT NOT NULL
-                )
-            ''')
+                for version, nombre, ruta in listar_migraciones():
+                    if hasta is not None and version > hasta:
+                        break
+                    with open(ruta, encoding='utf-8') as archivo:
+                        sql = archivo.read()
+                    checksum = hashlib.sha1(sql.encode('utf-8')).hexdigest()
 
-            # === NUEVAS TABLAS PARA NOTIFICACIONES ===
-            # Crear tabla de notificaciones si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS notificaciones (
-                    id SERIAL PRIMARY KEY,
-                    tipo VARCHAR(50) NOT NULL,
-                    titulo VARCHAR(200) NOT NULL,
-                    mensaje TEXT NOT NULL,
-                    prioridad VARCHAR(20) CHECK (prioridad IN ('baja', 'media', 'alta', 'urgente')),
-                    leida BOOLEAN DEFAULT FALSE,
-                    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    fecha_vencimiento TIMESTAMP,
-                    relacion_id INTEGER,
-                    relacion_tipo VARCHAR(50)
-                )
-            ''')
+                    if version in registradas:
+                        if registradas[version] != checksum:
+                            print(f"⚠️  La migración {nombre} cambió después de aplicarse")
+                        continue
 
-            # Crear tabla de configuraciones de alertas si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS configuraciones_alertas (
-                    id SERIAL PRIMARY KEY,
-                    tipo_alerta VARCHAR(50) UNIQUE NOT NULL,
-                    dias_antes INTEGER DEFAULT 0,
-                    activa BOOLEAN DEFAULT TRUE,
-                    parametros JSONB
-                )
-            ''')
+                    if version >= MIGRACION_REQUIERE_FECHAS and fechas_pendientes:
+                        columnas = ', '.join(f'{tabla}.{columna}' for tabla, columna in fechas_pendientes)
+                        raise RuntimeError(f"La migración {nombre} necesita fechas TIMESTAMP y {columnas} "
+                                           f"sigue siendo TEXT: ejecute 'flask migrar-fechas' y luego 'flask migrar'")
 
-            # Insertar configuraciones predeterminadas si no existen
-            cursor.execute('''
-                INSERT INTO configuraciones_alertas (tipo_alerta, dias_antes, parametros) 
-                VALUES 
-                    ('destete', 15, '{"dias_min": 15, "dias_max": 20}'),
-                    ('descarte', 360, '{"meses_min": 12}'),
-                    ('vacunacion', 0, '{"intervalo_dias": 90}'),
-                    ('control_peso', 30, '{}'),
-                    ('parto_proximo', 70, '{"dias_gestacion": 70}')
-                ON CONFLICT (tipo_alerta) DO NOTHING
-            ''')
+                    try:
+                        ejecutar_migracion(conn, cursor, sql)
+                        cursor.execute(
+                            'INSERT INTO schema_version (version, nombre, checksum) VALUES (%s, %s, %s)',
+                            (version, nombre, checksum))
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        print(f"❌ Error aplicando la migración {nombre}")
+                        raise
+                    aplicadas.append(nombre)
+                    reconstruir |= tablas_a_reconstruir(sql)
+                    print(f"✅ Migración {nombre} aplicada")
+
+                # Las tablas derivadas se recalculan desde el historial si alguna migración
+                # aplicada lo pide (MARCA_RECONSTRUIR) o si están vacías (primera instalación).
+                # Una migración que solo agrega índices no bloquea el inventario.
+                cursor.execute("SELECT to_regclass('inventario_poza') IS NOT NULL")
+                if cursor.fetchone()[0]:
+                    invalidar_catalogo_esquema()
+                    cursor.execute('SELECT EXISTS (SELECT 1 FROM inventario_poza)')
+                    if not cursor.fetchone()[0] or 'inventario_poza' in reconstruir:
+                        reconstruir_inventario_poza(cursor)
+                        conn.commit()
+                        print("✅ Inventario por poza reconstruido")
+
+                # Las métricas agrupan por mes: requieren fechas TIMESTAMP
+                cursor.execute("SELECT to_regclass('metricas_mensuales') IS NOT NULL")
+                if cursor.fetchone()[0] and not fechas_pendientes:
+                    cursor.execute('SELECT EXISTS (SELECT 1 FROM metricas_mensuales)')
+                    if not cursor.fetchone()[0] or 'metricas_mensuales' in reconstruir:
+                        reconstruir_metricas_mensuales(cursor)
+                        conn.commit()
+                        print("✅ Métricas mensuales reconstruidas")
+            finally:
+                conn.rollback()
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (CLAVE_BLOQUEO_MIGRACIONES,))
+
+    # Las columnas pueden haber cambiado: el dashboard debe volver a resolverlas
+    invalidar_catalogo_esquema()
+    return aplicadas
+
+def verificar_version_esquema():
+    """Comprobación de arranque: una consulta, sin DDL; devuelve (actual, esperada)"""
+    migraciones = listar_migraciones()
+    esperada = migraciones[-1][0] if migraciones else 0
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            actual = version_esquema(cursor)
+    return actual, esperada
+
+@app.cli.command('migrar')
+@click.option('--hasta', type=int, default=None, help='Aplicar solo hasta esta versión')
+def migrar_comando(hasta):
+    """Aplicar las migraciones de esquema pendientes
+
+    En una base con fechas TEXT aplica las migraciones anteriores a
+    MIGRACION_REQUIERE_FECHAS, convierte las fechas (como 'flask migrar-fechas')
+    y sigue. Si hay fechas inválidas se detiene en el umbral sin fallar: el
+    despliegue continúa con el esquema anterior y el aviso indica qué corregir.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            fechas_pendientes = columnas_fecha_pendientes(cursor)
+
+    aplicadas = []
+    if fechas_pendientes and (hasta is None or hasta >= MIGRACION_REQUIERE_FECHAS):
+        aplicadas += aplicar_migraciones(hasta=MIGRACION_REQUIERE_FECHAS - 1)
+        resultado = migrar_fechas()
+        no_convertidas = {nombre: estado['invalidas'] for nombre, estado in resultado.items()
+                          if not estado['convertida']}
+        for nombre, estado in resultado.items():
+            if estado['convertida']:
+                print(f"✅ {nombre} convertida a TIMESTAMP")
+        if no_convertidas:
+            for nombre, invalidas in no_convertidas.items():
+                print(f"⚠️  {nombre} no convertida: {len(invalidas)} fechas inválidas")
+            print(f"⚠️  Migraciones detenidas antes de la {MIGRACION_REQUIERE_FECHAS}: corrija las fechas "
+                  f"(o use 'flask migrar-fechas --forzar') y vuelva a ejecutar 'flask migrar'")
+            return
 
-            conn.commit()
-# Llamar a la función para crear o actualizar las tablas al iniciar la aplicación
+    try:
+        aplicadas += aplicar_migraciones(hasta=hasta)
+    except RuntimeError as e:
+        print(f"⚠️  {e}")
+        raise SystemExit(1)
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            version = version_esquema(cursor)
+            pendientes = columnas_fecha_pendientes(cursor)
+    if not aplicadas:
+        print("✅ El esquema ya estaba al día")
+    print(f"Versión del esquema: {version}")
+    for tabla, columna in pendientes:
+        print(f"⚠️  {tabla}.{columna} sigue siendo TEXT: ejecute 'flask migrar-fechas'")
+
+@app.cli.command('version-esquema')
+def version_esquema_comando():
+    """Mostrar la versión aplicada y las migraciones pendientes"""
+    actual, esperada = verificar_version_esquema()
+    print(f"Versión aplicada: {actual} / disponible: {esperada}")
+    for version, nombre, _ in listar_migraciones():
+        if version > actual:
+            print(f"  pendiente: {nombre}")
+
+# === DEDUPLICACIÓN DE PARTOS ===
+# Antes de la migración 0007 (restricción única en partos) pueden existir varios
+# registros del mismo parto creados por peticiones concurrentes. Se unen en el
+# de menor id sumando los contadores; el inventario por poza no cambia.
+def buscar_partos_duplicados(cursor):
+    """Grupos (galpon, poza, numero_parto) con más de un registro"""
+    cursor.execute('''
+        SELECT galpon, poza, numero_parto, ARRAY_AGG(id ORDER BY id) AS ids
+        FROM partos
+        GROUP BY galpon, poza, numero_parto
+        HAVING COUNT(*) > 1
+        ORDER BY galpon, poza, numero_parto
+    ''')
+    return cursor.fetchall()
+
+def unir_partos_duplicados(cursor):
+    """Unir los partos duplicados en el de menor id; devuelve los ids eliminados"""
+    cursor.execute('LOCK TABLE partos IN SHARE ROW EXCLUSIVE MODE')
+    cursor.execute('''
+        WITH grupos AS (
+            SELECT MIN(id) AS conservar,
+                   galpon, poza, numero_parto,
+                   SUM(nacidos) AS nacidos,
+                   SUM(muertos_bebes) AS muertos_bebes,
+                   SUM(muertos_reproductores) AS muertos_reproductores,
+                   MIN(fecha_nacimiento) AS fecha_nacimiento,
+                   ARRAY_AGG(fecha_nacimiento) AS fechas
+            FROM partos
+            GROUP BY galpon, poza, numero_parto
+            HAVING COUNT(*) > 1
+        ), conservados AS (
+            UPDATE partos p
+            SET nacidos = g.nacidos,
+                muertos_bebes = g.muertos_bebes,
+                muertos_reproductores = g.muertos_reproductores,
+                fecha_nacimiento = g.fecha_nacimiento
+            FROM grupos g
+            WHERE p.id = g.conservar
+        )
+        DELETE FROM partos p
+        USING grupos g
+        WHERE p.galpon = g.galpon AND p.poza = g.poza AND p.numero_parto = g.numero_parto
+        AND p.id <> g.conservar
+        RETURNING p.id, g.fechas
+    ''')
+    filas = cursor.fetchall()
+    eliminados = [fila[0] for fila in filas]
+
+    # Los meses de todos los registros unidos cambian de total en metricas_mensuales
+    # (si ya existe y las fechas son TIMESTAMP; si no, 'flask migrar' la llena después)
+    cursor.execute("SELECT to_regclass('metricas_mensuales') IS NOT NULL")
+    if cursor.fetchone()[0] and ('partos', 'fecha_nacimiento') not in columnas_fecha_pendientes(cursor):
+        refrescar_metricas_mensuales(cursor, 'partos', [fecha for _, fechas in filas for fecha in fechas])
+
+    if eliminados:
+        # Las alertas de destete de los registros eliminados ya no aplican
+        cursor.execute('''
+            UPDATE notificaciones SET leida = TRUE
+            WHERE relacion_tipo = 'destete' AND relacion_id = ANY(%s) AND leida = FALSE
+        ''', (eliminados,))
+        avisar_cambio_notificaciones(cursor)
+    return eliminados
+
+@app.cli.command('deduplicar-partos')
+@click.option('--aplicar', is_flag=True, help='Unir los duplicados (sin esta opción solo se listan)')
+def deduplicar_partos_comando(aplicar):
+    """Listar o unir partos duplicados por galpón, poza y número de parto"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            duplicados = buscar_partos_duplicados(cursor)
+            if not duplicados:
+                print("✅ No hay partos duplicados")
+                return
+            for galpon, poza, numero_parto, ids in duplicados:
+                print(f"  Galpón {galpon} Poza {poza} parto {numero_parto}: ids {ids}")
+            if not aplicar:
+                print(f"⚠️  {len(duplicados)} partos duplicados; use --aplicar para unirlos")
+                return
+            eliminados = unir_partos_duplicados(cursor)
+    print(f"✅ {len(duplicados)} partos unidos ({len(eliminados)} registros eliminados)")
+
+# Al iniciar solo se verifica la versión del esquema (MIGRAR_AL_INICIAR=1 aplica
+# las migraciones pendientes, útil en desarrollo local)
 try:
-    crear_o_actualizar_tablas()
+    if MIGRAR_AL_INICIAR:
+        aplicar_migraciones()
+    version_actual, version_esperada = verificar_version_esquema()
+    if version_actual < version_esperada:
+        print(f"⚠️  Esquema en versión {version_actual}, se esperaba {version_esperada}: ejecute 'flask migrar'")
     print("✅ Aplicación iniciada correctamente")
 except Exception as e:
-    print(f"⚠️  Error al inicializar tablas: {e}")
+    print(f"⚠️  Error al verificar el esquema: {e}")
 
-# Agregar estas funciones después de las funciones existentes
-def generar_notificaciones_destetes():
-    """Detectar cuyes listos para destete (15-20 días)"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Buscar partos con crías entre 15 y 20 días
-                cursor.execute('''
-                    SELECT p.id, p.galpon, p.poza, p.nacidos, p.fecha_nacimiento,
-                           EXTRACT(DAYS FROM (CURRENT_DATE - TO_DATE(p.fecha_nacimiento, 'YYYY-MM-DD'))) as dias
-                    FROM partos p
-                    LEFT JOIN destetes d ON p.galpon = d.galpon AND p.poza = d.poza
-                    WHERE d.id IS NULL 
-                    AND EXTRACT(DAYS FROM (CURRENT_DATE - TO_DATE(p.fecha_nacimiento, 'YYYY-MM-DD'))) BETWEEN 15 AND 20
-                ''')
-                partos_pendientes = cursor.fetchall()
-                
-                notificaciones = []
-                for parto in partos_pendientes:
-                    # Verificar si ya existe notificación para este parto
-                    cursor.execute('''
-                        SELECT id FROM notificaciones 
-                        WHERE relacion_id = %s AND relacion_tipo = 'destete' AND leida = FALSE
-                    ''', (parto['id'],))
-                    existe = cursor.fetchone()
-                    
-                    if not existe:
-                        notificaciones.append({
-                            'tipo': 'destete',
-                            'titulo': f'Destete Pendiente - Galpón {parto["galpon"]} Poza {parto["poza"]}',
-                            'mensaje': f'{parto["nacidos"]} cuyes tienen {parto["dias"]} días. ¡Es tiempo de destetar!',
-                            'prioridad': 'alta' if parto['dias'] > 25 else 'media',
-                            'relacion_id': parto['id'],
-                            'relacion_tipo': 'destete'
-                        })
-                
-                return notificaciones
-    except Exception as e:
-        print(f"Error generando notificaciones de destete: {e}")
-        return []
+# === GENERACIÓN DE NOTIFICACIONES ===
+# Cada tipo de alerta es un único INSERT ... SELECT. Los índices únicos parciales
+# sobre las alertas no leídas descartan duplicados con ON CONFLICT DO NOTHING,
+# también cuando dos workers generan alertas a la vez.
+COLUMNAS_NOTIFICACION = 'id, tipo, titulo, mensaje, prioridad, relacion_id, relacion_tipo'
 
-def generar_notificaciones_descarte():
+def generar_notificaciones_destetes(cursor):
+    """Detectar cuyes listos para destete (15-20 días)"""
+    cursor.execute(f'''
+        INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad, relacion_id, relacion_tipo)
+        SELECT 'destete',
+               'Destete Pendiente - Galpón ' || p.galpon || ' Poza ' || p.poza,
+               p.nacidos || ' cuyes tienen ' || p.dias || ' días. ¡Es tiempo de destetar!',
+               CASE WHEN p.dias > 25 THEN 'alta' ELSE 'media' END,
+               p.id,
+               'destete'
+        FROM (
+            SELECT p.id, p.galpon, p.poza, p.nacidos,
+                   CURRENT_DATE - p.fecha_nacimiento::date AS dias
+            FROM partos p
+            LEFT JOIN inventario_poza i ON p.galpon = i.galpon AND p.poza = i.poza
+            WHERE COALESCE(i.destetados, 0) = 0
+            -- Nacidos hace entre 15 y 20 días
+            AND p.fecha_nacimiento >= CURRENT_DATE - 20
+            AND p.fecha_nacimiento < CURRENT_DATE - 14
+        ) p
+        ON CONFLICT DO NOTHING
+        RETURNING {COLUMNAS_NOTIFICACION}
+    ''')
+    return cursor.fetchall()
+
+def generar_notificaciones_descarte(cursor):
     """Detectar reproductores para descarte (> 12 meses)"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute('''
-                    SELECT id, galpon, poza, hembras, machos, fecha_ingreso,
-                           EXTRACT(MONTHS FROM (CURRENT_DATE - TO_DATE(fecha_ingreso, 'YYYY-MM-DD'))) as meses
-                    FROM reproductores 
-                    WHERE EXTRACT(MONTHS FROM (CURRENT_DATE - TO_DATE(fecha_ingreso, 'YYYY-MM-DD'))) >= 12
-                ''')
-                reproductores_descarte = cursor.fetchall()
-                
-                notificaciones = []
-                for repro in reproductores_descarte:
-                    cursor.execute('''
-                        SELECT id FROM notificaciones 
-                        WHERE relacion_id = %s AND relacion_tipo = 'descarte' AND leida = FALSE
-                    ''', (repro['id'],))
-                    existe = cursor.fetchone()
-                    
-                    if not existe:
-                        notificaciones.append({
-                            'tipo': 'descarte',
-                            'titulo': f'Descarte Programado - Galpón {repro["galpon"]} Poza {repro["poza"]}',
-                            'mensaje': f'Reproductores con {repro["meses"]} meses. Considerar descarte.',
-                            'prioridad': 'media',
-                            'relacion_id': repro['id'],
-                            'relacion_tipo': 'descarte'
-                        })
-                
-                return notificaciones
-    except Exception as e:
-        print(f"Error generando notificaciones de descarte: {e}")
-        return []
-
-def generar_notificaciones_salud():
-    """Alertas de salud basadas en mortalidad"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Mortalidad alta en últimos 7 días
-                cursor.execute('''
-                    SELECT galpon, poza, SUM(muertos_hembras + muertos_machos) as total_muertes
-                    FROM muertes_destetados 
-                    WHERE TO_DATE(fecha_muerte, 'YYYY-MM-DD') >= CURRENT_DATE - INTERVAL '7 days'
-                    GROUP BY galpon, poza 
-                    HAVING SUM(muertos_hembras + muertos_machos) > 3
-                ''')
-                mortalidad_alta = cursor.fetchall()
-                
-                notificaciones = []
-                for registro in mortalidad_alta:
-                    notificaciones.append({
-                        'tipo': 'salud',
-                        'titulo': f'Alerta de Salud - Galpón {registro["galpon"]} Poza {registro["poza"]}',
-                        'mensaje': f'Alta mortalidad: {registro["total_muertes"]} muertes en 7 días.',
-                        'prioridad': 'urgente',
-                        'relacion_id': None,
-                        'relacion_tipo': 'salud'
-                    })
-                
-                return notificaciones
-    except Exception as e:
-        print(f"Error generando notificaciones de salud: {e}")
-        return []
-
-def guardar_notificaciones(notificaciones):
-    """Guardar notificaciones en la base de datos"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                for notif in notificaciones:
-                    cursor.execute('''
-                        INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad, relacion_id, relacion_tipo)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    ''', (notif['tipo'], notif['titulo'], notif['mensaje'], 
-                          notif['prioridad'], notif['relacion_id'], notif['relacion_tipo']))
-                conn.commit()
-    except Exception as e:
-        print(f"Error guardando notificaciones: {e}")
+    cursor.execute(f'''
+        INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad, relacion_id, relacion_tipo)
+        SELECT 'descarte',
+               'Descarte Programado - Galpón ' || r.galpon || ' Poza ' || r.poza,
+               'Reproductores con ' || r.meses || ' meses. Considerar descarte.',
+               'media',
+               r.id,
+               'descarte'
+        FROM (
+            SELECT id, galpon, poza,
+                   (DATE_PART('year', AGE(CURRENT_DATE, fecha_ingreso::date)) * 12
+                    + DATE_PART('month', AGE(CURRENT_DATE, fecha_ingreso::date)))::int AS meses
+            FROM reproductores
+            -- Ingresados hace 12 meses o más
+            WHERE fecha_ingreso < CURRENT_DATE - INTERVAL '12 months' + INTERVAL '1 day'
+        ) r
+        ON CONFLICT DO NOTHING
+        RETURNING {COLUMNAS_NOTIFICACION}
+    ''')
+    return cursor.fetchall()
+
+def generar_notificaciones_salud(cursor):
+    """Alertas de salud basadas en mortalidad (más de 3 muertes en 7 días)"""
+    # Las alertas de salud no tienen relacion_id: el índice único las deduplica por título
+    cursor.execute(f'''
+        INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad, relacion_id, relacion_tipo)
+        SELECT 'salud', m.titulo,
+               'Alta mortalidad: ' || m.total_muertes || ' muertes en 7 días.',
+               'urgente',
+               NULL,
+               'salud'
+        FROM (
+            SELECT 'Alerta de Salud - Galpón ' || galpon || ' Poza ' || poza AS titulo,
+                   SUM(muertos_hembras + muertos_machos) AS total_muertes
+            FROM muertes_destetados
+            WHERE fecha_muerte >= CURRENT_DATE - INTERVAL '7 days'
+            GROUP BY galpon, poza
+            HAVING SUM(muertos_hembras + muertos_machos) > 3
+        ) m
+        ON CONFLICT DO NOTHING
+        RETURNING {COLUMNAS_NOTIFICACION}
+    ''')
+    return cursor.fetchall()
+
+GENERADORES_NOTIFICACIONES = (
+    ('destete', generar_notificaciones_destetes),
+    ('descarte', generar_notificaciones_descarte),
+    ('salud', generar_notificaciones_salud),
+)
+
+def insertar_notificaciones_pendientes(cursor, errores=None):
+    """Ejecutar todos los generadores con el cursor dado; devuelve las notificaciones creadas"""
+    notificaciones = []
+    for tipo, generador in GENERADORES_NOTIFICACIONES:
+        # Un error en un tipo de alerta no debe descartar las demás
+        cursor.execute('SAVEPOINT generar_notificacion')
+        try:
+            notificaciones.extend(dict(fila) for fila in generador(cursor))
+            cursor.execute('RELEASE SAVEPOINT generar_notificacion')
+        except psycopg2.Error as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT generar_notificacion')
+            print(f"Error generando notificaciones de {tipo}: {e}")
+            if errores is not None:
+                errores.append(f"{tipo}: {e}")
+    if notificaciones:
+        avisar_cambio_notificaciones(cursor)
+    return notificaciones
 
 # Función principal para generar todas las notificaciones
 def generar_todas_las_notificaciones():
-    notificaciones = []
-    notificaciones.extend(generar_notificaciones_destetes())
-    notificaciones.extend(generar_notificaciones_descarte())
-    notificaciones.extend(generar_notificaciones_salud())
-    
+    """Generar todas las alertas en una transacción; devuelve las notificaciones creadas"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            notificaciones = insertar_notificaciones_pendientes(cursor)
+
     if notificaciones:
-        guardar_notificaciones(notificaciones)
         print(f"✅ Generadas {len(notificaciones)} notificaciones")
-    
+
     return notificaciones
-# Ruta principal
 
+# === PROGRAMADOR DE NOTIFICACIONES ===
+# Cada worker tiene un hilo que despierta cada NOTIFICACIONES_INTERVALO segundos
+# (con variación aleatoria). Un advisory lock de PostgreSQL y la fecha de la
+# última ejecución en tareas_programadas garantizan que, entre todos los
+# workers, la generación se ejecute una sola vez por intervalo.
+NOTIFICACIONES_INTERVALO = float(os.environ.get('NOTIFICACIONES_INTERVALO', 900))   # 0 desactiva la ejecución periódica
+NOTIFICACIONES_JITTER = float(os.environ.get('NOTIFICACIONES_JITTER', 0.1))         # fracción del intervalo
+NOTIFICACIONES_PROGRAMADOR = os.environ.get('NOTIFICACIONES_PROGRAMADOR', '1') == '1'  # hilo dentro de los workers web
+CLAVE_BLOQUEO_NOTIFICACIONES = 720150001
+
+_programador = {'hilo': None, 'pid': None, 'evento': None, 'forzar': False}
+_programador_lock = threading.Lock()
+
+def ejecutar_generacion_programada(forzar=False):
+    """Generar notificaciones si este worker obtiene el bloqueo y el intervalo venció
+
+    Devuelve la lista de notificaciones creadas, o None si la ejecución se omitió.
+    """
+    inicio = time.monotonic()
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s) AS bloqueo', (CLAVE_BLOQUEO_NOTIFICACIONES,))
+            if not cursor.fetchone()['bloqueo']:
+                return None
 
-@app.route("/")
-def index():
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+            if not forzar:
+                cursor.execute('''
+                    SELECT ultima_ejecucion > NOW() - make_interval(secs => %s) AS reciente
+                    FROM tareas_programadas WHERE nombre = 'notificaciones'
+                ''', (NOTIFICACIONES_INTERVALO * (1 - NOTIFICACIONES_JITTER),))
+                fila = cursor.fetchone()
+                if fila and fila['reciente']:
+                    return None
+
+            errores = []
+            notificaciones = insertar_notificaciones_pendientes(cursor, errores)
+
+            cursor.execute('''
+                INSERT INTO tareas_programadas (nombre, ultima_ejecucion, duracion_ms, generadas, error, ejecutado_por)
+                VALUES ('notificaciones', NOW(), %s, %s, %s, %s)
+                ON CONFLICT (nombre) DO UPDATE
+                SET ultima_ejecucion = EXCLUDED.ultima_ejecucion,
+                    duracion_ms = EXCLUDED.duracion_ms,
+                    generadas = EXCLUDED.generadas,
+                    error = EXCLUDED.error,
+                    ejecutado_por = EXCLUDED.ejecutado_por
+            ''', (int((time.monotonic() - inicio) * 1000), len(notificaciones), '; '.join(errores) or None,
+                  f"{socket.gethostname()}:{os.getpid()}"))
 
-        # -----------------------
-        # Totales generales
-        # -----------------------
-        # Total reproductores (sum actual de hembras+machos)
+    if notificaciones:
+        print(f"✅ Generadas {len(notificaciones)} notificaciones (programador)")
+    return notificaciones
+
+def _bucle_programador(evento, periodico=True):
+    while True:
+        espera = None
+        if periodico and NOTIFICACIONES_INTERVALO > 0:
+            espera = NOTIFICACIONES_INTERVALO * (1 + random.uniform(-NOTIFICACIONES_JITTER, NOTIFICACIONES_JITTER))
+        evento.wait(espera)
+        with _programador_lock:
+            forzar = _programador['forzar']
+            _programador['forzar'] = False
+            evento.clear()
         try:
-            cur.execute("SELECT COALESCE(SUM(hembras + machos), 0) FROM reproductores;")
-            total_reproductores = cur.fetchone()[0] or 0
+            ejecutar_generacion_programada(forzar=forzar)
         except Exception as e:
-            print("Error total_reproductores:", e)
-            total_reproductores = 0
+            app.logger.error("Error en el programador de notificaciones", exc_info=e)
+
+def iniciar_programador():
+    """Arrancar el hilo del programador en el proceso actual si aún no corre"""
+    pid = os.getpid()
+    hilo = _programador['hilo']
+    if hilo is not None and _programador['pid'] == pid and hilo.is_alive():
+        return _programador['evento']
+
+    with _programador_lock:
+        hilo = _programador['hilo']
+        if hilo is not None and hilo.is_alive() and _programador['pid'] == pid:
+            return _programador['evento']
+
+        # Tras un fork el hilo del proceso padre no existe en el hijo
+        evento = threading.Event()
+        hilo = threading.Thread(target=_bucle_programador, args=(evento, NOTIFICACIONES_PROGRAMADOR),
+                                name='programador-notificaciones', daemon=True)
+        _programador.update(hilo=hilo, pid=pid, evento=evento, forzar=False)
+        if NOTIFICACIONES_PROGRAMADOR:
+            evento.set()  # revisar al arrancar; la última ejecución evita repeticiones
+        hilo.start()
+        return evento
+
+def solicitar_generacion_notificaciones():
+    """Pedir al programador una ejecución inmediata sin bloquear la petición"""
+    evento = iniciar_programador()
+    with _programador_lock:
+        _programador['forzar'] = True
+        evento.set()
+
+def obtener_estado_programador():
+    """Estado de la última ejecución (compartido entre workers) y del hilo local"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute('''
+                SELECT ultima_ejecucion, duracion_ms, generadas, error, ejecutado_por
+                FROM tareas_programadas WHERE nombre = 'notificaciones'
+            ''')
+            fila = cursor.fetchone()
+
+    estado = dict(fila) if fila else {'ultima_ejecucion': None}
+    if estado['ultima_ejecucion'] is not None:
+        estado['ultima_ejecucion'] = estado['ultima_ejecucion'].isoformat()
+    hilo = _programador['hilo']
+    estado.update({
+        'intervalo_segundos': NOTIFICACIONES_INTERVALO,
+        'periodico': NOTIFICACIONES_PROGRAMADOR and NOTIFICACIONES_INTERVALO > 0,
+        'hilo_activo': bool(hilo and hilo.is_alive() and _programador['pid'] == os.getpid())
+    })
+    return estado
+
+@app.before_request
+def arrancar_programador_notificaciones():
+    if NOTIFICACIONES_PROGRAMADOR and not app.testing:
+        iniciar_programador()
+
+@app.cli.command('programador-notificaciones')
+def programador_notificaciones_comando():
+    """Ejecutar el programador en primer plano (proceso worker separado)"""
+    print(f"Programador de notificaciones cada {NOTIFICACIONES_INTERVALO}s")
+    evento = threading.Event()
+    evento.set()  # primera ejecución inmediata
+    _bucle_programador(evento)
+
+# === VISTAS MATERIALIZADAS ===
+# /balance lee el flujo de caja de una vista materializada (migración 0012) en
+# lugar de agregar ventas y gastos en cada visita; /resultados y el resumen de
+# /analisis_datos ya leen metricas_mensuales e inventario_poza, que las
+# escrituras mantienen al día. Cada worker tiene un hilo que refresca la vista
+# con REFRESH ... CONCURRENTLY (las lecturas no se bloquean) cada
+# VISTAS_INTERVALO segundos y, tras una ráfaga de escrituras, cuando pasan
+# VISTAS_RETARDO segundos sin nuevos POST.
+VISTAS_MATERIALIZADAS = ('mv_flujo_caja',)
+VISTAS_INTERVALO = float(os.environ.get('VISTAS_INTERVALO', 900))   # 0 desactiva el refresco periódico
+VISTAS_RETARDO = float(os.environ.get('VISTAS_RETARDO', 30))        # segundos sin escrituras antes de refrescar
+VISTAS_PROGRAMADOR = os.environ.get('VISTAS_PROGRAMADOR', '1') == '1'
+CLAVE_BLOQUEO_VISTAS = 720150004
+
+_vistas = {'hilo': None, 'pid': None, 'evento': None, 'ultima_escritura': None}
+_vistas_lock = threading.Lock()
+
+def refrescar_vistas_materializadas(forzar=True):
+    """Refrescar todas las vistas; devuelve las refrescadas, o None si se omitió
+
+    Se omite si otro worker está refrescando o, sin forzar, si el último
+    refresco tiene menos de VISTAS_INTERVALO segundos.
+    """
+    inicio = time.monotonic()
+    refrescadas, errores = [], []
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (CLAVE_BLOQUEO_VISTAS,))
+            if not cursor.fetchone()[0]:
+                return None
+            try:
+                if not forzar:
+                    cursor.execute('''
+                        SELECT ultima_ejecucion > NOW() - make_interval(secs => %s)
+                        FROM tareas_programadas WHERE nombre = 'vistas_materializadas'
+                    ''', (VISTAS_INTERVALO,))
+                    fila = cursor.fetchone()
+                    if fila and fila[0]:
+                        conn.commit()
+                        return None
+
+                # Las vistas reflejan los datos desde este momento
+                cursor.execute('SELECT NOW()')
+                refrescadas_desde = cursor.fetchone()[0]
+                conn.commit()
+
+                # Una transacción por vista para no retener el resto de bloqueos
+                for vista in VISTAS_MATERIALIZADAS:
+                    try:
+                        cursor.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {vista}')
+                        conn.commit()
+                        refrescadas.append(vista)
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        errores.append(f"{vista}: {e}")
+
+                cursor.execute('''
+                    INSERT INTO tareas_programadas (nombre, ultima_ejecucion, duracion_ms, generadas, error, ejecutado_por)
+                    VALUES ('vistas_materializadas', %s, %s, %s, %s, %s)
+                    ON CONFLICT (nombre) DO UPDATE
+                    SET ultima_ejecucion = EXCLUDED.ultima_ejecucion,
+                        duracion_ms = EXCLUDED.duracion_ms,
+                        generadas = EXCLUDED.generadas,
+                        error = EXCLUDED.error,
+                        ejecutado_por = EXCLUDED.ejecutado_por
+                ''', (refrescadas_desde, int((time.monotonic() - inicio) * 1000), len(refrescadas),
+                      '; '.join(errores) or None, f"{socket.gethostname()}:{os.getpid()}"))
+                conn.commit()
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', (CLAVE_BLOQUEO_VISTAS,))
+
+    for error in errores:
+        print(f"Error refrescando {error}")
+    return refrescadas
+
+def _bucle_vistas(evento, periodico=True):
+    while True:
+        espera = VISTAS_INTERVALO if periodico and VISTAS_INTERVALO > 0 else None
+        evento.wait(espera)
+
+        # Esperar a que la ráfaga de escrituras termine
+        while True:
+            with _vistas_lock:
+                evento.clear()
+                ultima = _vistas['ultima_escritura']
+                restante = ultima + VISTAS_RETARDO - time.monotonic() if ultima is not None else 0
+                if restante <= 0:
+                    _vistas['ultima_escritura'] = None
+                    break
+            time.sleep(restante)
 
-        # Total destetados
         try:
-            cur.execute("SELECT COALESCE(SUM(destetados_hembras + destetados_machos), 0) FROM destetes;")
-            total_destetados = cur.fetchone()[0] or 0
+            refrescar_vistas_materializadas(forzar=ultima is not None)
         except Exception as e:
-            print("Error total_destetados:", e)
-            total_destetados = 0
+            app.logger.error("Error refrescando las vistas materializadas", exc_info=e)
+
+def iniciar_refresco_vistas():
+    """Arrancar el hilo de refresco del proceso actual si aún no corre"""
+    pid = os.getpid()
+    with _vistas_lock:
+        hilo = _vistas['hilo']
+        if hilo is not None and hilo.is_alive() and _vistas['pid'] == pid:
+            return _vistas['evento']
+
+        evento = threading.Event()
+        hilo = threading.Thread(target=_bucle_vistas, args=(evento,), name='refresco-vistas', daemon=True)
+        _vistas.update(hilo=hilo, pid=pid, evento=evento, ultima_escritura=None)
+        hilo.start()
+        return evento
+
+def marcar_vistas_pendientes():
+    """Avisar al hilo de refresco de que hubo una escritura"""
+    evento = iniciar_refresco_vistas()
+    with _vistas_lock:
+        _vistas['ultima_escritura'] = time.monotonic()
+        evento.set()
+
+def obtener_estado_vistas(cursor):
+    """Antigüedad del último refresco para el indicador de las páginas (cursor con columnas por nombre)"""
+    cursor.execute('''
+        SELECT ultima_ejecucion, EXTRACT(EPOCH FROM NOW() - ultima_ejecucion) AS antiguedad
+        FROM tareas_programadas WHERE nombre = 'vistas_materializadas'
+    ''')
+    fila = cursor.fetchone()
+    if not fila or fila['ultima_ejecucion'] is None:
+        return {'actualizado': None, 'minutos': None, 'desactualizado': True}
+
+    antiguedad = float(fila['antiguedad'])
+    return {
+        'actualizado': fila['ultima_ejecucion'].strftime('%d/%m/%Y %H:%M'),
+        'minutos': int(antiguedad // 60),
+        'desactualizado': (_vistas['ultima_escritura'] is not None and _vistas['pid'] == os.getpid())
+                          or (VISTAS_INTERVALO > 0 and antiguedad > 2 * VISTAS_INTERVALO),
+    }
+
+@app.after_request
+def avisar_escritura_vistas(respuesta):
+    if request.method == 'POST' and respuesta.status_code < 400 and VISTAS_PROGRAMADOR and not app.testing:
+        marcar_vistas_pendientes()
+    return respuesta
+
+@app.before_request
+def arrancar_refresco_vistas():
+    if VISTAS_PROGRAMADOR and not app.testing:
+        iniciar_refresco_vistas()
+
+@app.cli.command('refrescar-vistas')
+def refrescar_vistas_comando():
+    """Refrescar ahora las vistas materializadas de las páginas de análisis"""
+    refrescadas = refrescar_vistas_materializadas()
+    if refrescadas is None:
+        print("⚠️  Otro proceso está refrescando las vistas")
+        raise SystemExit(1)
+    print(f"✅ {len(refrescadas)} de {len(VISTAS_MATERIALIZADAS)} vistas refrescadas")
+    if len(refrescadas) < len(VISTAS_MATERIALIZADAS):
+        raise SystemExit(1)
+
+# === NOTIFICACIONES EN TIEMPO REAL (SSE) ===
+# Las escrituras sobre notificaciones emiten NOTIFY en el canal 'notificaciones'.
+# Cada worker mantiene una única conexión LISTEN (fuera del pool) y, ante cada
+# aviso, lee una vez las pendientes y las reparte a los navegadores suscritos
+# por /api/notificaciones/stream. Las pestañas abiertas no ocupan conexiones.
+# Con workers gthread cada stream ocupa un hilo: se admiten a lo sumo
+# SSE_MAX_STREAMS por worker (el resto recibe 503 y el navegador consulta
+# /api/notificaciones) y cada stream se cierra a los SSE_DURACION_MAX segundos
+# para que el navegador reconecte y los cupos roten.
+CANAL_NOTIFICACIONES = 'notificaciones'
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))        # segundos entre comentarios de keep-alive
+SSE_REINTENTO_MS = int(os.environ.get('SSE_REINTENTO_MS', 5000))  # espera sugerida al navegador para reconectar
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))       # streams abiertos por worker
+SSE_DURACION_MAX = float(os.environ.get('SSE_DURACION_MAX', 300)) # segundos antes de cerrar un stream
+
+_cupos_sse = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+_suscriptores = set()
+_suscriptores_lock = threading.Lock()
+_escucha = {'hilo': None, 'pid': None}
+
+def avisar_cambio_notificaciones(cursor):
+    """Emitir NOTIFY; PostgreSQL lo entrega al confirmar la transacción"""
+    cursor.execute('SELECT pg_notify(%s, %s)', (CANAL_NOTIFICACIONES, str(os.getpid())))
+
+def listar_notificaciones_pendientes(cursor):
+    """Notificaciones no leídas ordenadas por prioridad y fecha"""
+    cursor.execute(f'''
+        SELECT * FROM notificaciones
+        WHERE leida = FALSE
+        ORDER BY {RANGO_PRIORIDAD_SQL}, fecha_creacion DESC
+        LIMIT 20
+    ''')
+    return [dict(notif) for notif in cursor.fetchall()]
+
+def obtener_instantanea_notificaciones():
+    """Devolver (version, json) de las pendientes; la versión sirve como id de evento SSE"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            notificaciones = listar_notificaciones_pendientes(cursor)
+
+    datos = app.json.dumps(notificaciones)
+    version = hashlib.sha1(datos.encode('utf-8')).hexdigest()[:16]
+    return version, datos
+
+def _difundir_notificaciones():
+    with _suscriptores_lock:
+        colas = list(_suscriptores)
+    if not colas:
+        return
+
+    instantanea = obtener_instantanea_notificaciones()
+    for cola in colas:
+        # Solo importa el estado más reciente: descartar el pendiente si lo hay
+        try:
+            cola.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            cola.put_nowait(instantanea)
+        except queue.Full:
+            pass
 
-        # Total nacidos
-        total_nacidos = 0
+def _bucle_escucha():
+    while True:
+        conn = None
         try:
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'partos');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'partos';")
-                parto_cols = [r[0] for r in cur.fetchall()]
-
-                if 'nacidos' in parto_cols:
-                    cur.execute("SELECT COALESCE(SUM(nacidos),0) FROM partos;")
-                elif 'nacidos_hembras' in parto_cols and 'nacidos_machos' in parto_cols:
-                    cur.execute("SELECT COALESCE(SUM(nacidos_hembras + nacidos_machos),0) FROM partos;")
-                elif 'crias_nacidas_hembras' in parto_cols and 'crias_nacidas_machos' in parto_cols:
-                    cur.execute("SELECT COALESCE(SUM(crias_nacidas_hembras + crias_nacidas_machos),0) FROM partos;")
-                else:
-                    columna_nacidos = None
-                    for c in parto_cols:
-                        if any(k in c.lower() for k in ('nac', 'cria', 'bebe', 'parto')) and not c.lower().startswith('fecha'):
-                            columna_nacidos = c
-                            break
-                    if columna_nacidos:
-                        cur.execute(f"SELECT COALESCE(SUM({columna_nacidos}),0) FROM partos;")
-                    else:
-                        cur.execute("SELECT COUNT(*) FROM partos;")
-                total_nacidos = cur.fetchone()[0] or 0
+            conn = psycopg2.connect(**_parametros_conexion())
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CANAL_NOTIFICACIONES}')
+            # Al (re)conectar pudieron perderse avisos
+            _difundir_notificaciones()
+
+            while True:
+                if select.select([conn], [], [], SSE_HEARTBEAT) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    _difundir_notificaciones()
         except Exception as e:
-            print("Error total_nacidos:", e)
-            conn.rollback()
-            total_nacidos = 0
-
-        # Nacidos actuales
-        nacidos_actuales = total_nacidos - total_destetados
+            app.logger.error("Error en la escucha de notificaciones", exc_info=e)
+            time.sleep(SSE_REINTENTO_MS / 1000)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
 
-        # Total muertos
-        total_muertos = 0
+def iniciar_escucha_notificaciones():
+    """Arrancar el hilo LISTEN del proceso actual si aún no corre"""
+    pid = os.getpid()
+    with _suscriptores_lock:
+        hilo = _escucha['hilo']
+        if hilo is not None and hilo.is_alive() and _escucha['pid'] == pid:
+            return
+        hilo = threading.Thread(target=_bucle_escucha, name='escucha-notificaciones', daemon=True)
+        _escucha.update(hilo=hilo, pid=pid)
+        hilo.start()
+
+def suscribir_notificaciones():
+    cola = queue.Queue(maxsize=1)
+    iniciar_escucha_notificaciones()
+    with _suscriptores_lock:
+        _suscriptores.add(cola)
+    return cola
+
+def cancelar_suscripcion_notificaciones(cola):
+    with _suscriptores_lock:
+        _suscriptores.discard(cola)
+
+def formatear_evento_sse(version, datos, evento='notificaciones'):
+    return f"id: {version}\nevent: {evento}\ndata: {datos}\n\n"
+
+# === CATÁLOGO DE GALPONES Y POZAS ===
+# Las listas de los formularios salen de las tablas galpones/pozas (migración
+# 0008), no de las tablas de eventos. Cada worker guarda el catálogo en memoria
+# durante CATALOGO_TTL segundos; las escrituras del propio worker lo invalidan
+# y los demás lo recargan al vencer el TTL.
+CATALOGO_TTL = float(os.environ.get('CATALOGO_TTL', 300))
+
+_catalogo_pozas = {'datos': None, 'expira': 0.0}
+_catalogo_pozas_lock = threading.Lock()
+
+def registrar_poza_catalogo(cursor, galpon, poza):
+    """Agregar el galpón y la poza al catálogo si aún no existen"""
+    if not galpon or not poza:
+        return
+    cursor.execute('INSERT INTO galpones (galpon) VALUES (%s) ON CONFLICT (galpon) DO NOTHING', (galpon,))
+    cursor.execute('''
+        INSERT INTO pozas (galpon, poza) VALUES (%s, %s)
+        ON CONFLICT (galpon, poza) DO NOTHING
+    ''', (galpon, poza))
+
+def cargar_catalogo_pozas(cursor):
+    """Leer el catálogo y calcular su ETag"""
+    cursor.execute('SELECT galpon, poza FROM pozas ORDER BY galpon, poza')
+    pozas = [{'galpon': galpon, 'poza': poza} for galpon, poza in cursor.fetchall()]
+    cursor.execute('SELECT galpon FROM galpones ORDER BY galpon')
+    galpones = [fila[0] for fila in cursor.fetchall()]
+
+    datos = {
+        'galpones': galpones,
+        'pozas_unicas': sorted({fila['poza'] for fila in pozas}),
+        'galpones_pozas': pozas,
+    }
+    datos['etag'] = hashlib.sha1(app.json.dumps(datos).encode('utf-8')).hexdigest()[:16]
+    return datos
+
+def obtener_catalogo_pozas():
+    """Catálogo en memoria del proceso; se recarga al vencer el TTL o tras invalidarlo"""
+    datos = _catalogo_pozas['datos']
+    if datos is not None and time.monotonic() < _catalogo_pozas['expira']:
+        return datos
+
+    with _catalogo_pozas_lock:
+        if _catalogo_pozas['datos'] is not None and time.monotonic() < _catalogo_pozas['expira']:
+            return _catalogo_pozas['datos']
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                datos = cargar_catalogo_pozas(cursor)
+        _catalogo_pozas.update(datos=datos, expira=time.monotonic() + CATALOGO_TTL)
+        return datos
+
+def invalidar_catalogo_pozas():
+    """Llamar después de confirmar una escritura sobre galpones o pozas"""
+    with _catalogo_pozas_lock:
+        _catalogo_pozas.update(datos=None, expira=0.0)
+
+# === LISTADOS PAGINADOS DE ANÁLISIS ===
+# Cada pestaña de /analisis_datos pide sus filas a /api/analisis/<tabla> por
+# páginas. La paginación es por clave: el cursor 'despues' codifica la última
+# fila devuelta y la página siguiente continúa con una comparación de tuplas
+# sobre el mismo orden del índice (galpon, poza, fecha, id). La memoria por
+# petición depende del tamaño de página, no del tamaño de la tabla.
+LISTADOS_ANALISIS = {
+    'reproductores': {'fecha': 'fecha_ingreso', 'por_poza': True},
+    'partos': {'fecha': 'fecha_nacimiento', 'por_poza': True},
+    'destetes': {'fecha': 'fecha_destete', 'por_poza': True},
+    'muertes_destetados': {'fecha': 'fecha_muerte', 'por_poza': True},
+    # Las ventas de destetados no tienen poza: el listado va por fecha como gastos
+    'ventas': {'fecha': 'fecha_venta', 'por_poza': False, 'descendente': True},
+    'gastos': {'fecha': 'fecha_gasto', 'por_poza': False, 'descendente': True},
+}
+LISTADO_LIMITE = int(os.environ.get('LISTADO_LIMITE', 50))
+LISTADO_LIMITE_MAXIMO = 500
+
+def columnas_orden_listado(tabla):
+    """Clave de orden del listado (coincide con un índice de la tabla)"""
+    config = LISTADOS_ANALISIS[tabla]
+    return (['galpon', 'poza'] if config['por_poza'] else []) + [config['fecha'], 'id']
+
+def codificar_cursor_listado(valores):
+    texto = app.json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in valores])
+    return base64.urlsafe_b64encode(texto.encode('utf-8')).decode('ascii')
+
+def decodificar_cursor_listado(cursor_texto, columnas):
+    """Valores de la clave de orden; ValueError si el cursor no es válido"""
+    try:
+        valores = app.json.loads(base64.urlsafe_b64decode(cursor_texto.encode('ascii')))
+    except Exception:
+        raise ValueError("Cursor de paginación no válido")
+    if not isinstance(valores, list) or len(valores) != len(columnas):
+        raise ValueError("Cursor de paginación no válido")
+    # Un cursor alterado puede traer listas u objetos: solo valores simples
+    if not all(v is None or isinstance(v, (str, int, float)) for v in valores):
+        raise ValueError("Cursor de paginación no válido")
+    # La fecha es la penúltima columna de la clave
+    if valores[-2] is not None:
         try:
-            muertos_partos = 0
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'partos');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'partos';")
-                parto_cols = [r[0] for r in cur.fetchall()]
-                if 'muertos_bebes' in parto_cols or 'muertos_reproductores' in parto_cols:
-                    expr = []
-                    if 'muertos_bebes' in parto_cols:
-                        expr.append('COALESCE(SUM(muertos_bebes),0)')
-                    if 'muertos_reproductores' in parto_cols:
-                        expr.append('COALESCE(SUM(muertos_reproductores),0)')
-                    if expr:
-                        cur.execute("SELECT " + " + ".join(expr) + " FROM partos;")
-                        muertos_partos = cur.fetchone()[0] or 0
-            muertos_dest = 0
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'muertes_destetados');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'muertes_destetados';")
-                md_cols = [r[0] for r in cur.fetchall()]
-                if 'muertos_hembras' in md_cols and 'muertos_machos' in md_cols:
-                    cur.execute("SELECT COALESCE(SUM(muertos_hembras + muertos_machos),0) FROM muertes_destetados;")
-                    muertos_dest = cur.fetchone()[0] or 0
-            total_muertos = (muertos_partos or 0) + (muertos_dest or 0)
-        except Exception as e:
-            print("Error total_muertos:", e)
-            conn.rollback()
-            total_muertos = 0
+            valores[-2] = datetime.fromisoformat(valores[-2])
+        except (TypeError, ValueError):
+            raise ValueError("Cursor de paginación no válido")
+    return valores
 
-        # -----------------------
-        # Datos por galpón / poza
-        # -----------------------
-        reproductores_data, nacidos_data, destetados_data, muertos_data = {}, {}, {}, {}
+def parsear_fecha_filtro(texto, nombre):
+    try:
+        return datetime.strptime(texto, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"{nombre} debe tener el formato AAAA-MM-DD")
+
+def serializar_fila(fila):
+    return {
+        clave: valor.isoformat(sep=' ', timespec='seconds') if isinstance(valor, datetime) else valor
+        for clave, valor in fila.items()
+    }
+
+def construir_consulta_listado(tabla, galpon=None, poza=None, desde=None, hasta=None, despues=None, limite=LISTADO_LIMITE):
+    """Devolver (sql, parámetros) de una página del listado"""
+    config = LISTADOS_ANALISIS[tabla]
+    fecha = config['fecha']
+    columnas = columnas_orden_listado(tabla)
+    descendente = config.get('descendente', False)
+
+    condiciones, parametros = [], []
+    if config['por_poza'] and galpon:
+        condiciones.append('galpon = %s')
+        parametros.append(galpon)
+    if config['por_poza'] and poza:
+        condiciones.append('poza = %s')
+        parametros.append(poza)
+    if desde:
+        condiciones.append(f'{fecha} >= %s')
+        parametros.append(desde)
+    if hasta:
+        condiciones.append(f'{fecha} < %s')
+        parametros.append(hasta + timedelta(days=1))
+    if despues:
+        clave = ', '.join(columnas)
+        marcadores = ', '.join(['%s'] * len(columnas))
+        condiciones.append(f"({clave}) {'<' if descendente else '>'} ({marcadores})")
+        parametros.extend(despues)
+
+    direccion = ' DESC' if descendente else ''
+    sql = f'''
+        SELECT * FROM {tabla}
+        {'WHERE ' + ' AND '.join(condiciones) if condiciones else ''}
+        ORDER BY {', '.join(columna + direccion for columna in columnas)}
+        LIMIT %s
+    '''
+    # Una fila extra indica si hay página siguiente
+    parametros.append(limite + 1)
+    return sql, parametros
+
+def listar_pagina(tabla, galpon=None, poza=None, desde=None, hasta=None, despues=None, limite=LISTADO_LIMITE):
+    """Una página del listado: (filas, cursor de la página siguiente o None)"""
+    sql, parametros = construir_consulta_listado(
+        tabla, galpon=galpon, poza=poza, desde=desde, hasta=hasta, despues=despues, limite=limite)
 
-        # Reproductores
+    with get_db_connection() as conn:
+        # Cursor con nombre: las filas quedan en el servidor y se traen por tandas
+        with conn.cursor(name=f'listado_{tabla}', cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.itersize = min(limite + 1, 200)
+            cursor.execute(sql, parametros)
+            filas = []
+            while len(filas) <= limite:
+                tanda = cursor.fetchmany(cursor.itersize)
+                if not tanda:
+                    break
+                filas.extend(tanda)
+
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor_listado([filas[-1][columna] for columna in columnas_orden_listado(tabla)])
+    return [serializar_fila(fila) for fila in filas], siguiente
+
+def obtener_resumen_analisis():
+    """Totales de las tarjetas de /analisis_datos desde inventario_poza y metricas_mensuales"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute('''
+                SELECT COALESCE(SUM(reproductores_total), 0) AS total_reproductores,
+                       COALESCE(SUM(destetados), 0) AS total_destetados
+                FROM inventario_poza
+            ''')
+            resumen = dict(cursor.fetchone())
+            cursor.execute('''
+                SELECT COALESCE(SUM(valor) FILTER (WHERE metrica = 'partos'), 0)::bigint AS total_partos,
+                       COALESCE(SUM(valor) FILTER (WHERE metrica = 'gastos'), 0)::float8 AS total_gastos
+                FROM metricas_mensuales
+                WHERE metrica IN ('partos', 'gastos')
+            ''')
+            resumen.update(cursor.fetchone())
+    return resumen
+
+# === BALANCE POR PERÍODOS ===
+# /api/balance devuelve ingresos, gastos y margen por día, semana o mes en una
+# sola consulta: cada tabla se agrupa solo dentro del rango pedido (índices
+# por fecha de la migración 0015) y generate_series completa los períodos sin
+# movimientos con ceros.
+GRANULARIDADES_BALANCE = {'dia': ('day', 1), 'semana': ('week', 7), 'mes': ('month', 28)}
+BALANCE_MAX_PERIODOS = 3660
+
+CONSULTA_BALANCE_PERIODOS = '''
+    WITH periodos AS (
+        SELECT generate_series(date_trunc(%(unidad)s, %(desde)s::timestamp),
+                               date_trunc(%(unidad)s, %(hasta)s::timestamp),
+                               make_interval(days => %(dias)s, months => %(meses)s)) AS periodo
+    ), ingresos AS (
+        SELECT date_trunc(%(unidad)s, fecha_venta) AS periodo,
+               SUM(costo_total) FILTER (WHERE tipo_venta = 'destetados') AS ventas_destetados,
+               SUM(costo_total) FILTER (WHERE tipo_venta = 'descarte') AS ventas_descarte
+        FROM ventas
+        WHERE fecha_venta >= %(desde)s AND fecha_venta < %(fin)s
+        GROUP BY 1
+    ), egresos AS (
+        SELECT date_trunc(%(unidad)s, fecha_gasto) AS periodo, SUM(monto) AS gastos
+        FROM gastos
+        WHERE fecha_gasto >= %(desde)s AND fecha_gasto < %(fin)s
+        GROUP BY 1
+    )
+    SELECT TO_CHAR(p.periodo, 'YYYY-MM-DD') AS periodo,
+           COALESCE(i.ventas_destetados, 0)::float8 AS ventas_destetados,
+           COALESCE(i.ventas_descarte, 0)::float8 AS ventas_descarte,
+           (COALESCE(i.ventas_destetados, 0) + COALESCE(i.ventas_descarte, 0))::float8 AS ingresos,
+           COALESCE(e.gastos, 0)::float8 AS gastos,
+           (COALESCE(i.ventas_destetados, 0) + COALESCE(i.ventas_descarte, 0) - COALESCE(e.gastos, 0))::float8 AS margen
+    FROM periodos p
+    LEFT JOIN ingresos i ON i.periodo = p.periodo
+    LEFT JOIN egresos e ON e.periodo = p.periodo
+    ORDER BY p.periodo
+'''
+COLUMNAS_BALANCE = ('ventas_destetados', 'ventas_descarte', 'ingresos', 'gastos', 'margen')
+
+def rango_balance_predeterminado(hoy=None):
+    """Últimos 12 meses completos hasta hoy: (desde, hasta)"""
+    hoy = hoy or datetime.now()
+    hasta = datetime(hoy.year, hoy.month, hoy.day)
+    if hasta.month == 12:
+        return datetime(hasta.year, 1, 1), hasta
+    return datetime(hasta.year - 1, hasta.month + 1, 1), hasta
+
+def validar_rango_balance(desde, hasta, granularidad):
+    """ValueError si la granularidad o el rango no son válidos (antes de tocar la base)"""
+    if granularidad not in GRANULARIDADES_BALANCE:
+        raise ValueError(f"granularidad debe ser una de: {', '.join(GRANULARIDADES_BALANCE)}")
+    if desde > hasta:
+        raise ValueError("desde no puede ser posterior a hasta")
+    _, dias_periodo = GRANULARIDADES_BALANCE[granularidad]
+    if (hasta - desde).days // dias_periodo + 1 > BALANCE_MAX_PERIODOS:
+        raise ValueError(f"El rango supera {BALANCE_MAX_PERIODOS} períodos: use una granularidad mayor")
+
+def calcular_balance_periodos(cursor, desde, hasta, granularidad='mes'):
+    """Ingresos, gastos y margen por período entre desde y hasta (ambos incluidos)"""
+    validar_rango_balance(desde, hasta, granularidad)
+    unidad, dias_periodo = GRANULARIDADES_BALANCE[granularidad]
+
+    cursor.execute(CONSULTA_BALANCE_PERIODOS, {
+        'unidad': unidad,
+        'dias': 0 if unidad == 'month' else dias_periodo,
+        'meses': 1 if unidad == 'month' else 0,
+        'desde': desde,
+        'hasta': hasta,
+        'fin': hasta + timedelta(days=1),
+    })
+    return [
+        {'periodo': fila['periodo'], **{columna: round(fila[columna], 2) for columna in COLUMNAS_BALANCE}}
+        for fila in cursor.fetchall()
+    ]
+
+# === EXPORTACIÓN ===
+# Las exportaciones leen cada tabla con un cursor con nombre (del lado del
+# servidor) por lotes de EXPORTACION_LOTE filas y las escriben a medida que
+# llegan, sin DataFrames ni copias completas en memoria:
+#   - CSV/ZIP: el archivo se arma y se envía mientras se leen las filas.
+#   - Excel: xlsxwriter en modo constant_memory escribe a un archivo temporal,
+#     que luego se envía por partes y se elimina.
+EXPORTACION_LOTE = int(os.environ.get('EXPORTACION_LOTE', 2000))
+EXPORTACION_BLOQUE = 64 * 1024
+EXCEL_MAX_FILAS = 1048576
+
+TABLAS_EXPORTACION = (
+    ('reproductores', 'Reproductores'),
+    ('partos', 'Partos'),
+    ('destetes', 'Destetes'),
+    ('muertes_destetados', 'Muertes'),
+    ('ventas', 'Ventas'),
+    ('gastos', 'Gastos'),
+)
+
+def leer_tabla_por_lotes(tabla, lote=EXPORTACION_LOTE):
+    """Generar (columnas, filas) de la tabla completa, un lote por iteración"""
+    with get_db_connection() as conn:
+        with conn.cursor(name=f'exportar_{tabla}') as cursor:
+            cursor.itersize = lote
+            cursor.execute(f'SELECT * FROM {tabla} ORDER BY id')
+            filas = cursor.fetchmany(lote)
+            columnas = [columna.name for columna in cursor.description]
+            yield columnas, filas
+            while filas:
+                filas = cursor.fetchmany(lote)
+                if filas:
+                    yield columnas, filas
+
+class _BufferSalida(io.RawIOBase):
+    """Destino de escritura que se vacía en cada yield del generador"""
+
+    def __init__(self):
+        self.partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b''.join(self.partes)
+        self.partes = []
+        return datos
+
+def _valor_csv(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.isoformat(sep=' ')
+    return valor
+
+def generar_csv_tabla(tabla, destino, lote=EXPORTACION_LOTE):
+    """Escribir la tabla como CSV UTF-8 en destino; genera después de cada lote"""
+    texto = io.TextIOWrapper(destino, encoding='utf-8', newline='', write_through=True)
+    escritor = csv.writer(texto)
+    encabezado = False
+    for columnas, filas in leer_tabla_por_lotes(tabla, lote):
+        if not encabezado:
+            escritor.writerow(columnas)
+            encabezado = True
+        escritor.writerows([_valor_csv(valor) for valor in fila] for fila in filas)
+        yield
+    texto.detach()
+
+def exportar_csv_stream(tabla):
+    """Contenido de un CSV de una tabla, en partes"""
+    buffer = _BufferSalida()
+    for _ in generar_csv_tabla(tabla, buffer):
+        yield buffer.vaciar()
+    yield buffer.vaciar()
+
+def exportar_zip_stream(tablas=TABLAS_EXPORTACION):
+    """ZIP con un CSV por tabla, enviado mientras se genera"""
+    buffer = _BufferSalida()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archivo_zip:
+        for tabla, _ in tablas:
+            with archivo_zip.open(f'{tabla}.csv', 'w', force_zip64=True) as destino:
+                for _ in generar_csv_tabla(tabla, destino):
+                    datos = buffer.vaciar()
+                    if datos:
+                        yield datos
+    yield buffer.vaciar()
+
+def escribir_excel(ruta, tablas=TABLAS_EXPORTACION):
+    """Crear el libro en disco con memoria constante (una fila a la vez)"""
+    libro = xlsxwriter.Workbook(ruta, {
+        'constant_memory': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        'remove_timezone': True,
+    })
+    try:
+        for tabla, nombre_hoja in tablas:
+            hoja, fila_actual, numero_hoja = None, 0, 1
+            for columnas, filas in leer_tabla_por_lotes(tabla):
+                for fila in filas:
+                    # Una hoja admite EXCEL_MAX_FILAS: el resto sigue en otra hoja
+                    if hoja is None or fila_actual >= EXCEL_MAX_FILAS:
+                        hoja = libro.add_worksheet(nombre_hoja if numero_hoja == 1 else f'{nombre_hoja} ({numero_hoja})')
+                        hoja.write_row(0, 0, columnas)
+                        fila_actual, numero_hoja = 1, numero_hoja + 1
+                    hoja.write_row(fila_actual, 0, fila)
+                    fila_actual += 1
+                if hoja is None:
+                    hoja = libro.add_worksheet(nombre_hoja)
+                    hoja.write_row(0, 0, columnas)
+                    numero_hoja += 1
+    finally:
+        libro.close()
+
+def enviar_archivo_temporal(ruta):
+    """Enviar el archivo por bloques y eliminarlo al terminar"""
+    try:
+        with open(ruta, 'rb') as archivo:
+            while True:
+                bloque = archivo.read(EXPORTACION_BLOQUE)
+                if not bloque:
+                    break
+                yield bloque
+    finally:
+        os.remove(ruta)
+
+# === EXPORTACIÓN MASIVA CON COPY ===
+# Para respaldos y BI: PostgreSQL genera el CSV con COPY (SELECT ...) TO STDOUT
+# y los bytes pasan directo a la respuesta (o a un archivo en el CLI), sin
+# convertir filas en Python. Opcionalmente se comprimen con gzip al vuelo.
+# Parquet requiere pyarrow (dependencia opcional): el CSV de COPY se lee por
+# bloques con los tipos de las columnas de la tabla y se escribe por grupos.
+COPIA_COLA_BLOQUES = 16   # bloques en tránsito entre el hilo de COPY y la respuesta
+
+def consulta_copia(cursor, tabla, desde=None, hasta=None):
+    """Sentencia COPY de la tabla, filtrada por su columna de fecha"""
+    fecha = LISTADOS_ANALISIS[tabla]['fecha']
+    condiciones, parametros = [], []
+    if desde:
+        condiciones.append(f'{fecha} >= %s')
+        parametros.append(desde)
+    if hasta:
+        condiciones.append(f'{fecha} < %s')
+        parametros.append(hasta + timedelta(days=1))
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    select = cursor.mogrify(f'SELECT * FROM {tabla} {where} ORDER BY id', parametros).decode('utf-8')
+    return f'COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)'
+
+def copiar_tabla(tabla, destino, desde=None, hasta=None):
+    """Escribir el CSV de la tabla en un archivo abierto en modo binario"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(consulta_copia(cursor, tabla, desde, hasta), destino, size=EXPORTACION_BLOQUE)
+
+class _CopiaCancelada(Exception):
+    pass
+
+class _DestinoCola:
+    """Archivo de escritura que entrega los bloques de COPY a una cola acotada"""
+
+    def __init__(self, cola, cancelada):
+        self.cola = cola
+        self.cancelada = cancelada
+
+    def write(self, datos):
+        while True:
+            if self.cancelada.is_set():
+                raise _CopiaCancelada()
+            try:
+                self.cola.put(bytes(datos), timeout=1)
+                return len(datos)
+            except queue.Full:
+                continue
+
+def copiar_tabla_stream(tabla, desde=None, hasta=None, comprimir=False):
+    """Generar el CSV de la tabla mientras PostgreSQL lo produce
+
+    copy_expert bloquea hasta terminar, así que corre en un hilo y pasa los
+    bloques por una cola acotada: si el cliente lee lento, COPY espera.
+    """
+    cola = queue.Queue(maxsize=COPIA_COLA_BLOQUES)
+    cancelada = threading.Event()
+    fin = object()
+    errores = []
+
+    def copiar():
         try:
-            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'reproductores';")
-            repro_cols = [r[0] for r in cur.fetchall()]
-            posibles_fecha = ['fecha_ingreso', 'fecha_registro', 'created_at', 'tiempo_reproductores', 'fecha', 'fecha_creacion']
-            fecha_col = next((c for c in posibles_fecha if c in repro_cols), None)
-
-            if fecha_col:
-                cur.execute(f"""
-                    SELECT r.galpon, r.poza, (r.hembras + r.machos) as cantidad
-                    FROM reproductores r
-                    JOIN (
-                        SELECT galpon, poza, MAX({fecha_col}) as ultima_fecha
-                        FROM reproductores
-                        GROUP BY galpon, poza
-                    ) ult
-                    ON r.galpon = ult.galpon
-                    AND r.poza = ult.poza
-                    AND r.{fecha_col} = ult.ultima_fecha
-                    ORDER BY r.galpon, r.poza;
-                """)
-            else:
-                cur.execute("""
-                    SELECT r.galpon, r.poza, (r.hembras + r.machos) as cantidad
-                    FROM reproductores r
-                    JOIN (
-                        SELECT galpon, poza, MAX(id) as maxid
-                        FROM reproductores
-                        GROUP BY galpon, poza
-                    ) ult
-                    ON r.galpon = ult.galpon
-                    AND r.poza = ult.poza
-                    AND r.id = ult.maxid
-                    ORDER BY r.galpon, r.poza;
-                """)
-            for row in cur.fetchall():
-                galpon, poza, cantidad = str(row[0]), str(row[1]), int(row[2] or 0)
-                reproductores_data.setdefault(galpon, {})[poza] = cantidad
+            copiar_tabla(tabla, _DestinoCola(cola, cancelada), desde, hasta)
+        except _CopiaCancelada:
+            pass
         except Exception as e:
-            print("Error reproductores_data:", e)
-            conn.rollback()
+            errores.append(e)
+        finally:
+            while not cancelada.is_set():
+                try:
+                    cola.put(fin, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    hilo = threading.Thread(target=copiar, name=f'copia-{tabla}', daemon=True)
+    hilo.start()
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None  # wbits=31: formato gzip
+    try:
+        while True:
+            bloque = cola.get()
+            if bloque is fin:
+                break
+            if compresor:
+                bloque = compresor.compress(bloque)
+            if bloque:
+                yield bloque
+        if errores:
+            app.logger.error(f"Error exportando {tabla} con COPY", exc_info=errores[0])
+            raise errores[0]
+        if compresor:
+            yield compresor.flush()
+    finally:
+        # El cliente cortó la descarga: detener COPY
+        cancelada.set()
+
+def tipos_arrow_tabla(tabla):
+    """Tipos pyarrow de las columnas según el tipo de PostgreSQL"""
+    tipos_pg = {
+        'smallint': pa.int16(), 'integer': pa.int32(), 'bigint': pa.int64(),
+        'real': pa.float32(), 'double precision': pa.float64(), 'numeric': pa.float64(),
+        'boolean': pa.bool_(), 'date': pa.date32(),
+        'timestamp without time zone': pa.timestamp('us'),
+        'timestamp with time zone': pa.timestamp('us', tz='UTC'),
+    }
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT column_name, data_type FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = %s
+                ORDER BY ordinal_position
+            ''', (tabla,))
+            columnas = cursor.fetchall()
+    return {columna: tipos_pg.get(tipo, pa.string()) for columna, tipo in columnas}
+
+def escribir_parquet(tabla, ruta, desde=None, hasta=None):
+    """Crear un Parquet de la tabla a partir del CSV de COPY (pasa por un temporal)"""
+    if pa is None:
+        raise RuntimeError("La exportación a Parquet requiere pyarrow (pip install pyarrow)")
+
+    with tempfile.TemporaryFile() as temporal:
+        copiar_tabla(tabla, temporal, desde, hasta)
+        temporal.seek(0)
+        lector = pa_csv.open_csv(temporal, convert_options=pa_csv.ConvertOptions(
+            column_types=tipos_arrow_tabla(tabla),
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+        ))
+        with pa_parquet.ParquetWriter(ruta, lector.schema, compression='snappy') as escritor:
+            for lote in lector:
+                escritor.write_batch(lote)
+
+# === IMPORTACIÓN MASIVA ===
+# Carga de registros históricos desde CSV o XLSX (la primera fila son los
+# nombres de columna). Cada fila se valida con las mismas reglas que los
+# formularios; las válidas se envían con COPY FROM STDIN a una tabla temporal y
+# desde ahí se insertan en la tabla destino y en inventario_poza dentro de una
+# sola transacción. El informe indica el número de fila de cada error.
+IMPORTACION_LOTE_COPY = 1000     # filas por bloque enviado a COPY
+IMPORTACION_MAX_ERRORES = 1000   # errores detallados en el informe
+
+# columnas: nombre -> texto | entero | decimal | fecha (en el orden de la tabla temporal)
+# La fecha vacía toma la fecha de importación, como los formularios.
+IMPORTACIONES = {
+    'partos': {
+        'columnas': {'galpon': 'texto', 'poza': 'texto', 'numero_parto': 'entero', 'nacidos': 'entero',
+                     'muertos_bebes': 'entero', 'muertos_reproductores': 'entero', 'fecha_nacimiento': 'fecha'},
+        # Igual que el formulario: un parto repetido suma sus valores al existente
+        'clave_unica': ('galpon', 'poza', 'numero_parto'),
+        'inventario': {'nacidos': 'nacidos', 'muertos': 'muertos_bebes + muertos_reproductores'},
+    },
+    'destetes': {
+        'columnas': {'galpon': 'texto', 'poza': 'texto', 'destetados_hembras': 'entero',
+                     'destetados_machos': 'entero', 'fecha_destete': 'fecha'},
+        'inventario': {'destetados': 'destetados_hembras + destetados_machos'},
+    },
+    'muertes_destetados': {
+        'columnas': {'galpon': 'texto', 'poza': 'texto', 'muertos_hembras': 'entero',
+                     'muertos_machos': 'entero', 'fecha_muerte': 'fecha'},
+        'inventario': {'muertos': 'muertos_hembras + muertos_machos'},
+    },
+    'ventas': {
+        'columnas': {'tipo_venta': 'texto', 'galpon': 'texto', 'poza': 'texto', 'hembras_vendidas': 'entero',
+                     'machos_vendidos': 'entero', 'costo_total': 'decimal', 'observaciones': 'texto',
+                     'fecha_venta': 'fecha'},
+        'opcionales': ('galpon', 'poza', 'observaciones'),
+        'largos': {'tipo_venta': 20, 'galpon': 50, 'poza': 50},
+        'inventario': {'vendidos': VENDIDOS_INVENTARIO},
+    },
+    'gastos': {
+        'columnas': {'descripcion': 'texto', 'monto': 'decimal', 'tipo': 'texto', 'fecha_gasto': 'fecha'},
+    },
+}
+
+def leer_filas_archivo(archivo, nombre):
+    """Iterar (numero_fila, {columna: valor}) de un CSV o XLSX abierto en modo binario"""
+    if nombre.lower().endswith('.xlsx'):
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        filas = libro.active.iter_rows(values_only=True)
+    else:
+        texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+        primera = texto.readline()
+        # Excel en español guarda los CSV separados por punto y coma
+        separador = ';' if primera.count(';') > primera.count(',') else ','
+        filas = csv.reader(itertools.chain([primera], texto), delimiter=separador)
+
+    encabezado = [str(columna or '').strip().lower() for columna in next(filas, ())]
+    for numero, fila in enumerate(filas, start=2):
+        if all(valor is None or str(valor).strip() == '' for valor in fila):
+            continue
+        yield numero, dict(zip(encabezado, fila))
+
+@functools.lru_cache(maxsize=4096)
+def _parsear_fecha_importacion(texto):
+    # Los archivos históricos repiten mucho las mismas fechas y strptime es lento
+    return parsear_fecha_legada(texto)
+
+def validar_fila_importacion(tipo, fila, fecha_importacion):
+    """Convertir una fila al orden de IMPORTACIONES[tipo]; ValueError con el motivo si no es válida"""
+    definicion = IMPORTACIONES[tipo]
+    opcionales = definicion.get('opcionales', ())
+    registro = {}
+    for columna, clase in definicion['columnas'].items():
+        valor = fila.get(columna)
+        if isinstance(valor, str):
+            valor = valor.strip()
+        if valor is None or valor == '':
+            if clase == 'fecha':
+                registro[columna] = fecha_importacion
+            elif columna in opcionales:
+                registro[columna] = None
+            else:
+                raise ValueError(f"{columna} es obligatorio")
+            continue
+
+        if clase == 'texto':
+            valor = str(valor)
+            largo = definicion.get('largos', {}).get(columna)
+            if largo and len(valor) > largo:
+                raise ValueError(f"{columna} admite hasta {largo} caracteres")
+        elif clase == 'fecha':
+            fecha = _parsear_fecha_importacion(valor) if isinstance(valor, str) else parsear_fecha_legada(valor)
+            if fecha is None:
+                raise ValueError(f"{columna} no es una fecha válida: {valor}")
+            valor = fecha
+        else:
+            try:
+                numero = float(str(valor).replace(',', '.')) if isinstance(valor, str) else float(valor)
+            except (TypeError, ValueError):
+                raise ValueError(f"{columna} debe ser numérico: {valor}")
+            # float() acepta 'nan', 'inf' y 1e400, que PostgreSQL guardaría tal cual
+            if not math.isfinite(numero):
+                raise ValueError(f"{columna} debe ser un número finito: {valor}")
+            if clase == 'entero':
+                if not numero.is_integer():
+                    raise ValueError(f"{columna} debe ser un número entero: {valor}")
+                numero = int(numero)
+            valor = numero
+        registro[columna] = valor
+
+    validate_positive_values(**{c: v for c, v in registro.items()
+                                if definicion['columnas'][c] in ('entero', 'decimal')})
+
+    # Reglas propias de cada formulario
+    if tipo == 'destetes' and registro['destetados_hembras'] + registro['destetados_machos'] == 0:
+        raise ValueError("Debe ingresar al menos un animal destetado")
+    if tipo == 'ventas':
+        if registro['tipo_venta'] not in ('destetados', 'descarte'):
+            raise ValueError(f"tipo_venta desconocido: {registro['tipo_venta']}")
+        if registro['costo_total'] <= 0:
+            raise ValueError("costo_total debe ser mayor que cero")
+        if registro['hembras_vendidas'] + registro['machos_vendidos'] == 0:
+            raise ValueError("Debe registrar al menos un cuy vendido")
+        if registro['tipo_venta'] == 'descarte' and not (registro['galpon'] and registro['poza']):
+            raise ValueError("Las ventas de descarte requieren galpón y poza de origen")
+
+    return tuple(registro.values())
+
+def _bloques_copia_importacion(registros):
+    """Agrupar los registros validados en bloques CSV para COPY"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    pendientes = 0
+    for registro in registros:
+        escritor.writerow(registro)
+        pendientes += 1
+        if pendientes >= IMPORTACION_LOTE_COPY:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pendientes = 0
+    if pendientes:
+        yield buffer.getvalue().encode('utf-8')
+
+class _LectorCopia:
+    """Archivo de lectura para copy_expert que consume un generador de bloques"""
+
+    def __init__(self, bloques):
+        self.bloques = bloques
+        self.pendiente = bytearray()
+
+    def read(self, tamano=-1):
+        while tamano < 0 or len(self.pendiente) < tamano:
+            bloque = next(self.bloques, None)
+            if bloque is None:
+                break
+            self.pendiente += bloque
+        if tamano < 0:
+            tamano = len(self.pendiente)
+        datos = bytes(self.pendiente[:tamano])
+        del self.pendiente[:tamano]
+        return datos
+
+    readline = read
+
+def construir_merge_importacion(tipo):
+    """Sentencias que pasan la tabla temporal a la tabla destino y al inventario"""
+    definicion = IMPORTACIONES[tipo]
+    columnas = list(definicion['columnas'])
+    sentencias = []
+
+    clave = definicion.get('clave_unica')
+    if clave:
+        sumas = [c for c in columnas if definicion['columnas'][c] in ('entero', 'decimal') and c not in clave]
+        seleccion = [c if c in clave else f'SUM({c})' if c in sumas else f'MIN({c})' for c in columnas]
+        sentencias.append(f'''
+            INSERT INTO {tipo} ({', '.join(columnas)})
+            SELECT {', '.join(seleccion)}
+            FROM importacion
+            GROUP BY {', '.join(clave)}
+            ON CONFLICT ({', '.join(clave)}) DO UPDATE
+            SET {', '.join(f'{c} = {tipo}.{c} + EXCLUDED.{c}' for c in sumas)}
+        ''')
+    else:
+        sentencias.append(f'''
+            INSERT INTO {tipo} ({', '.join(columnas)})
+            SELECT {', '.join(columnas)} FROM importacion
+        ''')
+
+    contadores = definicion.get('inventario')
+    if contadores:
+        sentencias.append(f'''
+            INSERT INTO inventario_poza (galpon, poza, {', '.join(contadores)}, actualizado)
+            SELECT galpon, poza, {', '.join(f'SUM({expresion})' for expresion in contadores.values())}, NOW()
+            FROM importacion
+            WHERE galpon IS NOT NULL AND galpon <> '' AND poza IS NOT NULL AND poza <> ''
+            GROUP BY galpon, poza
+            ON CONFLICT (galpon, poza) DO UPDATE
+            SET {', '.join(f'{c} = inventario_poza.{c} + EXCLUDED.{c}' for c in contadores)}, actualizado = NOW()
+        ''')
+    return sentencias
+
+def fusionar_importacion(cursor, tipo):
+    """Pasar la tabla temporal importacion a la tabla destino, el inventario y las métricas"""
+    for sentencia in construir_merge_importacion(tipo):
+        cursor.execute(sentencia)
+    if tipo in METRICAS_MENSUALES:
+        fecha = LISTADOS_ANALISIS[tipo]['fecha']
+        cursor.execute(f"SELECT DISTINCT date_trunc('month', {fecha}) FROM importacion")
+        refrescar_metricas_mensuales(cursor, tipo, [fila[0] for fila in cursor.fetchall()])
+
+def importar_archivo(tipo, archivo, nombre, omitir_errores=False):
+    """Validar e importar un archivo; devuelve el informe de la importación
+
+    Si hay filas con errores no se importa nada, salvo con omitir_errores.
+    """
+    if tipo not in IMPORTACIONES:
+        raise ValueError(f"Tipo de importación desconocido: {tipo}")
+    definicion = IMPORTACIONES[tipo]
+    columnas = list(definicion['columnas'])
+    inicio = time.monotonic()
+    # Las columnas de fecha guardan la hora UTC sin zona
+    fecha_importacion = datetime.now(timezone.utc).replace(tzinfo=None)
+    informe = {'tipo': tipo, 'archivo': nombre, 'leidas': 0, 'importadas': 0, 'total_errores': 0, 'errores': []}
+
+    filas = leer_filas_archivo(archivo, nombre)
+    primera = next(filas, None)
+    if primera is None:
+        raise ValueError("El archivo no tiene filas de datos")
+    obligatorias = [c for c in columnas
+                    if definicion['columnas'][c] != 'fecha' and c not in definicion.get('opcionales', ())]
+    faltantes = [c for c in obligatorias if c not in primera[1]]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en el archivo: {', '.join(faltantes)}")
+
+    def registros_validos():
+        for numero, fila in itertools.chain([primera], filas):
+            informe['leidas'] += 1
+            try:
+                yield validar_fila_importacion(tipo, fila, fecha_importacion)
+            except ValueError as e:
+                informe['total_errores'] += 1
+                if len(informe['errores']) < IMPORTACION_MAX_ERRORES:
+                    informe['errores'].append({'fila': numero, 'error': str(e)})
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f'''
+                CREATE TEMP TABLE importacion ON COMMIT DROP AS
+                SELECT {', '.join(columnas)} FROM {tipo} WITH NO DATA
+            ''')
+            cursor.copy_expert(
+                f"COPY importacion ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)",
+                _LectorCopia(_bloques_copia_importacion(registros_validos()))
+            )
+            informe['importadas'] = cursor.rowcount
+
+            if informe['total_errores'] and not omitir_errores:
+                conn.rollback()
+                informe['importadas'] = 0
+            else:
+                fusionar_importacion(cursor, tipo)
+
+    informe['segundos'] = round(time.monotonic() - inicio, 2)
+    app.logger.info(f"Importación {tipo} ({nombre}): {informe['importadas']} de {informe['leidas']} filas, "
+                    f"{informe['total_errores']} errores, {informe['segundos']}s")
+    return informe
+
+@app.cli.command('importar')
+@click.argument('tipo', type=click.Choice(list(IMPORTACIONES)))
+@click.argument('ruta', type=click.Path(exists=True, dir_okay=False))
+@click.option('--omitir-errores', is_flag=True, help='Importar las filas válidas aunque otras tengan errores')
+def importar_comando(tipo, ruta, omitir_errores):
+    """Importar registros históricos desde un CSV o XLSX"""
+    with open(ruta, 'rb') as archivo:
+        informe = importar_archivo(tipo, archivo, os.path.basename(ruta), omitir_errores=omitir_errores)
+
+    for error in informe['errores'][:50]:
+        print(f"   fila {error['fila']}: {error['error']}")
+    if informe['total_errores'] and not omitir_errores:
+        print(f"⚠️  No se importó nada: {informe['total_errores']} filas con errores")
+        raise SystemExit(1)
+    print(f"✅ {informe['importadas']} filas importadas en {tipo}")
+    if refrescar_vistas_materializadas() is not None:
+        print("✅ Vistas materializadas refrescadas")
+
+# === API DE EVENTOS POR LOTES ===
+# Los celulares y tablets de los galpones guardan los eventos sin conexión y los
+# envían juntos a /api/v1/eventos/batch. Cada evento trae una clave generada por
+# el cliente; eventos_recibidos (migración 0010) la registra en la misma
+# transacción, así un lote reenviado no duplica registros. Los eventos válidos
+# se insertan con execute_values en la tabla temporal de la importación masiva y
+# se pasan a las tablas con las mismas sentencias.
+EVENTOS_LOTE_MAX = int(os.environ.get('EVENTOS_LOTE_MAX', 1000))
+
+def registrar_lote_eventos(eventos):
+    """Validar e insertar un lote de eventos; devuelve un resultado por evento, en orden"""
+    resultados = []
+    vistas = set()
+    validos = {}   # tipo -> [(clave, registro, resultado)]
+    # Las columnas de fecha guardan la hora UTC sin zona
+    fecha_recepcion = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    for indice, evento in enumerate(eventos):
+        resultado = {'indice': indice, 'clave': None, 'estado': 'error'}
+        resultados.append(resultado)
+        if not isinstance(evento, dict):
+            resultado['error'] = 'El evento debe ser un objeto'
+            continue
+
+        clave = evento.get('clave')
+        tipo = evento.get('tipo')
+        resultado['clave'] = clave
+        if not isinstance(clave, str) or not clave.strip() or len(clave) > 200:
+            resultado['error'] = 'clave es obligatoria (texto de hasta 200 caracteres)'
+            continue
+        if not isinstance(tipo, str) or tipo not in IMPORTACIONES:
+            resultado['error'] = f"tipo desconocido: {tipo}"
+            continue
+        datos = evento.get('datos') or {}
+        if not isinstance(datos, dict):
+            resultado['error'] = 'datos debe ser un objeto'
+            continue
+        if clave in vistas:
+            resultado['estado'] = 'duplicado'
+            continue
+        vistas.add(clave)
 
-        # Nacidos
         try:
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'partos');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'partos';")
-                parto_cols = [r[0] for r in cur.fetchall()]
-                if 'nacidos' in parto_cols:
-                    cur.execute("SELECT galpon, poza, COALESCE(SUM(nacidos),0) FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
-                elif 'nacidos_hembras' in parto_cols and 'nacidos_machos' in parto_cols:
-                    cur.execute("SELECT galpon, poza, COALESCE(SUM(nacidos_hembras + nacidos_machos),0) FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
-                elif 'crias_nacidas_hembras' in parto_cols and 'crias_nacidas_machos' in parto_cols:
-                    cur.execute("SELECT galpon, poza, COALESCE(SUM(crias_nacidas_hembras + crias_nacidas_machos),0) FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
-                else:
-                    columna_nacidos = None
-                    for c in parto_cols:
-                        if any(k in c.lower() for k in ('nac', 'cria', 'bebe', 'parto')) and not c.lower().startswith('fecha'):
-                            columna_nacidos = c
-                            break
-                    if columna_nacidos:
-                        cur.execute(f"SELECT galpon, poza, COALESCE(SUM({columna_nacidos}),0) FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
+            registro = validar_fila_importacion(tipo, datos, fecha_recepcion)
+        except ValueError as e:
+            resultado['error'] = str(e)
+            continue
+        validos.setdefault(tipo, []).append((clave, registro, resultado))
+
+    if not validos:
+        return resultados
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # Reservar las claves: un reintento concurrente espera aquí y luego las ve como duplicadas
+            nuevas = psycopg2.extras.execute_values(cursor, '''
+                INSERT INTO eventos_recibidos (clave, tipo) VALUES %s
+                ON CONFLICT (clave) DO NOTHING
+                RETURNING clave
+            ''', [(clave, tipo) for tipo, items in validos.items() for clave, _, _ in items], fetch=True)
+            nuevas = {fila[0] for fila in nuevas}
+
+            for tipo, items in validos.items():
+                registros = []
+                for clave, registro, resultado in items:
+                    if clave in nuevas:
+                        registros.append(registro)
+                        resultado['estado'] = 'creado'
                     else:
-                        cur.execute("SELECT galpon, poza, COUNT(*) FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
-                for r in cur.fetchall():
-                    galpon, poza, cantidad = str(r[0]), str(r[1]), int(r[2] or 0)
-                    nacidos_data.setdefault(galpon, {})[poza] = cantidad
-        except Exception as e:
-            print("Error nacidos_data:", e)
-            conn.rollback()
+                        resultado['estado'] = 'duplicado'
+                if not registros:
+                    continue
+
+                columnas = list(IMPORTACIONES[tipo]['columnas'])
+                cursor.execute(f'''
+                    CREATE TEMP TABLE importacion ON COMMIT DROP AS
+                    SELECT {', '.join(columnas)} FROM {tipo} WITH NO DATA
+                ''')
+                psycopg2.extras.execute_values(
+                    cursor, f"INSERT INTO importacion ({', '.join(columnas)}) VALUES %s",
+                    registros, page_size=len(registros)
+                )
+                fusionar_importacion(cursor, tipo)
+                cursor.execute('DROP TABLE importacion')
+
+    return resultados
+
+# === REGISTRO DE MODELOS ===
+# Los modelos de predicción se guardan con joblib en MODELOS_DIR bajo la huella
+# de sus datos (las filas de metricas_mensuales que usan). Cada worker los
+# mantiene en memoria y solo reentrena cuando la huella cambia o el archivo
+# supera MODELOS_MAX_EDAD segundos.
+MODELOS_DIR = os.environ.get('MODELOS_DIR', os.path.join(tempfile.gettempdir(), 'registro-cuyes-modelos'))
+MODELOS_MAX_EDAD = float(os.environ.get('MODELOS_MAX_EDAD', 3600))
+METRICAS_MODELOS = ('muertos_destetados', 'nacidos', 'ventas_destetados')
+
+_modelos = {'huella': None, 'modelos': None, 'expira': 0.0}
+_modelos_lock = threading.Lock()
+
+def huella_datos_modelos(cursor, metricas=METRICAS_MODELOS):
+    """Huella de las métricas mensuales que alimentan un conjunto de modelos
+
+    Se calcula sobre metricas_mensuales (una fila por mes, poza y métrica) en
+    lugar de contar las tablas de eventos; cambia con cualquier valor de cualquier mes.
+    """
+    # Un agregado por métrica: cada uno recorre su tramo de la clave primaria
+    cursor.execute('''
+        SELECT COALESCE(SUM(mm.filas), 0), COALESCE(SUM(mm.total), 0), COALESCE(SUM(mm.firma), 0)
+        FROM unnest(%s::text[]) m(metrica)
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS filas, SUM(valor) AS total,
+                   SUM(valor * hashtext(metrica || '|' || mes || '|' || galpon || '|' || poza)) AS firma
+            FROM metricas_mensuales
+            WHERE metrica = m.metrica
+        ) mm
+    ''', (list(metricas),))
+    partes = [str(valor) for valor in cursor.fetchone()]
+    return hashlib.sha1('|'.join(partes).encode('utf-8')).hexdigest()[:16]
+
+def _ruta_modelos(huella, prefijo='granja'):
+    return os.path.join(MODELOS_DIR, f'{prefijo}_{huella}.joblib')
+
+def _guardar_modelos(huella, modelos, prefijo='granja'):
+    """Escribir de forma atómica y borrar los archivos de huellas anteriores"""
+    os.makedirs(MODELOS_DIR, exist_ok=True)
+    ruta = _ruta_modelos(huella, prefijo)
+    fd, temporal = tempfile.mkstemp(dir=MODELOS_DIR, suffix='.tmp')
+    os.close(fd)
+    joblib.dump(modelos, temporal)
+    os.replace(temporal, ruta)
+    for nombre in os.listdir(MODELOS_DIR):
+        if nombre.startswith(f'{prefijo}_') and nombre != os.path.basename(ruta):
+            try:
+                os.remove(os.path.join(MODELOS_DIR, nombre))
+            except OSError:
+                pass
 
-        # Destetados
-        try:
-            cur.execute("""
-                SELECT galpon, poza, COALESCE(SUM(destetados_hembras + destetados_machos),0)
-                FROM destetes GROUP BY galpon, poza ORDER BY galpon, poza;
-            """)
-            for r in cur.fetchall():
-                galpon, poza, cantidad = str(r[0]), str(r[1]), int(r[2] or 0)
-                destetados_data.setdefault(galpon, {})[poza] = cantidad
-        except Exception as e:
-            print("Error destetados_data:", e)
-            conn.rollback()
+def _cargar_modelos(huella, prefijo='granja'):
+    """Modelos guardados por cualquier worker para esta huella, si no vencieron"""
+    ruta = _ruta_modelos(huella, prefijo)
+    try:
+        if time.time() - os.path.getmtime(ruta) > MODELOS_MAX_EDAD:
+            return None
+        return joblib.load(ruta)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        app.logger.error(f"No se pudo leer {ruta}; se reentrenará", exc_info=e)
+        return None
 
-        # Muertos
-        try:
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'partos');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'partos';")
-                parto_cols = [r[0] for r in cur.fetchall()]
-                if 'muertos_bebes' in parto_cols or 'muertos_reproductores' in parto_cols:
-                    expr = []
-                    if 'muertos_bebes' in parto_cols:
-                        expr.append('COALESCE(SUM(muertos_bebes),0)')
-                    if 'muertos_reproductores' in parto_cols:
-                        expr.append('COALESCE(SUM(muertos_reproductores),0)')
-                    if expr:
-                        cur.execute("SELECT galpon, poza, " + " + ".join(expr) + " FROM partos GROUP BY galpon, poza ORDER BY galpon, poza;")
-                        for r in cur.fetchall():
-                            galpon, poza, cantidad = str(r[0]), str(r[1]), int(r[2] or 0)
-                            muertos_data.setdefault(galpon, {})[poza] = muertos_data.get(galpon, {}).get(poza, 0) + cantidad
-
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'muertes_destetados');")
-            if cur.fetchone()[0]:
-                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'muertes_destetados';")
-                md_cols = [r[0] for r in cur.fetchall()]
-                if 'muertos_hembras' in md_cols and 'muertos_machos' in md_cols:
-                    cur.execute("SELECT galpon, poza, COALESCE(SUM(muertos_hembras + muertos_machos),0) FROM muertes_destetados GROUP BY galpon, poza ORDER BY galpon, poza;")
-                    for r in cur.fetchall():
-                        galpon, poza, cantidad = str(r[0]), str(r[1]), int(r[2] or 0)
-                        muertos_data.setdefault(galpon, {})[poza] = muertos_data.get(galpon, {}).get(poza, 0) + cantidad
-        except Exception as e:
-            print("Error muertos_data:", e)
-            conn.rollback()
+def _obtener_del_registro(cache, prefijo, metricas, entrenar, forzar=False):
+    """Modelos de memoria, del disco o recién entrenados con entrenar()"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            huella = huella_datos_modelos(cursor, metricas)
 
-        # -----------------------
-        # Combinar y ORDENAR
-        # -----------------------
-        datos_galpones = OrderedDict()
-        total_reproductores_por_galpon, total_nacidos_por_galpon, total_destetados_por_galpon = {}, {}, {}
-
-        fuentes = [reproductores_data, nacidos_data, destetados_data, muertos_data]
-        all_galpones = set()
-        for src in fuentes:
-            all_galpones.update(src.keys())
-
-        for galpon in sorted(all_galpones, key=lambda x: int(x) if x.isdigit() else x):
-            datos_galpones[galpon] = OrderedDict()
-            total_reproductores_por_galpon[galpon] = 0
-            total_nacidos_por_galpon[galpon] = 0
-            total_destetados_por_galpon[galpon] = 0
-
-            pozas = set()
-            for src in fuentes:
-                pozas.update(src.get(galpon, {}).keys())
-
-            for poza in sorted(pozas, key=lambda x: int(x) if x.isdigit() else x):
-                r = reproductores_data.get(galpon, {}).get(poza, 0)
-                n = nacidos_data.get(galpon, {}).get(poza, 0)
-                d = destetados_data.get(galpon, {}).get(poza, 0)
-                m = muertos_data.get(galpon, {}).get(poza, 0)
-
-                datos_galpones[galpon][poza] = {
-                    'reproductores': r,
-                    'nacidos': n,
-                    'destetados': d,
-                    'nacidos_vigentes': max(0, n - d - m),
-                    'muertos': m
-                }
+    if not forzar and cache['huella'] == huella and time.monotonic() < cache['expira']:
+        return cache['modelos']
+
+    with _modelos_lock:
+        if not forzar and cache['huella'] == huella and time.monotonic() < cache['expira']:
+            return cache['modelos']
 
-                total_reproductores_por_galpon[galpon] += r
-                total_nacidos_por_galpon[galpon] += n
-                total_destetados_por_galpon[galpon] += d
+        modelos = None if forzar else _cargar_modelos(huella, prefijo)
+        if modelos is None:
+            inicio = time.monotonic()
+            modelos = entrenar()
+            print(f"✅ Modelos {prefijo} entrenados para la huella {huella} en {time.monotonic() - inicio:.2f}s")
+            try:
+                _guardar_modelos(huella, modelos, prefijo)
+            except OSError as e:
+                app.logger.error("No se pudieron guardar los modelos", exc_info=e)
+
+        cache.update(huella=huella, modelos=modelos, expira=time.monotonic() + MODELOS_MAX_EDAD)
+        return modelos
+
+def obtener_modelos(forzar=False):
+    """(modelo_mortalidad, modelo_nacimientos, modelo_ganancias) desde el registro"""
+    return _obtener_del_registro(_modelos, 'granja', METRICAS_MODELOS, entrenar_modelos, forzar)
+
+@app.cli.command('entrenar-modelos')
+def entrenar_modelos_comando():
+    """Reentrenar los modelos de predicción y guardarlos en el registro"""
+    modelos = obtener_modelos(forzar=True)
+    disponibles = [nombre for nombre, modelo in zip(('mortalidad', 'nacimientos', 'ganancias'), modelos) if modelo is not None]
+    print(f"Modelos disponibles: {', '.join(disponibles) or 'ninguno'} ({MODELOS_DIR})")
+    print(f"Modelos por poza: {len(obtener_modelos_poza(forzar=True))}")
+
+# === MOTOR DE PREDICCIONES ===
+# Arma la matriz de meses futuros una sola vez y llama a predict una vez por
+# modelo: el costo casi no depende del horizonte. Lo usan /predicciones y
+# /api/predicciones.
+METRICAS_PREDICCION = ('mortalidad', 'nacimientos', 'ganancias')
+PREDICCION_MAX_MESES = int(os.environ.get('PREDICCION_MAX_MESES', 60))
+
+def predecir_horizonte(modelos, meses):
+    """Predicciones de los próximos meses: {'meses': [...], metrica: [...]} con valores >= 0"""
+    # Mismas características que en el entrenamiento: columna mes_num, 1 = próximo mes
+    X = pd.DataFrame({'mes_num': np.arange(1, meses + 1, dtype=float)})
+    fechas = pd.date_range(start=pd.Timestamp.now(), periods=meses, freq='ME')
+
+    resultado = {'meses': fechas.strftime('%Y-%m').tolist()}
+    for metrica, modelo in zip(METRICAS_PREDICCION, modelos):
+        valores = np.zeros(meses) if modelo is None else np.clip(modelo.predict(X), 0, None)
+        resultado[metrica] = valores.astype(float).tolist()
+    return resultado
+
+# === MODELOS POR GALPÓN Y POZA ===
+# Una regresión por (galpón, poza, métrica) sobre los totales mensuales. Las
+# series salen de una sola consulta agrupada, se ajustan en paralelo con joblib
+# (procesos) y se guardan en el registro de modelos con su propia huella.
+MODELOS_POZA_PROCESOS = int(os.environ.get('MODELOS_POZA_PROCESOS', -1))   # -1: todos los núcleos
+MODELOS_POZA_MIN_PARALELO = 50   # con menos series no vale la pena arrancar procesos
+METRICAS_POZA = ('nacimientos', 'destetes', 'mortalidad', 'ganancias')
+
+# Las series salen de metricas_mensuales (meses x pozas x métricas) en lugar de
+# agrupar el historial completo de cuatro tablas en cada entrenamiento
+METRICAS_SERIES_POZA = {
+    'nacidos': 'nacimientos',
+    'destetados': 'destetes',
+    'muertos_destetados': 'mortalidad',
+    'ventas_destetados': 'ganancias',
+    'ventas_descarte': 'ganancias',
+}
+CONSULTA_SERIES_POZA = f'''
+    SELECT CASE metrica {' '.join(f"WHEN '{m}' THEN '{s}'" for m, s in METRICAS_SERIES_POZA.items())} END AS serie,
+           galpon, poza, mes::timestamp AS mes, SUM(valor) AS valor
+    FROM metricas_mensuales
+    WHERE metrica IN ({', '.join(f"'{m}'" for m in METRICAS_SERIES_POZA)})
+    AND galpon <> '' AND poza <> ''
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 2, 3, 1, 4
+'''
+
+_modelos_poza = {'huella': None, 'modelos': None, 'expira': 0.0}
+
+def cargar_series_poza(cursor):
+    """{(galpon, poza, metrica): (meses, valores)} ordenados por mes"""
+    cursor.execute(CONSULTA_SERIES_POZA)
+    series = {}
+    for metrica, galpon, poza, mes, valor in cursor.fetchall():
+        meses, valores = series.setdefault((galpon, poza, metrica), ([], []))
+        meses.append(mes)
+        valores.append(float(valor or 0))
+    return series
+
+def ajustar_modelos_poza(series):
+    """Ajustar en paralelo las series con al menos 2 meses de datos"""
+    claves, inicios, tareas = [], [], []
+    for clave, (meses, valores) in series.items():
+        if len(meses) < 2:
+            continue
+        inicio = meses[0]
+        claves.append(clave)
+        inicios.append(inicio)
+        tareas.append((np.array([[(mes - inicio).days / 30] for mes in meses]), np.array(valores)))
+
+    procesos = MODELOS_POZA_PROCESOS if len(tareas) >= MODELOS_POZA_MIN_PARALELO else 1
+    # Se envía el método fit de un estimador nuevo: los procesos solo importan
+    # sklearn, no app.py (que se conecta a la base al importarse)
+    ajustados = joblib.Parallel(n_jobs=procesos)(
+        joblib.delayed(LinearRegression().fit)(X, y) for X, y in tareas
+    )
+    return {
+        clave: {'modelo': modelo, 'inicio': inicio, 'observaciones': len(X)}
+        for clave, inicio, modelo, (X, _) in zip(claves, inicios, ajustados, tareas)
+    }
 
-        cur.close()
-        conn.close()
+def entrenar_modelos_poza():
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            series = cargar_series_poza(cursor)
+    return ajustar_modelos_poza(series)
+
+def obtener_modelos_poza(forzar=False):
+    """{(galpon, poza, metrica): ajuste} desde el registro de modelos"""
+    return _obtener_del_registro(_modelos_poza, 'pozas', tuple(METRICAS_SERIES_POZA), entrenar_modelos_poza, forzar)
+
+def predecir_series_poza(modelos, meses, galpon=None, poza=None, metrica=None):
+    """Predicciones de los próximos meses para los modelos que coinciden con el filtro"""
+    periodos = pd.period_range(start=pd.Timestamp.now(), periods=meses, freq='M')
+    inicios_mes = periodos.to_timestamp()
+
+    series = []
+    for (g, p, m), ajuste in sorted(modelos.items()):
+        if (galpon and g != galpon) or (poza and p != poza) or (metrica and m != metrica):
+            continue
+        X = ((inicios_mes - ajuste['inicio']).days.to_numpy() / 30).reshape(-1, 1)
+        valores = np.clip(ajuste['modelo'].predict(X), 0, None)
+        series.append({
+            'galpon': g,
+            'poza': p,
+            'metrica': m,
+            'observaciones': ajuste['observaciones'],
+            'valores': valores.astype(float).tolist()
+        })
+    return {'meses': periodos.strftime('%Y-%m').tolist(), 'series': series}
+
+# === DATOS DEL DASHBOARD ===
+def armar_datos_dashboard(filas):
+    """Ordenar la matriz galpón/poza y derivar los totales a partir de las filas de la consulta"""
+    matriz = {}
+    totales = {'reproductores': 0, 'nacidos': 0, 'destetados': 0, 'muertos': 0}
+    for galpon, poza, reproductores_total, reproductores, nacidos, destetados, muertos, vendidos in filas:
+        matriz.setdefault(str(galpon), {})[str(poza)] = (int(reproductores or 0), int(nacidos or 0), int(destetados or 0),
+                                                          int(muertos or 0), int(vendidos or 0))
+        totales['reproductores'] += int(reproductores_total or 0)
+        totales['nacidos'] += int(nacidos or 0)
+        totales['destetados'] += int(destetados or 0)
+        totales['muertos'] += int(muertos or 0)
+
+    datos_galpones = OrderedDict()
+    total_reproductores_por_galpon, total_nacidos_por_galpon, total_destetados_por_galpon = {}, {}, {}
+
+    for galpon in sorted(matriz, key=lambda x: int(x) if x.isdigit() else x):
+        datos_galpones[galpon] = OrderedDict()
+        total_reproductores_por_galpon[galpon] = 0
+        total_nacidos_por_galpon[galpon] = 0
+        total_destetados_por_galpon[galpon] = 0
+
+        for poza in sorted(matriz[galpon], key=lambda x: int(x) if x.isdigit() else x):
+            r, n, d, m, v = matriz[galpon][poza]
+            datos_galpones[galpon][poza] = {
+                'reproductores': r,
+                'nacidos': n,
+                'destetados': d,
+                'nacidos_vigentes': max(0, n - d - m),
+                'muertos': m,
+                'vendidos': v
+            }
+
+            total_reproductores_por_galpon[galpon] += r
+            total_nacidos_por_galpon[galpon] += n
+            total_destetados_por_galpon[galpon] += d
+
+    return {
+        'total_reproductores': totales['reproductores'],
+        'total_nacidos': totales['nacidos'],
+        'nacidos_actuales': totales['nacidos'] - totales['destetados'],
+        'total_destetados': totales['destetados'],
+        'total_muertos': totales['muertos'],
+        'datos_galpones': datos_galpones,
+        'total_reproductores_por_galpon': total_reproductores_por_galpon,
+        'total_nacidos_por_galpon': total_nacidos_por_galpon,
+        'total_destetados_por_galpon': total_destetados_por_galpon
+    }
+
+def obtener_datos_dashboard():
+    """Leer los datos del dashboard desde inventario_poza (una fila por poza)"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT galpon, poza, reproductores_total, reproductores, nacidos, destetados, muertos, vendidos
+                FROM inventario_poza
+            ''')
+            filas = cursor.fetchall()
+    return armar_datos_dashboard(filas)
+
+# Ruta principal
+
+
+@app.route("/")
+def index():
+    try:
+        datos = obtener_datos_dashboard()
 
         # Logs
         print("=== RESUMEN GENERAL ===")
-        print("Total Reproductores:", total_reproductores)
-        print("Total Nacidos:", total_nacidos)
-        print("Nacidos actuales:", nacidos_actuales)
-        print("Total Destetados:", total_destetados)
-        print("Total Muertos:", total_muertos)
-        print("Datos por Galpón:", datos_galpones)
+        print("Total Reproductores:", datos['total_reproductores'])
+        print("Total Nacidos:", datos['total_nacidos'])
+        print("Nacidos actuales:", datos['nacidos_actuales'])
+        print("Total Destetados:", datos['total_destetados'])
+        print("Total Muertos:", datos['total_muertos'])
+        print("Datos por Galpón:", datos['datos_galpones'])
 
-        return render_template(
-            "index.html",
-            total_reproductores=total_reproductores,
-            total_nacidos=total_nacidos,
-            nacidos_actuales=nacidos_actuales,
-            total_destetados=total_destetados,
-            total_muertos=total_muertos,
-            datos_galpones=datos_galpones,
-            total_reproductores_por_galpon=total_reproductores_por_galpon,
-            total_nacidos_por_galpon=total_nacidos_por_galpon,
-            total_destetados_por_galpon=total_destetados_por_galpon
-        )
+        return render_template("index.html", **datos)
 
     except Exception as e:
         print("Error general en la función index:", e)
@@ -741,9 +2835,12 @@ def ingresar_reproductores():
                         INSERT INTO reproductores (
                             galpon, poza, hembras, machos, tiempo_reproductores, fecha_ingreso
                         ) VALUES (%s, %s, %s, %s, %s, %s)
-                    ''', (galpon, poza, hembras, machos, tiempo_reproductores, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+                    ''', (galpon, poza, hembras, machos, tiempo_reproductores, datetime.now()))
+                    actualizar_inventario_poza(cursor, galpon, poza, reproductores=hembras + machos, reproductores_total=hembras + machos)
+                    registrar_poza_catalogo(cursor, galpon, poza)
 
                     conn.commit()
+                    invalidar_catalogo_pozas()
                     flash('Reproductores registrados correctamente.', 'success')
                     return redirect(url_for('index'))
 
@@ -759,20 +2856,6 @@ def ingresar_reproductores():
 # Ruta para registrar partos
 @app.route('/registrar_partos', methods=['GET', 'POST'])
 def registrar_partos():
-    with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            # Obtener valores únicos de galpón y poza
-            cursor.execute('SELECT DISTINCT galpon, poza FROM reproductores')
-            galpones_pozas = cursor.fetchall()
-
-            # Obtener valores únicos de galpón
-            cursor.execute('SELECT DISTINCT galpon FROM reproductores')
-            galpones_unicos = [row['galpon'] for row in cursor.fetchall()]
-
-            # Obtener valores únicos de poza
-            cursor.execute('SELECT DISTINCT poza FROM reproductores')
-            pozas_unicas = [row['poza'] for row in cursor.fetchall()]
-
     if request.method == 'POST':
         action = request.form.get('action')  # Obtener la acción (registrar o buscar)
         galpon = request.form['galpon']
@@ -786,31 +2869,22 @@ def registrar_partos():
                 muertos_reproductores = int(request.form['muertos_reproductores'])
 
                 with get_db_connection() as conn:
-                    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                        # Verificar si el parto ya existe
+                    with conn.cursor() as cursor:
+                        # Un solo INSERT: si el parto ya existe se suman los valores
                         cursor.execute('''
-                            SELECT id FROM partos
-                            WHERE galpon = %s AND poza = %s AND numero_parto = %s
-                        ''', (galpon, poza, numero_parto))
-                        parto_existente = cursor.fetchone()
-
-                        if parto_existente:
-                            # Si el parto ya existe, actualizar los valores
-                            cursor.execute('''
-                                UPDATE partos
-                                SET nacidos = nacidos + %s,
-                                    muertos_bebes = muertos_bebes + %s,
-                                    muertos_reproductores = muertos_reproductores + %s
-                                WHERE id = %s
-                            ''', (nacidos, muertos_bebes, muertos_reproductores, parto_existente['id']))
-                        else:
-                            # Si el parto no existe, insertar un nuevo registro
-                            cursor.execute('''
-                                INSERT INTO partos (
-                                    galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento
-                                ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                            ''', (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
-
+                            INSERT INTO partos (
+                                galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento
+                            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (galpon, poza, numero_parto) DO UPDATE
+                            SET nacidos = partos.nacidos + EXCLUDED.nacidos,
+                                muertos_bebes = partos.muertos_bebes + EXCLUDED.muertos_bebes,
+                                muertos_reproductores = partos.muertos_reproductores + EXCLUDED.muertos_reproductores
+                            RETURNING fecha_nacimiento
+                        ''', (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, datetime.now()))
+                        fecha_nacimiento = cursor.fetchone()[0]
+
+                        actualizar_inventario_poza(cursor, galpon, poza, nacidos=nacidos, muertos=muertos_bebes + muertos_reproductores)
+                        refrescar_metricas_mensuales(cursor, 'partos', [fecha_nacimiento])
                         conn.commit()
                         flash('Parto registrado correctamente.', 'success')
                         return redirect(url_for('registrar_partos'))
@@ -829,6 +2903,7 @@ def registrar_partos():
                         cursor.execute('''
                             SELECT * FROM partos
                             WHERE galpon = %s AND poza = %s
+                            ORDER BY numero_parto
                         ''', (galpon, poza))
                         partos = cursor.fetchall()
 
@@ -839,11 +2914,13 @@ def registrar_partos():
             except Exception as e:
                 flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
 
+    # Las listas del formulario salen del catálogo en memoria
+    catalogo = obtener_catalogo_pozas()
     return render_template(
         'registrar_partos.html',
-        galpones_pozas=galpones_pozas,
-        galpones_unicos=galpones_unicos,
-        pozas_unicas=pozas_unicas
+        galpones_pozas=catalogo['galpones_pozas'],
+        galpones_unicos=catalogo['galpones'],
+        pozas_unicas=catalogo['pozas_unicas']
     )
 
 # Ruta para buscar partos
@@ -857,6 +2934,7 @@ def buscar_partos():
             cursor.execute('''
                 SELECT * FROM partos
                 WHERE galpon = %s AND poza = %s
+                ORDER BY numero_parto
             ''', (galpon, poza))
             partos = cursor.fetchall()
 
@@ -879,18 +2957,36 @@ def editar_parto(id):
 
                     validate_positive_values(numero_parto=numero_parto, nacidos=nacidos, muertos_bebes=muertos_bebes, muertos_reproductores=muertos_reproductores)
 
+                    cursor.execute('''
+                        SELECT galpon, poza, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento
+                        FROM partos WHERE id = %s FOR UPDATE
+                    ''', (id,))
+                    anterior = cursor.fetchone()
+
                     cursor.execute('''
                         UPDATE partos
                         SET galpon = %s, poza = %s, numero_parto = %s, nacidos = %s, muertos_bebes = %s, muertos_reproductores = %s
                         WHERE id = %s
                     ''', (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, id))
 
+                    # Mover los contadores del valor anterior al nuevo (puede cambiar de poza)
+                    if anterior:
+                        actualizar_inventario_poza(cursor, anterior['galpon'], anterior['poza'],
+                                                   nacidos=-anterior['nacidos'],
+                                                   muertos=-(anterior['muertos_bebes'] + anterior['muertos_reproductores']))
+                        actualizar_inventario_poza(cursor, galpon, poza, nacidos=nacidos, muertos=muertos_bebes + muertos_reproductores)
+                        refrescar_metricas_mensuales(cursor, 'partos', [anterior['fecha_nacimiento']])
+
                     conn.commit()
                     flash('Parto actualizado correctamente.', 'success')
                     return redirect(url_for('index'))
                 except ValueError as e:
                     flash(f'Error en los datos ingresados: {str(e)}', 'danger')
+                except psycopg2.errors.UniqueViolation:
+                    conn.rollback()
+                    flash('Ya existe un parto con ese número en el galpón y poza indicados.', 'danger')
                 except psycopg2.Error as e:
+                    conn.rollback()
                     flash(f'Error en la base de datos: {str(e)}', 'danger')
                 except Exception as e:
                     flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
@@ -918,49 +3014,34 @@ def registrar_destete():
 
     # Obtener galpones/pozas y estadísticas (GET parte)
     try:
+        catalogo = obtener_catalogo_pozas()
+        galpones_unicos = catalogo['galpones']
+        pozas_unicas = catalogo['pozas_unicas']
+
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Galpones y pozas
-                cursor.execute("SELECT DISTINCT galpon FROM reproductores ORDER BY galpon")
-                galpones_unicos = [r['galpon'] for r in cursor.fetchall()]
-
-                cursor.execute("SELECT DISTINCT poza FROM reproductores ORDER BY poza")
-                pozas_unicas = [r['poza'] for r in cursor.fetchall()]
-
-                # Total acumulado (simple)
+                # Total acumulado (desde el inventario por poza, sin recorrer destetes)
                 cursor.execute("""
-                    SELECT COALESCE(SUM(destetados_hembras + destetados_machos), 0) AS suma
-                    FROM destetes
+                    SELECT COALESCE(SUM(destetados), 0) AS suma
+                    FROM inventario_poza
                 """)
                 total_destetados = int(cursor.fetchone()['suma'] or 0)
 
-                # --- Destetados HOY (robusto para distintos formatos) ---
+                # --- Destetados HOY ---
                 cursor.execute("""
                     SELECT COALESCE(SUM(destetados_hembras + destetados_machos), 0) AS suma
                     FROM destetes
-                    WHERE (
-                        -- Formato ISO al inicio:  YYYY-MM-DD or YYYY-MM-DD HH:MM:SS[.fff]
-                        (substring(trim(fecha_destete) from '(\d{4}-\d{2}-\d{2})') IS NOT NULL
-                         AND substring(trim(fecha_destete) from '(\d{4}-\d{2}-\d{2})')::date = CURRENT_DATE)
-                        OR
-                        -- Formato con barras al inicio: DD/MM/YYYY or DD/MM/YYYY HH:MM:SS
-                        (substring(trim(fecha_destete) from '(\d{2}/\d{2}/\d{4})') IS NOT NULL
-                         AND to_date(substring(trim(fecha_destete) from '(\d{2}/\d{2}/\d{4})'),'DD/MM/YYYY') = CURRENT_DATE)
-                    )
+                    WHERE fecha_destete >= CURRENT_DATE
+                    AND fecha_destete < CURRENT_DATE + 1
                 """)
                 destetados_hoy = int(cursor.fetchone()['suma'] or 0)
 
-                # --- Destetados MES (mismo enfoque, por mes actual) ---
+                # --- Destetados MES ---
                 cursor.execute("""
                     SELECT COALESCE(SUM(destetados_hembras + destetados_machos), 0) AS suma
                     FROM destetes
-                    WHERE (
-                        (substring(trim(fecha_destete) from '(\d{4}-\d{2}-\d{2})') IS NOT NULL
-                         AND date_trunc('month', substring(trim(fecha_destete) from '(\d{4}-\d{2}-\d{2})')::date) = date_trunc('month', CURRENT_DATE))
-                        OR
-                        (substring(trim(fecha_destete) from '(\d{2}/\d{2}/\d{4})') IS NOT NULL
-                         AND date_trunc('month', to_date(substring(trim(fecha_destete) from '(\d{2}/\d{2}/\d{4})'),'DD/MM/YYYY')) = date_trunc('month', CURRENT_DATE))
-                    )
+                    WHERE fecha_destete >= date_trunc('month', CURRENT_DATE)
+                    AND fecha_destete < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
                 """)
                 destetados_mes = int(cursor.fetchone()['suma'] or 0)
 
@@ -987,13 +3068,15 @@ def registrar_destete():
                 flash('Debe ingresar al menos un animal destetado.', 'danger')
                 return redirect(url_for('registrar_destete'))
 
-            fecha_str = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            fecha_destete = datetime.now()
             with get_db_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute('''
                         INSERT INTO destetes (galpon, poza, destetados_hembras, destetados_machos, fecha_destete)
                         VALUES (%s, %s, %s, %s, %s)
-                    ''', (galpon, poza, destetados_hembras, destetados_machos, fecha_str))
+                    ''', (galpon, poza, destetados_hembras, destetados_machos, fecha_destete))
+                    actualizar_inventario_poza(cursor, galpon, poza, destetados=destetados_hembras + destetados_machos)
+                    refrescar_metricas_mensuales(cursor, 'destetes', [fecha_destete])
                 conn.commit()
 
             flash('Destete registrado correctamente.', 'success')
@@ -1029,20 +3112,20 @@ def registrar_muertes_destetados():
                 return redirect(url_for('registrar_muertes_destetados'))
 
             # Insertar en la base de datos
-            conn = get_db_connection()
-            if conn:
+            with get_db_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute('''
                         INSERT INTO muertes_destetados (galpon, poza, muertos_hembras, muertos_machos, fecha_muerte)
                         VALUES (%s, %s, %s, %s, NOW())
+                        RETURNING fecha_muerte
                     ''', (galpon, poza, muertos_hembras, muertos_machos))
+                    fecha_muerte = cursor.fetchone()[0]
+                    actualizar_inventario_poza(cursor, galpon, poza, muertos=muertos_hembras + muertos_machos)
+                    refrescar_metricas_mensuales(cursor, 'muertes_destetados', [fecha_muerte])
                     conn.commit()
-                conn.close()
-                
-                flash('Muertes registradas correctamente.', 'success')
-                return redirect(url_for('registrar_muertes_destetados'))
-            else:
-                flash('Error de conexión a la base de datos.', 'danger')
+
+            flash('Muertes registradas correctamente.', 'success')
+            return redirect(url_for('registrar_muertes_destetados'))
 
         except ValueError:
             flash('Por favor ingrese valores numéricos válidos.', 'danger')
@@ -1064,73 +3147,41 @@ def ventas():
 
     # --- GET: Obtener galpones/pozas y estadísticas ---
     try:
+        galpones_pozas = obtener_catalogo_pozas()['galpones_pozas']
+
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                # Galpones y pozas
-                cur.execute("SELECT DISTINCT galpon, poza FROM reproductores ORDER BY galpon, poza")
-                galpones_pozas = cur.fetchall()
-
-                # Verificar si la tabla ventas existe consultando el catálogo del sistema
+                # Hoy y el mes actual: rango de fechas sobre el índice de la migración 0015
                 cur.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.tables 
-                        WHERE table_schema = 'public'
-                        AND table_name = 'ventas'
-                    );
+                    SELECT
+                        COALESCE(SUM(hembras_vendidas + machos_vendidos)
+                                 FILTER (WHERE tipo_venta = 'destetados' AND fecha_venta >= CURRENT_DATE
+                                         AND fecha_venta < CURRENT_DATE + 1), 0) AS destetados_hoy,
+                        COALESCE(SUM(hembras_vendidas + machos_vendidos)
+                                 FILTER (WHERE tipo_venta = 'destetados'), 0) AS destetados_mes,
+                        COALESCE(SUM(hembras_vendidas + machos_vendidos)
+                                 FILTER (WHERE tipo_venta = 'descarte'), 0) AS descarte_mes
+                    FROM ventas
+                    WHERE fecha_venta >= date_trunc('month', CURRENT_DATE)
+                    AND fecha_venta < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
                 """)
-                tabla_existe = cur.fetchone()[0]
-                
-                if not tabla_existe:
-                    # Si la tabla no existe, inicializarla
-                    init_ventas_table()
-                    flash('Tabla de ventas inicializada correctamente.', 'info')
-                else:
-                    # Verificar si hay datos
-                    cur.execute("SELECT COUNT(*) FROM ventas")
-                    hay_datos = cur.fetchone()[0] > 0
-                    
-                    if hay_datos:
-                        # Total acumulado de ventas de destetados
-                        cur.execute("""
-                            SELECT COALESCE(SUM(hembras_vendidas + machos_vendidos),0) AS total
-                            FROM ventas
-                            WHERE tipo_venta='destetados'
-                        """)
-                        total_ventas_destetados = int(cur.fetchone()['total'] or 0)
-
-                        # Ventas de destetados hoy
-                        cur.execute("""
-                            SELECT COALESCE(SUM(hembras_vendidas + machos_vendidos),0) AS total
-                            FROM ventas
-                            WHERE tipo_venta='destetados'
-                            AND fecha_venta::date = CURRENT_DATE
-                        """)
-                        ventas_destetados_hoy = int(cur.fetchone()['total'] or 0)
-
-                        # Ventas de destetados este mes
-                        cur.execute("""
-                            SELECT COALESCE(SUM(hembras_vendidas + machos_vendidos),0) AS total
-                            FROM ventas
-                            WHERE tipo_venta='destetados'
-                            AND date_trunc('month', fecha_venta) = date_trunc('month', CURRENT_DATE)
-                        """)
-                        ventas_destetados_mes = int(cur.fetchone()['total'] or 0)
-                        
-                        # Ventas de descarte este mes
-                        cur.execute("""
-                            SELECT COALESCE(SUM(hembras_vendidas + machos_vendidos),0) AS total
-                            FROM ventas
-                            WHERE tipo_venta='descarte'
-                            AND date_trunc('month', fecha_venta) = date_trunc('month', CURRENT_DATE)
-                        """)
-                        ventas_descarte_mes = int(cur.fetchone()['total'] or 0)
-                        
-                        # Ingresos totales (suma de todas las ventas)
-                        cur.execute("""
-                            SELECT COALESCE(SUM(costo_total),0) AS total
-                            FROM ventas
-                        """)
-                        ingresos_totales = float(cur.fetchone()['total'] or 0)
+                estadisticas = dict(cur.fetchone())
+                # Totales históricos desde metricas_mensuales, sin recorrer el libro completo
+                cur.execute("""
+                    SELECT
+                        COALESCE(SUM(mm.total) FILTER (WHERE m.metrica = 'vendidos_destetados'), 0) AS total_destetados,
+                        COALESCE(SUM(mm.total) FILTER (WHERE m.metrica <> 'vendidos_destetados'), 0) AS ingresos
+                    FROM unnest(ARRAY['vendidos_destetados', 'ventas_destetados', 'ventas_descarte']) m(metrica)
+                    CROSS JOIN LATERAL (
+                        SELECT SUM(valor) AS total FROM metricas_mensuales WHERE metrica = m.metrica
+                    ) mm
+                """)
+                estadisticas.update(cur.fetchone())
+                total_ventas_destetados = int(estadisticas['total_destetados'])
+                ventas_destetados_hoy = int(estadisticas['destetados_hoy'])
+                ventas_destetados_mes = int(estadisticas['destetados_mes'])
+                ventas_descarte_mes = int(estadisticas['descarte_mes'])
+                ingresos_totales = float(estadisticas['ingresos'])
 
         app.logger.debug(f"[ventas] hoy={ventas_destetados_hoy} mes={ventas_destetados_mes} total={total_ventas_destetados}")
 
@@ -1143,7 +3194,7 @@ def ventas():
         try:
             tipo_venta = request.form['tipo_venta']
             costo_venta = float(request.form['costo_venta'])
-            fecha_venta = request.form.get('fecha_venta', datetime.utcnow().date())
+            fecha_venta = request.form.get('fecha_venta', datetime.now().date())
 
             if tipo_venta == 'destetados':
                 hembras_vendidas = int(request.form['hembras_vendidas'])
@@ -1162,7 +3213,9 @@ def ventas():
                         cur.execute("""
                             INSERT INTO ventas (tipo_venta, hembras_vendidas, machos_vendidos, costo_total, fecha_venta)
                             VALUES (%s, %s, %s, %s, %s)
+                            RETURNING fecha_venta
                         """, (tipo_venta, hembras_vendidas, machos_vendidos, costo_venta, fecha_venta))
+                        refrescar_metricas_mensuales(cur, 'ventas', [cur.fetchone()[0]])
                     conn.commit()
 
                 flash('Venta de destetados registrada correctamente.', 'success')
@@ -1207,11 +3260,14 @@ def ventas():
                                 engorde_poza, fecha_movimiento, dias_engorde, observaciones
                             )
                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            RETURNING fecha_venta
                         """, (
                             tipo_venta, origen_galpon, origen_poza, 0, cuyes_vendidos, 
                             costo_venta, fecha_venta, mover_engorde, engorde_galpon, 
                             engorde_poza, fecha_movimiento, dias_engorde, observaciones
                         ))
+                        refrescar_metricas_mensuales(cur, 'ventas', [cur.fetchone()[0]])
+                        actualizar_inventario_poza(cur, origen_galpon, origen_poza, vendidos=cuyes_vendidos)
                     conn.commit()
 
                 flash('Venta de descarte registrada correctamente.', 'success')
@@ -1246,13 +3302,15 @@ def registrar_gastos():
 
             validate_positive_values(monto=monto)
 
+            fecha_gasto = datetime.now()
             with get_db_connection() as conn:
                 with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
                     cursor.execute('''
                         INSERT INTO gastos (
                             descripcion, monto, tipo, fecha_gasto
                         ) VALUES (%s, %s, %s, %s)
-                    ''', (descripcion, monto, tipo, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+                    ''', (descripcion, monto, tipo, fecha_gasto))
+                    refrescar_metricas_mensuales(cursor, 'gastos', [fecha_gasto])
 
                     conn.commit()
                     flash('Gasto registrado correctamente.', 'success')
@@ -1266,204 +3324,202 @@ def registrar_gastos():
 
     return render_template('registrar_gastos.html')
 
+# Ruta para importar registros históricos desde CSV o XLSX
+@app.route('/importar', methods=['GET', 'POST'])
+def importar():
+    informe = None
+    if request.method == 'POST':
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            flash('Seleccione un archivo CSV o XLSX.', 'danger')
+        else:
+            try:
+                informe = importar_archivo(request.form.get('tipo'), archivo.stream, archivo.filename,
+                                           omitir_errores='omitir_errores' in request.form)
+                if informe['importadas']:
+                    flash(f"Se importaron {informe['importadas']} registros.", 'success')
+                elif informe['total_errores']:
+                    flash(f"No se importó nada: {informe['total_errores']} filas con errores.", 'warning')
+            except ValueError as e:
+                flash(f'Error en el archivo: {str(e)}', 'danger')
+            except psycopg2.Error as e:
+                app.logger.error("Error de base de datos al importar archivo", exc_info=e)
+                flash(f'Error en la base de datos: {str(e)}', 'danger')
+            except Exception as e:
+                app.logger.error("Error al importar archivo", exc_info=e)
+                flash('Error al importar el archivo. Revisa los logs.', 'danger')
+
+    return render_template('importar.html', importaciones=IMPORTACIONES, informe=informe)
+
 # Ruta para ver análisis de datos
 # Ruta para ver análisis de datos - CORREGIDA
 @app.route('/analisis_datos')
 def analisis_datos():
+    # Las tablas se cargan por pestaña desde /api/analisis/<tabla>
     try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Obtener datos de reproductores
-                cursor.execute('SELECT * FROM reproductores ORDER BY galpon, poza')
-                reproductores = cursor.fetchall()
-
-                # Obtener datos de partos
-                cursor.execute('SELECT * FROM partos ORDER BY galpon, poza, fecha_nacimiento')
-                partos = cursor.fetchall()
-
-                # Obtener datos de destetes
-                cursor.execute('SELECT * FROM destetes ORDER BY galpon, poza, fecha_destete')
-                destetes = cursor.fetchall()
-
-                # Obtener datos de muertes de destetados
-                cursor.execute('SELECT * FROM muertes_destetados ORDER BY galpon, poza, fecha_muerte')
-                muertes_destetados = cursor.fetchall()
-
-                # Obtener datos de ventas de destetados
-                cursor.execute('SELECT * FROM ventas_destetados ORDER BY galpon, poza, fecha_venta')
-                ventas_destetados = cursor.fetchall()
-
-                # Obtener datos de ventas de descarte
-                cursor.execute('SELECT * FROM ventas_descarte ORDER BY galpon, poza, fecha_venta')
-                ventas_descarte = cursor.fetchall()
-
-                # Obtener datos de gastos
-                cursor.execute('SELECT * FROM gastos ORDER BY fecha_gasto DESC')
-                gastos = cursor.fetchall()
-
-        # Pasar los datos organizados por tabla
-        return render_template('analisis_datos.html', 
-                             reproductores=reproductores,
-                             partos=partos,
-                             destetes=destetes,
-                             muertes_destetados=muertes_destetados,
-                             ventas_destetados=ventas_destetados,
-                             ventas_descarte=ventas_descarte,
-                             gastos=gastos)
+        resumen = obtener_resumen_analisis()
+        catalogo = obtener_catalogo_pozas()
+        return render_template('analisis_datos.html',
+                             resumen=resumen,
+                             galpones=catalogo['galpones'],
+                             pozas=catalogo['pozas_unicas'],
+                             limite=LISTADO_LIMITE)
 
     except Exception as e:
         print(f"Error en análisis de datos: {e}")
         flash(f'Ocurrió un error al cargar los datos: {str(e)}', 'danger')
         return redirect(url_for('index'))
+
+@app.route('/api/analisis/<tabla>')
+def api_listado_analisis(tabla):
+    """Página de un listado: ?galpon=&poza=&desde=&hasta=&despues=&limite="""
+    if tabla not in LISTADOS_ANALISIS:
+        return jsonify({'error': f'Tabla desconocida: {tabla}'}), 404
+
+    try:
+        limite = min(max(int(request.args.get('limite', LISTADO_LIMITE)), 1), LISTADO_LIMITE_MAXIMO)
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        despues = request.args.get('despues')
+        filtros = {
+            'galpon': request.args.get('galpon') or None,
+            'poza': request.args.get('poza') or None,
+            'desde': parsear_fecha_filtro(desde, 'desde') if desde else None,
+            'hasta': parsear_fecha_filtro(hasta, 'hasta') if hasta else None,
+            'despues': decodificar_cursor_listado(despues, columnas_orden_listado(tabla)) if despues else None,
+        }
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        filas, siguiente = listar_pagina(tabla, limite=limite, **filtros)
+    except Exception as e:
+        app.logger.error(f"Error listando {tabla}", exc_info=e)
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'filas': filas, 'siguiente': siguiente})
+
 # Ruta para ver el balance
 @app.route('/balance')
 def balance():
     try:
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute('SELECT SUM(costo_venta) FROM ventas_destetados')
-                total_ventas_destetados = cursor.fetchone()[0] or 0
-
-                cursor.execute('SELECT SUM(costo_venta) FROM ventas_descarte')
-                total_ventas_descarte = cursor.fetchone()[0] or 0
-
-                cursor.execute('SELECT SUM(monto) FROM gastos')
-                total_gastos = cursor.fetchone()[0] or 0
+                cursor.execute('''
+                    SELECT COALESCE(SUM(ventas_destetados), 0), COALESCE(SUM(ventas_descarte), 0),
+                           COALESCE(SUM(gastos), 0)
+                    FROM mv_flujo_caja
+                ''')
+                total_ventas_destetados, total_ventas_descarte, total_gastos = cursor.fetchone()
 
                 balance = (total_ventas_destetados + total_ventas_descarte) - total_gastos
+                estado_vistas = obtener_estado_vistas(cursor)
 
         return render_template('balance.html', 
                              total_ventas_destetados=total_ventas_destetados,
                              total_ventas_descarte=total_ventas_descarte,
                              total_gastos=total_gastos,
-                             balance=balance)
+                             balance=balance,
+                             estado_vistas=estado_vistas)
     except Exception as e:
         flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
         return render_template('error.html')
 
+@app.route('/api/balance')
+def api_balance():
+    """Balance por período: ?desde=&hasta=&granularidad=dia|semana|mes"""
+    try:
+        desde, hasta = rango_balance_predeterminado()
+        if request.args.get('hasta'):
+            hasta = parsear_fecha_filtro(request.args['hasta'], 'hasta')
+        if request.args.get('desde'):
+            desde = parsear_fecha_filtro(request.args['desde'], 'desde')
+        granularidad = request.args.get('granularidad', 'mes')
+        validar_rango_balance(desde, hasta, granularidad)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Los errores de la base (o de su configuración) no son culpa de los parámetros
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                periodos = calcular_balance_periodos(cursor, desde, hasta, granularidad)
+    except Exception as e:
+        app.logger.error("Error calculando el balance por períodos", exc_info=e)
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'desde': desde.date().isoformat(),
+        'hasta': hasta.date().isoformat(),
+        'granularidad': granularidad,
+        'periodos': periodos,
+        'totales': {columna: round(sum(p[columna] for p in periodos), 2) for columna in COLUMNAS_BALANCE},
+    })
+
 # Ruta para ver resultados
 @app.route('/resultados')
 def resultados():
     try:
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Obtener todos los datos de las tablas
-                cursor.execute('SELECT * FROM reproductores')
-                reproductores = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM partos')
-                partos = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM destetes')
-                destetes = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM muertes_destetados')
-                muertes_destetados = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM ventas_destetados')
-                ventas_destetados = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM ventas_descarte')
-                ventas_descarte = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM gastos')
-                gastos = cursor.fetchall()
-
-                # Análisis estadístico
-                # 1. Mortalidad por mes y poza/galpón (incluyendo todas las fuentes)
+                # Todas las series salen de metricas_mensuales (un registro por mes y poza)
+                # 1. Mortalidad por mes y poza/galpón (destetados y partos)
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_muerte, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        galpon,
-                        poza,
-                        SUM(muertos_hembras + muertos_machos) AS total_muertes
-                    FROM muertes_destetados
-                    WHERE fecha_muerte IS NOT NULL
-                    GROUP BY mes, galpon, poza
-
-                    UNION ALL
-
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_nacimiento, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        galpon,
-                        poza,
-                        SUM(muertos_bebes + muertos_reproductores) AS total_muertes
-                    FROM partos
-                    WHERE fecha_nacimiento IS NOT NULL
-                    GROUP BY mes, galpon, poza
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, galpon, poza, SUM(valor)::bigint AS total_muertes
+                    FROM metricas_mensuales
+                    WHERE metrica IN ('muertos_destetados', 'muertos_partos')
+                    GROUP BY 1, galpon, poza
+                    ORDER BY 1, galpon, poza
                 ''')
                 mortalidad_por_mes = cursor.fetchall()
 
                 # 2. Nacimientos por mes y poza/galpón
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_nacimiento, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        galpon,
-                        poza,
-                        SUM(nacidos) AS total_nacidos
-                    FROM partos
-                    WHERE fecha_nacimiento IS NOT NULL
-                    GROUP BY mes, galpon, poza
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, galpon, poza, valor::bigint AS total_nacidos
+                    FROM metricas_mensuales
+                    WHERE metrica = 'nacidos'
                     ORDER BY mes, galpon, poza
                 ''')
                 nacimientos_por_mes = cursor.fetchall()
 
-                # 3. Costos и ganancias por mes
+                # 3. Costos y ganancias por mes
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_gasto, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(monto) AS total_gastos
-                    FROM gastos
-                    WHERE fecha_gasto IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, SUM(valor)::float AS total_gastos
+                    FROM metricas_mensuales
+                    WHERE metrica = 'gastos'
+                    GROUP BY 1
+                    ORDER BY 1
                 ''')
                 gastos_por_mes = cursor.fetchall()
 
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_venta, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(costo_venta) AS total_ventas
-                    FROM ventas_destetados
-                    WHERE fecha_venta IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, SUM(valor)::float AS total_ventas
+                    FROM metricas_mensuales
+                    WHERE metrica = 'ventas_destetados'
+                    GROUP BY 1
+                    ORDER BY 1
                 ''')
                 ventas_destetados_por_mes = cursor.fetchall()
 
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_venta, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(costo_venta) AS total_ventas
-                    FROM ventas_descarte
-                    WHERE fecha_venta IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, SUM(valor)::float AS total_ventas
+                    FROM metricas_mensuales
+                    WHERE metrica = 'ventas_descarte'
+                    GROUP BY 1
+                    ORDER BY 1
                 ''')
                 ventas_descarte_por_mes = cursor.fetchall()
 
                 # 4. Proyección de crecimiento (usando Pandas)
                 cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_nacimiento, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(nacidos) AS total_nacidos
-                    FROM partos
-                    WHERE fecha_nacimiento IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
+                    SELECT TO_CHAR(mes, 'YYYY-MM') AS mes, SUM(valor)::bigint AS total_nacidos
+                    FROM metricas_mensuales
+                    WHERE metrica = 'nacidos'
+                    GROUP BY 1
+                    ORDER BY 1
                 ''')
                 proyeccion_nacimientos = cursor.fetchall()
-
-                cursor.execute('''
-                    SELECT 
-                        TO_CHAR(TO_DATE(fecha_venta, 'YYYY-MM-DD'), 'YYYY-MM') AS mes,
-                        SUM(costo_venta) AS total_ventas
-                    FROM ventas_destetados
-                    WHERE fecha_venta IS NOT NULL
-                    GROUP BY mes
-                    ORDER BY mes
-                ''')
-                proyeccion_ventas = cursor.fetchall()
+                proyeccion_ventas = ventas_destetados_por_mes
 
                 # Convertir a DataFrame de Pandas para proyecciones
                 df_nacimientos = pd.DataFrame(proyeccion_nacimientos, columns=['mes', 'total_nacidos'])
@@ -1501,13 +3557,6 @@ def resultados():
 
         # Pasar todos los datos a la plantilla
         return render_template('resultados.html', 
-                             reproductores=reproductores,
-                             partos=partos,
-                             destetes=destetes,
-                             muertes_destetados=muertes_destetados,
-                             ventas_destetados=ventas_destetados,
-                             ventas_descarte=ventas_descarte,
-                             gastos=gastos,
                              mortalidad_por_mes=mortalidad_por_mes,
                              nacimientos_por_mes=nacimientos_por_mes,
                              gastos_por_mes=gastos_por_mes,
@@ -1535,13 +3584,22 @@ def editar_reproductor(id):
 
                     validate_positive_values(hembras=hembras, machos=machos, tiempo_reproductores=tiempo_reproductores)
 
+                    cursor.execute('SELECT galpon, poza FROM reproductores WHERE id = %s FOR UPDATE', (id,))
+                    anterior = cursor.fetchone()
+
                     cursor.execute('''
                         UPDATE reproductores
                         SET galpon = %s, poza = %s, hembras = %s, machos = %s, tiempo_reproductores = %s
                         WHERE id = %s
                     ''', (galpon, poza, hembras, machos, tiempo_reproductores, id))
 
+                    if anterior and (anterior['galpon'], anterior['poza']) != (galpon, poza):
+                        recalcular_reproductores_poza(cursor, anterior['galpon'], anterior['poza'])
+                    recalcular_reproductores_poza(cursor, galpon, poza)
+                    registrar_poza_catalogo(cursor, galpon, poza)
+
                     conn.commit()
+                    invalidar_catalogo_pozas()
                     flash('Reproductor actualizado correctamente.', 'success')
                     return redirect(url_for('analisis_datos'))
                 except ValueError as e:
@@ -1577,11 +3635,16 @@ def eliminar_todos_los_datos():
                 cursor.execute('DELETE FROM partos')
                 cursor.execute('DELETE FROM destetes')
                 cursor.execute('DELETE FROM muertes_destetados')
+                cursor.execute('DELETE FROM ventas')
                 cursor.execute('DELETE FROM ventas_destetados')
                 cursor.execute('DELETE FROM ventas_descarte')
                 cursor.execute('DELETE FROM gastos')
+                cursor.execute('DELETE FROM galpones')
+                reconstruir_metricas_mensuales(cursor)
+                reconstruir_inventario_poza(cursor)
 
                 conn.commit()
+                invalidar_catalogo_pozas()
                 flash('Todos los datos han sido eliminados correctamente.', 'success')
     except Exception as e:
         flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
@@ -1591,58 +3654,99 @@ def eliminar_todos_los_datos():
 # Ruta para Exportar a Excel
 @app.route('/exportar_excel')
 def exportar_excel():
+    fd, ruta = tempfile.mkstemp(prefix='exportacion_', suffix='.xlsx')
+    os.close(fd)
     try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                # Obtener todos los datos de las tablas
-                cursor.execute('SELECT * FROM reproductores')
-                reproductores = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM partos')
-                partos = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM destetes')
-                destetes = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM muertes_destetados')
-                muertes_destetados = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM ventas_destetados')
-                ventas_destetados = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM ventas_descarte')
-                ventas_descarte = cursor.fetchall()
-
-                cursor.execute('SELECT * FROM gastos')
-                gastos = cursor.fetchall()
-
-                # Crear un DataFrame de Pandas
-                df_reproductores = pd.DataFrame(reproductores)
-                df_partos = pd.DataFrame(partos)
-                df_destetes = pd.DataFrame(destetes)
-                df_muertes = pd.DataFrame(muertes_destetados)
-                df_ventas_destetados = pd.DataFrame(ventas_destetados)
-                df_ventas_descarte = pd.DataFrame(ventas_descarte)
-                df_gastos = pd.DataFrame(gastos)
-
-                # Crear un archivo Excel en memoria
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df_reproductores.to_excel(writer, sheet_name='Reproductores', index=False)
-                    df_partos.to_excel(writer, sheet_name='Partos', index=False)
-                    df_destetes.to_excel(writer, sheet_name='Destetes', index=False)
-                    df_muertes.to_excel(writer, sheet_name='Muertes', index=False)
-                    df_ventas_destetados.to_excel(writer, sheet_name='Ventas Destetados', index=False)
-                    df_ventas_descarte.to_excel(writer, sheet_name='Ventas Descarte', index=False)
-                    df_gastos.to_excel(writer, sheet_name='Gastos', index=False)
-
-                output.seek(0)
-                return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                headers={"Content-Disposition": "attachment;filename=datos_granja.xlsx"})
+        escribir_excel(ruta)
     except Exception as e:
+        os.remove(ruta)
         flash(f'Ocurrió un error inesperado: {str(e)}', 'danger')
         return redirect(url_for('index'))
 
+    return Response(enviar_archivo_temporal(ruta),
+                    mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    headers={"Content-Disposition": "attachment;filename=datos_granja.xlsx",
+                             "Content-Length": str(os.path.getsize(ruta))})
+
+# Exportación en CSV: un ZIP con todas las tablas o ?tabla=<nombre> para una sola
+@app.route('/exportar_csv')
+def exportar_csv():
+    tabla = request.args.get('tabla')
+    if tabla:
+        if tabla not in dict(TABLAS_EXPORTACION):
+            flash(f'Tabla desconocida: {tabla}', 'danger')
+            return redirect(url_for('analisis_datos'))
+        return Response(exportar_csv_stream(tabla), mimetype='text/csv; charset=utf-8',
+                        headers={"Content-Disposition": f"attachment;filename={tabla}.csv"})
+
+    return Response(exportar_zip_stream(), mimetype='application/zip',
+                    headers={"Content-Disposition": "attachment;filename=datos_granja.zip"})
+
+# Exportación masiva con COPY: ?formato=csv|parquet&gzip=1&desde=AAAA-MM-DD&hasta=AAAA-MM-DD
+@app.route('/exportar/<tabla>')
+def exportar_copia(tabla):
+    if tabla not in LISTADOS_ANALISIS:
+        return jsonify({'error': f'Tabla desconocida: {tabla}'}), 404
+
+    formato = request.args.get('formato', 'csv')
+    try:
+        desde = parsear_fecha_filtro(request.args['desde'], 'desde') if request.args.get('desde') else None
+        hasta = parsear_fecha_filtro(request.args['hasta'], 'hasta') if request.args.get('hasta') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if formato == 'parquet':
+        if pa is None:
+            return jsonify({'error': 'La exportación a Parquet requiere pyarrow'}), 501
+        fd, ruta = tempfile.mkstemp(prefix=f'{tabla}_', suffix='.parquet')
+        os.close(fd)
+        try:
+            escribir_parquet(tabla, ruta, desde, hasta)
+        except Exception as e:
+            os.remove(ruta)
+            app.logger.error(f"Error exportando {tabla} a Parquet", exc_info=e)
+            return jsonify({'error': str(e)}), 500
+        return Response(enviar_archivo_temporal(ruta), mimetype='application/vnd.apache.parquet',
+                        headers={"Content-Disposition": f"attachment;filename={tabla}.parquet",
+                                 "Content-Length": str(os.path.getsize(ruta))})
+
+    if formato != 'csv':
+        return jsonify({'error': 'formato debe ser csv o parquet'}), 400
+
+    comprimir = request.args.get('gzip') == '1'
+    nombre = f"{tabla}.csv.gz" if comprimir else f"{tabla}.csv"
+    return Response(copiar_tabla_stream(tabla, desde, hasta, comprimir),
+                    mimetype='application/gzip' if comprimir else 'text/csv; charset=utf-8',
+                    headers={"Content-Disposition": f"attachment;filename={nombre}"})
+
+@app.cli.command('exportar-copia')
+@click.argument('tablas', nargs=-1)
+@click.option('--directorio', default='.', show_default=True, help='Carpeta de salida')
+@click.option('--formato', type=click.Choice(['csv', 'parquet']), default='csv', show_default=True)
+@click.option('--gzip', 'comprimir', is_flag=True, help='Comprimir los CSV con gzip')
+@click.option('--desde', default=None, help='Fecha inicial AAAA-MM-DD')
+@click.option('--hasta', default=None, help='Fecha final AAAA-MM-DD (inclusive)')
+def exportar_copia_comando(tablas, directorio, formato, comprimir, desde, hasta):
+    """Exportar tablas con COPY (todas si no se indican)"""
+    tablas = tablas or tuple(tabla for tabla, _ in TABLAS_EXPORTACION)
+    desconocidas = [tabla for tabla in tablas if tabla not in LISTADOS_ANALISIS]
+    if desconocidas:
+        raise click.BadParameter(f"Tablas desconocidas: {', '.join(desconocidas)}")
+    desde = parsear_fecha_filtro(desde, 'desde') if desde else None
+    hasta = parsear_fecha_filtro(hasta, 'hasta') if hasta else None
+
+    os.makedirs(directorio, exist_ok=True)
+    for tabla in tablas:
+        inicio = time.monotonic()
+        if formato == 'parquet':
+            ruta = os.path.join(directorio, f'{tabla}.parquet')
+            escribir_parquet(tabla, ruta, desde, hasta)
+        else:
+            ruta = os.path.join(directorio, f"{tabla}.csv{'.gz' if comprimir else ''}")
+            with (gzip.open(ruta, 'wb') if comprimir else open(ruta, 'wb')) as destino:
+                copiar_tabla(tabla, destino, desde, hasta)
+        print(f"✅ {ruta} ({os.path.getsize(ruta)} bytes, {time.monotonic() - inicio:.1f}s)")
+
 # Ruta para health check
 @app.route('/health')
 def health_check():
@@ -1666,9 +3770,12 @@ def predicciones():
         try:
             # Obtener el número de meses a predecir desde el formulario
             meses_a_predecir = int(request.form['meses_a_predecir'])
+            if not 1 <= meses_a_predecir <= PREDICCION_MAX_MESES:
+                flash(f'El horizonte debe estar entre 1 y {PREDICCION_MAX_MESES} meses.', 'warning')
+                return redirect(url_for('predicciones'))
 
-            # Entrenar los modelos
-            modelo_mortalidad, modelo_nacimientos, modelo_ganancias = entrenar_modelos()
+            # Modelos del registro (solo se reentrenan si cambiaron los datos)
+            modelo_mortalidad, modelo_nacimientos, modelo_ganancias = obtener_modelos()
 
             # Verificar si los modelos se entrenaron correctamente
             modelos_entrenados = 0
@@ -1683,41 +3790,18 @@ def predicciones():
                 flash('No hay suficientes datos históricos para generar predicciones. Se necesitan al menos 2 meses de datos.', 'warning')
                 return redirect(url_for('predicciones'))
 
-            # Crear fechas futuras para la predicción
-            ultima_fecha = pd.to_datetime('now')  # Fecha actual
-            fechas_futuras = pd.date_range(start=ultima_fecha, periods=meses_a_predecir, freq='M')
-            
-            predicciones = []
-            for i, fecha in enumerate(fechas_futuras):
-                mes_num = i + 1  # Meses futuros desde el presente
-                
-                prediccion = {
-                    'mes': fecha.strftime('%Y-%m'),
-                    'prediccion_mortalidad': 0,
-                    'prediccion_nacimientos': 0,
-                    'prediccion_ganancias': 0
+            # Todos los meses de cada modelo en una sola llamada a predict
+            horizonte = predecir_horizonte((modelo_mortalidad, modelo_nacimientos, modelo_ganancias), meses_a_predecir)
+            predicciones = [
+                {
+                    'mes': mes,
+                    'prediccion_mortalidad': mortalidad,
+                    'prediccion_nacimientos': nacimientos,
+                    'prediccion_ganancias': ganancias
                 }
-                
-                # Realizar predicciones solo si los modelos están disponibles
-                if modelo_mortalidad is not None:
-                    try:
-                        prediccion['prediccion_mortalidad'] = max(0, float(modelo_mortalidad.predict([[mes_num]])[0]))
-                    except:
-                        prediccion['prediccion_mortalidad'] = 0
-                
-                if modelo_nacimientos is not None:
-                    try:
-                        prediccion['prediccion_nacimientos'] = max(0, float(modelo_nacimientos.predict([[mes_num]])[0]))
-                    except:
-                        prediccion['prediccion_nacimientos'] = 0
-                
-                if modelo_ganancias is not None:
-                    try:
-                        prediccion['prediccion_ganancias'] = max(0, float(modelo_ganancias.predict([[mes_num]])[0]))
-                    except:
-                        prediccion['prediccion_ganancias'] = 0
-                
-                predicciones.append(prediccion)
+                for mes, mortalidad, nacimientos, ganancias in zip(
+                    horizonte['meses'], horizonte['mortalidad'], horizonte['nacimientos'], horizonte['ganancias'])
+            ]
 
             # Informar al usuario sobre los modelos que se pudieron entrenar
             mensaje_modelos = []
@@ -1744,30 +3828,118 @@ def predicciones():
 
 # Agregar estas rutas después de las rutas existentes en app.py
 
+@app.route('/api/predicciones')
+def api_predicciones():
+    """Predicciones en JSON: ?meses=N para la granja, con galpon/poza/metrica por poza"""
+    try:
+        meses = int(request.args.get('meses', 12))
+    except ValueError:
+        return jsonify({'error': 'meses debe ser un número entero'}), 400
+    if not 1 <= meses <= PREDICCION_MAX_MESES:
+        return jsonify({'error': f'meses debe estar entre 1 y {PREDICCION_MAX_MESES}'}), 400
+
+    galpon = request.args.get('galpon') or None
+    poza = request.args.get('poza') or None
+    metrica = request.args.get('metrica') or None
+    if galpon or poza or metrica:
+        if metrica and metrica not in METRICAS_POZA:
+            return jsonify({'error': f"metrica debe ser una de: {', '.join(METRICAS_POZA)}"}), 400
+        return jsonify(predecir_series_poza(obtener_modelos_poza(), meses, galpon, poza, metrica))
+
+    modelos = obtener_modelos()
+    horizonte = predecir_horizonte(modelos, meses)
+    horizonte['disponibles'] = [metrica for metrica, modelo in zip(METRICAS_PREDICCION, modelos) if modelo is not None]
+    return jsonify(horizonte)
+
+@app.route('/api/catalogo')
+def api_catalogo():
+    """Galpones y pozas para los formularios; el navegador revalida con ETag"""
+    catalogo = obtener_catalogo_pozas()
+    respuesta = jsonify({
+        'galpones': catalogo['galpones'],
+        'pozas': catalogo['galpones_pozas'],
+    })
+    respuesta.set_etag(catalogo['etag'])
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    return respuesta.make_conditional(request)
+
+@app.route('/api/v1/eventos/batch', methods=['POST'])
+def api_eventos_batch():
+    """Registrar un lote de eventos enviados por los dispositivos de campo"""
+    datos = request.get_json(silent=True)
+    eventos = datos.get('eventos') if isinstance(datos, dict) else datos
+    if not isinstance(eventos, list):
+        return jsonify({'error': 'Se esperaba {"eventos": [...]} o una lista de eventos'}), 400
+    if len(eventos) > EVENTOS_LOTE_MAX:
+        return jsonify({'error': f'El lote admite hasta {EVENTOS_LOTE_MAX} eventos'}), 413
+
+    try:
+        resultados = registrar_lote_eventos(eventos)
+    except psycopg2.Error as e:
+        app.logger.error("Error al registrar lote de eventos", exc_info=e)
+        return jsonify({'error': 'Error en la base de datos; reintentar el lote'}), 503
+
+    estados = [resultado['estado'] for resultado in resultados]
+    return jsonify({
+        'creados': estados.count('creado'),
+        'duplicados': estados.count('duplicado'),
+        'errores': estados.count('error'),
+        'resultados': resultados
+    })
+
 @app.route('/api/notificaciones')
 def obtener_notificaciones():
     """Obtener notificaciones no leídas"""
     try:
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                cursor.execute('''
-                    SELECT * FROM notificaciones 
-                    WHERE leida = FALSE 
-                    ORDER BY 
-                        CASE prioridad 
-                            WHEN 'urgente' THEN 1
-                            WHEN 'alta' THEN 2
-                            WHEN 'media' THEN 3
-                            ELSE 4
-                        END,
-                    fecha_creacion DESC
-                    LIMIT 20
-                ''')
-                notificaciones = cursor.fetchall()
-                return jsonify([dict(notif) for notif in notificaciones])
+                return jsonify(listar_notificaciones_pendientes(cursor))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/notificaciones/stream')
+def stream_notificaciones():
+    """Canal SSE: envía las pendientes al conectar y cada vez que cambian"""
+    ultima_version = request.headers.get('Last-Event-ID') or request.args.get('ultimo')
+    if not _cupos_sse.acquire(blocking=False):
+        return jsonify({'error': 'Demasiados streams abiertos; use /api/notificaciones'}), 503, \
+            {'Retry-After': str(max(1, SSE_REINTENTO_MS // 1000))}
+
+    def eventos(ultima_version):
+        fin = time.monotonic() + SSE_DURACION_MAX
+        # Suscribirse antes de leer la instantánea para no perder cambios intermedios
+        cola = suscribir_notificaciones()
+        try:
+            yield f"retry: {SSE_REINTENTO_MS}\n\n"
+            # Al reconectar con Last-Event-ID solo se reenvía si hubo cambios
+            version, datos = obtener_instantanea_notificaciones()
+            if version != ultima_version:
+                yield formatear_evento_sse(version, datos)
+                ultima_version = version
+
+            while time.monotonic() < fin:
+                try:
+                    version, datos = cola.get(timeout=min(SSE_HEARTBEAT, max(0, fin - time.monotonic())))
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if version != ultima_version:
+                    yield formatear_evento_sse(version, datos)
+                    ultima_version = version
+        finally:
+            cancelar_suscripcion_notificaciones(cola)
+
+    try:
+        respuesta = Response(stream_with_context(eventos(ultima_version)), mimetype='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    except Exception:
+        _cupos_sse.release()
+        raise
+    # El servidor cierra la respuesta al terminar el stream o al desconectarse el navegador
+    respuesta.call_on_close(_cupos_sse.release)
+    return respuesta
+
 @app.route('/api/notificaciones/<int:notificacion_id>/leer', methods=['POST'])
 def marcar_notificacion_leida(notificacion_id):
     """Marcar notificación como leída"""
@@ -1777,6 +3949,7 @@ def marcar_notificacion_leida(notificacion_id):
                 cursor.execute('''
                     UPDATE notificaciones SET leida = TRUE WHERE id = %s
                 ''', (notificacion_id,))
+                avisar_cambio_notificaciones(cursor)
                 conn.commit()
                 return jsonify({'success': True})
     except Exception as e:
@@ -1789,6 +3962,7 @@ def marcar_todas_leidas():
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('UPDATE notificaciones SET leida = TRUE')
+                avisar_cambio_notificaciones(cursor)
                 conn.commit()
                 return jsonify({'success': True})
     except Exception as e:
@@ -1796,14 +3970,18 @@ def marcar_todas_leidas():
 
 @app.route('/api/notificaciones/generar', methods=['POST'])
 def generar_notificaciones():
-    """Forzar generación de notificaciones"""
+    """Solicitar una generación inmediata al programador (no bloquea la petición)"""
     try:
-        notificaciones = generar_todas_las_notificaciones()
-        return jsonify({
-            'success': True,
-            'generadas': len(notificaciones),
-            'notificaciones': notificaciones
-        })
+        solicitar_generacion_notificaciones()
+        return jsonify({'success': True, 'encolada': True}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/notificaciones/estado')
+def estado_notificaciones():
+    """Estado de la última ejecución del programador de notificaciones"""
+    try:
+        return jsonify(obtener_estado_programador())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,16 @@
+# Configuración de gunicorn (se carga automáticamente desde el directorio de trabajo)
+import os
+
+# Workers con hilos: /api/notificaciones/stream mantiene conexiones abiertas
+# y cada una ocupa un hilo, no un proceso completo. app.py admite a lo sumo
+# SSE_MAX_STREAMS streams por worker (4 de los 16 hilos); el resto de las
+# pestañas recibe 503 y consulta /api/notificaciones. Con un worker asíncrono
+# (GUNICORN_WORKER_CLASS=gevent, requiere instalar gevent) los streams no ocupan
+# hilos y se puede subir SSE_MAX_STREAMS.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Los streams SSE envían un heartbeat periódico; el timeout solo vigila que el worker responda
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+keepalive = 75
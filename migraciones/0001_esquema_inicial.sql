@@ -0,0 +1,120 @@
+-- Esquema inicial: las tablas de la aplicación original, que antes se creaban al
+-- arrancar cada worker. Los objetos agregados después (inventario, índices de
+-- notificaciones, tareas programadas, fechas no convertidas) tienen su propia
+-- migración. Usa IF NOT EXISTS para que las bases existentes queden registradas
+-- sin cambios.
+
+CREATE TABLE IF NOT EXISTS reproductores (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    hembras INTEGER NOT NULL,
+    machos INTEGER NOT NULL,
+    tiempo_reproductores INTEGER NOT NULL,
+    fecha_ingreso TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS partos (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    numero_parto INTEGER NOT NULL,
+    nacidos INTEGER NOT NULL,
+    muertos_bebes INTEGER NOT NULL,
+    muertos_reproductores INTEGER NOT NULL,
+    fecha_nacimiento TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS destetes (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    destetados_hembras INTEGER NOT NULL,
+    destetados_machos INTEGER NOT NULL,
+    fecha_destete TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS muertes_destetados (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    muertos_hembras INTEGER NOT NULL,
+    muertos_machos INTEGER NOT NULL,
+    fecha_muerte TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ventas_destetados (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    hembras_vendidas INTEGER NOT NULL,
+    machos_vendidos INTEGER NOT NULL,
+    costo_venta REAL NOT NULL,
+    fecha_venta TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ventas_descarte (
+    id SERIAL PRIMARY KEY,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    cuyes_vendidos INTEGER NOT NULL,
+    costo_venta REAL NOT NULL,
+    fecha_venta TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS ventas (
+    id SERIAL PRIMARY KEY,
+    tipo_venta VARCHAR(20) NOT NULL CHECK (tipo_venta IN ('destetados', 'descarte')),
+    galpon VARCHAR(50),
+    poza VARCHAR(50),
+    hembras_vendidas INTEGER DEFAULT 0,
+    machos_vendidos INTEGER DEFAULT 0,
+    costo_total DECIMAL(10, 2) NOT NULL,
+    fecha_venta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    mover_engorde BOOLEAN DEFAULT FALSE,
+    engorde_galpon VARCHAR(50),
+    engorde_poza VARCHAR(50),
+    fecha_movimiento DATE,
+    dias_engorde INTEGER,
+    observaciones TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS gastos (
+    id SERIAL PRIMARY KEY,
+    descripcion TEXT NOT NULL,
+    monto REAL NOT NULL,
+    tipo TEXT NOT NULL,
+    fecha_gasto TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS notificaciones (
+    id SERIAL PRIMARY KEY,
+    tipo VARCHAR(50) NOT NULL,
+    titulo VARCHAR(200) NOT NULL,
+    mensaje TEXT NOT NULL,
+    prioridad VARCHAR(20) CHECK (prioridad IN ('baja', 'media', 'alta', 'urgente')),
+    leida BOOLEAN DEFAULT FALSE,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    fecha_vencimiento TIMESTAMP,
+    relacion_id INTEGER,
+    relacion_tipo VARCHAR(50)
+);
+
+CREATE TABLE IF NOT EXISTS configuraciones_alertas (
+    id SERIAL PRIMARY KEY,
+    tipo_alerta VARCHAR(50) UNIQUE NOT NULL,
+    dias_antes INTEGER DEFAULT 0,
+    activa BOOLEAN DEFAULT TRUE,
+    parametros JSONB
+);
+
+-- Configuraciones predeterminadas
+INSERT INTO configuraciones_alertas (tipo_alerta, dias_antes, parametros)
+VALUES
+    ('destete', 15, '{"dias_min": 15, "dias_max": 20}'),
+    ('descarte', 360, '{"meses_min": 12}'),
+    ('vacunacion', 0, '{"intervalo_dias": 90}'),
+    ('control_peso', 30, '{}'),
+    ('parto_proximo', 70, '{"dias_gestacion": 70}')
+ON CONFLICT (tipo_alerta) DO NOTHING;
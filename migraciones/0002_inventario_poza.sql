@@ -0,0 +1,16 @@
+-- Inventario acumulado por galpón/poza (se mantiene en cada registro).
+-- Antes se creaba al arrancar cada worker; IF NOT EXISTS deja intactas las
+-- bases que ya la tienen.
+
+CREATE TABLE IF NOT EXISTS inventario_poza (
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    reproductores INTEGER NOT NULL DEFAULT 0,
+    reproductores_total INTEGER NOT NULL DEFAULT 0,
+    nacidos INTEGER NOT NULL DEFAULT 0,
+    destetados INTEGER NOT NULL DEFAULT 0,
+    muertos INTEGER NOT NULL DEFAULT 0,
+    vendidos INTEGER NOT NULL DEFAULT 0,
+    actualizado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (galpon, poza)
+);
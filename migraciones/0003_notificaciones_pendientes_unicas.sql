@@ -0,0 +1,33 @@
+-- Índices parciales sobre las notificaciones no leídas. Antes se creaban al
+-- arrancar cada worker; IF NOT EXISTS deja intactas las bases que ya los tienen.
+
+-- Antes de crear los índices únicos, marcar como leídas las alertas
+-- pendientes duplicadas (se conserva la más reciente)
+UPDATE notificaciones SET leida = TRUE
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY relacion_tipo, COALESCE(relacion_id::text, titulo)
+            ORDER BY fecha_creacion DESC, id DESC
+        ) AS n
+        FROM notificaciones
+        WHERE leida = FALSE
+    ) duplicadas
+    WHERE n > 1
+);
+
+-- Una sola alerta pendiente por entidad relacionada
+CREATE UNIQUE INDEX IF NOT EXISTS notificaciones_pendiente_relacion_uq
+ON notificaciones (relacion_tipo, relacion_id)
+WHERE leida = FALSE;
+
+-- Las alertas sin entidad (salud) se identifican por su título
+CREATE UNIQUE INDEX IF NOT EXISTS notificaciones_pendiente_titulo_uq
+ON notificaciones (relacion_tipo, titulo)
+WHERE leida = FALSE AND relacion_id IS NULL;
+
+-- Listado de /api/notificaciones: pendientes por prioridad y fecha.
+-- La expresión debe coincidir con RANGO_PRIORIDAD_SQL en app.py
+CREATE INDEX IF NOT EXISTS notificaciones_pendientes_idx
+ON notificaciones ((CASE prioridad WHEN 'urgente' THEN 1 WHEN 'alta' THEN 2 WHEN 'media' THEN 3 ELSE 4 END), fecha_creacion DESC)
+WHERE leida = FALSE;
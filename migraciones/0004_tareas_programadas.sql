@@ -0,0 +1,12 @@
+-- Estado de las tareas periódicas (programador de notificaciones).
+-- Antes se creaba al arrancar cada worker; IF NOT EXISTS deja intactas las
+-- bases que ya la tienen.
+
+CREATE TABLE IF NOT EXISTS tareas_programadas (
+    nombre VARCHAR(50) PRIMARY KEY,
+    ultima_ejecucion TIMESTAMP,
+    duracion_ms INTEGER,
+    generadas INTEGER,
+    error TEXT,
+    ejecutado_por VARCHAR(100)
+);
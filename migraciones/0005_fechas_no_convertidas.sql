@@ -0,0 +1,12 @@
+-- Registro de fechas que la migración de TEXT a TIMESTAMP no pudo interpretar.
+-- Antes se creaba al arrancar cada worker; IF NOT EXISTS deja intactas las
+-- bases que ya la tienen.
+
+CREATE TABLE IF NOT EXISTS fechas_no_convertidas (
+    id SERIAL PRIMARY KEY,
+    tabla TEXT NOT NULL,
+    columna TEXT NOT NULL,
+    fila_id INTEGER NOT NULL,
+    valor TEXT,
+    registrado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,40 @@
+-- sin-transaccion
+-- Índices para los accesos frecuentes. Se crean CONCURRENTLY para no bloquear
+-- escrituras durante el despliegue, por eso la migración corre sin transacción
+-- (las sentencias se separan por punto y coma: no usarlo en comentarios).
+
+-- Búsqueda de partos por galpón/poza y upsert por (galpon, poza, numero_parto)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS partos_poza_parto_idx
+ON partos (galpon, poza, numero_parto);
+
+-- Alertas de destete: partos nacidos en una ventana de días
+CREATE INDEX CONCURRENTLY IF NOT EXISTS partos_fecha_idx
+ON partos (fecha_nacimiento);
+
+-- Reproductores vigentes de una poza (el registro más reciente)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS reproductores_poza_idx
+ON reproductores (galpon, poza, fecha_ingreso, id);
+
+-- Eventos por poza en orden cronológico (exportación y listados)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS destetes_poza_fecha_idx
+ON destetes (galpon, poza, fecha_destete, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS muertes_destetados_poza_fecha_idx
+ON muertes_destetados (galpon, poza, fecha_muerte, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ventas_destetados_poza_fecha_idx
+ON ventas_destetados (galpon, poza, fecha_venta, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ventas_descarte_poza_fecha_idx
+ON ventas_descarte (galpon, poza, fecha_venta, id);
+
+-- Totales de hoy y del mes en destetes, alertas de salud de los últimos 7 días
+CREATE INDEX CONCURRENTLY IF NOT EXISTS destetes_fecha_idx
+ON destetes (fecha_destete);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS muertes_destetados_fecha_idx
+ON muertes_destetados (fecha_muerte);
+
+-- Estadísticas de ventas por tipo y período
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ventas_tipo_fecha_idx
+ON ventas (tipo_venta, fecha_venta);
@@ -0,0 +1,27 @@
+-- sin-transaccion
+-- Un solo registro por (galpon, poza, numero_parto): registrar_partos usa
+-- INSERT ... ON CONFLICT sobre esta restricción. Si hay duplicados la migración
+-- se detiene: unirlos antes con 'flask deduplicar-partos --aplicar'.
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM partos
+        GROUP BY galpon, poza, numero_parto
+        HAVING COUNT(*) > 1
+    ) THEN
+        RAISE EXCEPTION 'Hay partos duplicados por (galpon, poza, numero_parto): ejecute flask deduplicar-partos --aplicar';
+    END IF;
+END
+$$;
+
+-- Restos de un intento anterior interrumpido (índice inválido)
+DROP INDEX CONCURRENTLY IF EXISTS partos_poza_parto_uq;
+
+CREATE UNIQUE INDEX CONCURRENTLY partos_poza_parto_uq
+ON partos (galpon, poza, numero_parto);
+
+ALTER TABLE partos ADD CONSTRAINT partos_poza_parto_uq UNIQUE USING INDEX partos_poza_parto_uq;
+
+-- El índice no único de la migración 0006 queda cubierto por la restricción
+DROP INDEX CONCURRENTLY IF EXISTS partos_poza_parto_idx;
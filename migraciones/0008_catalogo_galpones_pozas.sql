@@ -0,0 +1,25 @@
+-- Catálogo de galpones y pozas para los formularios (antes se obtenía con
+-- SELECT DISTINCT sobre reproductores en cada petición). Se mantiene al
+-- ingresar o editar reproductores.
+
+CREATE TABLE IF NOT EXISTS galpones (
+    galpon TEXT PRIMARY KEY,
+    creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS pozas (
+    galpon TEXT NOT NULL REFERENCES galpones (galpon) ON DELETE CASCADE,
+    poza TEXT NOT NULL,
+    creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (galpon, poza)
+);
+
+INSERT INTO galpones (galpon)
+SELECT DISTINCT galpon FROM reproductores
+WHERE galpon IS NOT NULL AND galpon <> ''
+ON CONFLICT (galpon) DO NOTHING;
+
+INSERT INTO pozas (galpon, poza)
+SELECT DISTINCT galpon, poza FROM reproductores
+WHERE galpon IS NOT NULL AND galpon <> '' AND poza IS NOT NULL AND poza <> ''
+ON CONFLICT (galpon, poza) DO NOTHING;
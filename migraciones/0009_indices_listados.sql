@@ -0,0 +1,9 @@
+-- sin-transaccion
+-- Paginación por clave de los listados de análisis: el orden de cada listado
+-- coincide con un índice, así cada página lee solo sus filas.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS partos_poza_fecha_idx
+ON partos (galpon, poza, fecha_nacimiento, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS gastos_fecha_idx
+ON gastos (fecha_gasto, id);
@@ -0,0 +1,8 @@
+-- Claves de idempotencia de /api/v1/eventos/batch: los dispositivos sin
+-- conexión reintentan el mismo lote y cada evento debe registrarse una sola vez.
+
+CREATE TABLE IF NOT EXISTS eventos_recibidos (
+    clave TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    recibido TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,13 @@
+-- Totales mensuales por galpón/poza y métrica (antes /resultados y el
+-- entrenamiento agrupaban el historial completo en cada petición). Las rutas
+-- que registran eventos recalculan el mes afectado; 'flask migrar' la llena
+-- desde el historial si está vacía. Las métricas sin poza (gastos) usan ''.
+
+CREATE TABLE IF NOT EXISTS metricas_mensuales (
+    metrica TEXT NOT NULL,
+    mes DATE NOT NULL,
+    galpon TEXT NOT NULL,
+    poza TEXT NOT NULL,
+    valor NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (metrica, mes, galpon, poza)
+);
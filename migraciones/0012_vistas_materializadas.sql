@@ -0,0 +1,34 @@
+-- Flujo de caja mensual para /balance. Se refresca con REFRESH ... CONCURRENTLY
+-- desde el hilo de vistas de cada worker; el índice único es obligatorio para
+-- el refresco concurrente.
+--
+-- Es la única vista materializada: /resultados y el resumen de /analisis_datos
+-- leen metricas_mensuales (0011) e inventario_poza (0002), que cada escritura
+-- actualiza en su misma transacción. Vistas de mortalidad, nacimientos o
+-- inventario repetirían esos totales con la demora del refresco periódico.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_flujo_caja AS
+SELECT mes,
+       SUM(ventas_destetados)::float8 AS ventas_destetados,
+       SUM(ventas_descarte)::float8 AS ventas_descarte,
+       SUM(gastos)::float8 AS gastos
+FROM (
+    SELECT date_trunc('month', fecha_venta)::date AS mes, costo_venta AS ventas_destetados,
+           0 AS ventas_descarte, 0 AS gastos
+    FROM ventas_destetados
+    UNION ALL
+    SELECT date_trunc('month', fecha_venta)::date, 0, costo_venta, 0
+    FROM ventas_descarte
+    UNION ALL
+    SELECT date_trunc('month', fecha_gasto)::date, 0, 0, monto
+    FROM gastos
+) movimientos
+WHERE mes IS NOT NULL
+GROUP BY mes;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mv_flujo_caja_uq ON mv_flujo_caja (mes);
+
+-- La vista se crea con datos: queda registrado como primer refresco
+INSERT INTO tareas_programadas (nombre, ultima_ejecucion, generadas)
+VALUES ('vistas_materializadas', NOW(), 1)
+ON CONFLICT (nombre) DO UPDATE SET ultima_ejecucion = EXCLUDED.ultima_ejecucion;
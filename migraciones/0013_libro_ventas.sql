@@ -0,0 +1,62 @@
+-- sin-transaccion
+-- Libro único de ventas: las filas de las tablas antiguas ventas_destetados y
+-- ventas_descarte se copian a ventas por lotes de 5000 (cada lote se confirma
+-- aparte). origen_legado/origen_id identifican la fila copiada, así que volver
+-- a ejecutar el bloque no duplica ventas. Las tablas antiguas quedan como
+-- respaldo y la aplicación ya no las lee (no usar punto y coma en comentarios).
+-- Los vendidos de inventario_poza y las ventas de metricas_mensuales pasan a
+-- contar las filas copiadas: flask migrar las recalcula al terminar.
+-- reconstruir: inventario_poza, metricas_mensuales
+
+ALTER TABLE ventas ADD COLUMN IF NOT EXISTS origen_legado VARCHAR(20);
+
+ALTER TABLE ventas ADD COLUMN IF NOT EXISTS origen_id INTEGER;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ventas_origen_legado_uq
+ON ventas (origen_legado, origen_id) WHERE origen_legado IS NOT NULL;
+
+-- Listado de /analisis_datos (más recientes primero, paginado por fecha e id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ventas_fecha_id_idx
+ON ventas (fecha_venta, id);
+
+DO $$
+DECLARE
+    ultimo INTEGER;
+    copiadas INTEGER;
+BEGIN
+    ultimo := 0;
+    LOOP
+        WITH lote AS (
+            SELECT * FROM ventas_destetados WHERE id > ultimo ORDER BY id LIMIT 5000
+        ), insertadas AS (
+            INSERT INTO ventas (tipo_venta, galpon, poza, hembras_vendidas, machos_vendidos,
+                                costo_total, fecha_venta, origen_legado, origen_id)
+            SELECT 'destetados', galpon, poza, hembras_vendidas, machos_vendidos,
+                   costo_venta, fecha_venta, 'ventas_destetados', id
+            FROM lote
+            ON CONFLICT (origen_legado, origen_id) WHERE origen_legado IS NOT NULL DO NOTHING
+        )
+        SELECT MAX(id), COUNT(*) INTO ultimo, copiadas FROM lote;
+        EXIT WHEN copiadas = 0;
+        COMMIT;
+    END LOOP;
+
+    ultimo := 0;
+    LOOP
+        WITH lote AS (
+            SELECT * FROM ventas_descarte WHERE id > ultimo ORDER BY id LIMIT 5000
+        ), insertadas AS (
+            -- Igual que el formulario: los cuyes de descarte van en machos_vendidos
+            INSERT INTO ventas (tipo_venta, galpon, poza, hembras_vendidas, machos_vendidos,
+                                costo_total, fecha_venta, origen_legado, origen_id)
+            SELECT 'descarte', galpon, poza, 0, cuyes_vendidos,
+                   costo_venta, fecha_venta, 'ventas_descarte', id
+            FROM lote
+            ON CONFLICT (origen_legado, origen_id) WHERE origen_legado IS NOT NULL DO NOTHING
+        )
+        SELECT MAX(id), COUNT(*) INTO ultimo, copiadas FROM lote;
+        EXIT WHEN copiadas = 0;
+        COMMIT;
+    END LOOP;
+END
+$$;
@@ -0,0 +1,26 @@
+-- Las agregaciones de ventas pasan a leer el libro único (migración 0013).
+
+-- Flujo de caja: una sola lectura de ventas separando los tipos con FILTER
+DROP MATERIALIZED VIEW IF EXISTS mv_flujo_caja;
+
+CREATE MATERIALIZED VIEW mv_flujo_caja AS
+SELECT mes,
+       SUM(ventas_destetados)::float8 AS ventas_destetados,
+       SUM(ventas_descarte)::float8 AS ventas_descarte,
+       SUM(gastos)::float8 AS gastos
+FROM (
+    SELECT date_trunc('month', fecha_venta)::date AS mes,
+           COALESCE(SUM(costo_total) FILTER (WHERE tipo_venta = 'destetados'), 0) AS ventas_destetados,
+           COALESCE(SUM(costo_total) FILTER (WHERE tipo_venta = 'descarte'), 0) AS ventas_descarte,
+           0 AS gastos
+    FROM ventas
+    GROUP BY 1
+    UNION ALL
+    SELECT date_trunc('month', fecha_gasto)::date, 0, 0, SUM(monto)
+    FROM gastos
+    GROUP BY 1
+) movimientos
+WHERE mes IS NOT NULL
+GROUP BY mes;
+
+CREATE UNIQUE INDEX mv_flujo_caja_uq ON mv_flujo_caja (mes);
@@ -0,0 +1,15 @@
+-- sin-transaccion
+-- /api/balance suma ventas y gastos por rango de fechas. Los índices por fecha
+-- incluyen las columnas sumadas para resolverlo con un index-only scan y
+-- reemplazan a los de los listados (misma clave, el orden por fecha e id se
+-- mantiene). Se crean antes de borrar los anteriores para no quedar sin índice.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ventas_fecha_balance_idx
+ON ventas (fecha_venta, id) INCLUDE (tipo_venta, costo_total);
+
+DROP INDEX CONCURRENTLY IF EXISTS ventas_fecha_id_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS gastos_fecha_balance_idx
+ON gastos (fecha_gasto, id) INCLUDE (monto);
+
+DROP INDEX CONCURRENTLY IF EXISTS gastos_fecha_idx;
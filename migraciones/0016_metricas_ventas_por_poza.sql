@@ -0,0 +1,7 @@
+-- reconstruir: metricas_mensuales
+-- Las métricas de ventas pasan a guardarse por galpón y poza (los modelos por
+-- poza las leen de metricas_mensuales). Se borran las filas anteriores, que
+-- tenían galpon y poza '': la marca de arriba hace que flask migrar
+-- reconstruya metricas_mensuales desde el historial al terminar.
+
+DELETE FROM metricas_mensuales WHERE metrica IN ('ventas_destetados', 'ventas_descarte');
@@ -0,0 +1,7 @@
+-- reconstruir: metricas_mensuales
+-- Métrica nueva 'vendidos_destetados' (cuyes vendidos por mes y poza): /ventas
+-- lee de aquí el total histórico en lugar de recorrer el libro completo. Se
+-- borran las filas que hayan escrito los workers antes de migrar; la marca de
+-- arriba hace que flask migrar reconstruya metricas_mensuales al terminar.
+
+DELETE FROM metricas_mensuales WHERE metrica = 'vendidos_destetados';
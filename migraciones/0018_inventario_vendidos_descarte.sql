@@ -0,0 +1,6 @@
+-- reconstruir: inventario_poza
+-- inventario_poza.vendidos cuenta solo las ventas de descarte (VENDIDOS_INVENTARIO
+-- en app.py). Las reconstrucciones anteriores sumaban también las ventas de
+-- destetados antiguas con galpón y poza: la marca de arriba recalcula la tabla.
+
+SELECT 1;
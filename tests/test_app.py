@@ -13,4 +13,431 @@ def client():
 
 def test_health_check(client):
     response = client.get('/health')
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+class ConexionFalsa:
+    def __init__(self):
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class PoolFalso:
+    def __init__(self, conexiones):
+        self.libres = list(conexiones)
+        self.devueltas = []
+
+    def getconn(self):
+        return self.libres.pop(0)
+
+    def putconn(self, conn, close=False):
+        self.devueltas.append((conn, close))
+
+
+@pytest.fixture
+def pool_falso(monkeypatch):
+    import threading
+    import app as modulo
+
+    def instalar(conexiones):
+        pool = PoolFalso(conexiones)
+        monkeypatch.setattr(modulo, '_pool', pool)
+        monkeypatch.setattr(modulo, '_pool_pid', os.getpid())
+        monkeypatch.setattr(modulo, '_pool_cupos', threading.BoundedSemaphore(2))
+        return pool
+    return instalar
+
+
+def test_get_db_connection_devuelve_conexion_al_pool(pool_falso):
+    conn = ConexionFalsa()
+    pool = pool_falso([conn])
+
+    with get_db_connection() as c:
+        assert c is conn
+
+    assert conn.commits == 1
+    assert pool.devueltas == [(conn, False)]
+
+
+def test_get_db_connection_descarta_conexiones_rotas(pool_falso):
+    rota, sana = ConexionFalsa(), ConexionFalsa()
+    rota.closed = 2
+    pool = pool_falso([rota, sana])
+
+    with pytest.raises(RuntimeError):
+        with get_db_connection() as c:
+            assert c is sana
+            raise RuntimeError('fallo dentro de la transacción')
+
+    assert sana.rollbacks == 1
+    assert pool.devueltas == [(rota, True), (sana, False)]
+
+
+def test_conexion_descartada_no_conserva_sus_tiempos(pool_falso, monkeypatch):
+    import time
+    import weakref
+    import app as modulo
+
+    vieja, nueva = ConexionFalsa(), ConexionFalsa()
+    monkeypatch.setattr(modulo, '_pool_tiempos', weakref.WeakKeyDictionary())
+    modulo._pool_tiempos[vieja] = (time.monotonic() - modulo.DB_POOL_VIDA_MAXIMA - 1, time.monotonic())
+    pool = pool_falso([vieja, nueva])
+
+    with get_db_connection() as c:
+        assert c is nueva
+
+    # La conexión reciclada sale del registro; la nueva empieza con sus propios tiempos
+    assert pool.devueltas == [(vieja, True), (nueva, False)]
+    assert list(modulo._pool_tiempos) == [nueva]
+
+
+def test_resolver_expresiones_esquema_columnas_antiguas():
+    from app import resolver_expresiones_esquema
+
+    catalogo = resolver_expresiones_esquema({
+        'partos': ['id', 'galpon', 'poza', 'crias_nacidas_hembras', 'crias_nacidas_machos', 'muertos_bebes'],
+        'muertes_destetados': ['id', 'muertos_hembras', 'muertos_machos'],
+        'reproductores': ['id', 'galpon', 'poza', 'fecha_ingreso'],
+    })
+
+    assert catalogo['nacidos'] == 'crias_nacidas_hembras + crias_nacidas_machos'
+    assert catalogo['muertos_partos'] == 'COALESCE(muertos_bebes, 0)'
+    assert catalogo['muertos_destetados'] == 'muertos_hembras + muertos_machos'
+    assert catalogo['orden_reproductores'] == 'fecha_ingreso'
+    assert resolver_expresiones_esquema({})['nacidos'] is None
+
+
+def test_armar_datos_dashboard_deriva_totales():
+    from app import armar_datos_dashboard
+
+    datos = armar_datos_dashboard([
+        ('10', '2', 12, 12, 0, 0, 0, 0),
+        ('2', '1', 30, 10, 20, 9, 3, 4),
+    ])
+
+    assert list(datos['datos_galpones']) == ['2', '10']
+    assert datos['datos_galpones']['2']['1']['nacidos_vigentes'] == 8
+    assert datos['datos_galpones']['2']['1']['vendidos'] == 4
+    assert datos['total_reproductores'] == 42
+    assert datos['nacidos_actuales'] == 11
+    assert datos['total_muertos'] == 3
+    assert datos['total_reproductores_por_galpon'] == {'2': 10, '10': 12}
+
+
+def test_solicitar_generacion_despierta_al_programador(monkeypatch):
+    import threading
+    import app as modulo
+
+    evento = threading.Event()
+    monkeypatch.setattr(modulo, 'iniciar_programador', lambda: evento)
+    monkeypatch.setitem(modulo._programador, 'forzar', False)
+
+    modulo.solicitar_generacion_notificaciones()
+
+    assert evento.is_set()
+    assert modulo._programador['forzar'] is True
+
+
+def test_stream_notificaciones_rechaza_sin_cupo(client, monkeypatch):
+    import threading
+    import app as modulo
+
+    cupos = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(modulo, '_cupos_sse', cupos)
+    cupos.acquire()
+
+    respuesta = client.get('/api/notificaciones/stream')
+    assert respuesta.status_code == 503
+    assert respuesta.headers['Retry-After'] == '5'
+    cupos.release()
+
+
+def test_stream_notificaciones_envia_cambios_y_libera_el_cupo(client, monkeypatch):
+    import threading
+    import app as modulo
+
+    cupos = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(modulo, '_cupos_sse', cupos)
+    monkeypatch.setattr(modulo, 'iniciar_escucha_notificaciones', lambda: None)
+    monkeypatch.setattr(modulo, 'obtener_instantanea_notificaciones', lambda: ('v1', '[]'))
+
+    respuesta = client.get('/api/notificaciones/stream')
+    assert respuesta.status_code == 200
+    fragmentos = iter(respuesta.response)
+    assert next(fragmentos) == b'retry: 5000\n\n'
+    assert next(fragmentos) == b'id: v1\nevent: notificaciones\ndata: []\n\n'
+
+    # Mientras el stream está abierto ocupa el único cupo
+    assert not cupos.acquire(blocking=False)
+    cola, = modulo._suscriptores
+    cola.put(('v2', '[{"id": 1}]'))
+    assert next(fragmentos) == b'id: v2\nevent: notificaciones\ndata: [{"id": 1}]\n\n'
+
+    respuesta.close()
+    assert not modulo._suscriptores
+    assert cupos.acquire(blocking=False)
+
+
+def test_difundir_notificaciones_deja_solo_la_ultima_instantanea(monkeypatch):
+    import queue
+    import app as modulo
+
+    colas = [queue.Queue(maxsize=1), queue.Queue(maxsize=1)]
+    colas[0].put(('vieja', '[]'))
+    monkeypatch.setattr(modulo, '_suscriptores', set(colas))
+    monkeypatch.setattr(modulo, 'obtener_instantanea_notificaciones', lambda: ('v3', '[3]'))
+
+    modulo._difundir_notificaciones()
+    assert [cola.get_nowait() for cola in colas] == [('v3', '[3]'), ('v3', '[3]')]
+
+
+def test_parsear_fecha_legada_formatos():
+    from datetime import datetime
+    from app import parsear_fecha_legada
+
+    assert parsear_fecha_legada('2024-01-05') == datetime(2024, 1, 5)
+    assert parsear_fecha_legada('2024-01-05 10:30:00') == datetime(2024, 1, 5, 10, 30)
+    assert parsear_fecha_legada('15/03/2024') == datetime(2024, 3, 15)
+    assert parsear_fecha_legada('2024-01-05 10:30:00+02:00') == datetime(2024, 1, 5, 8, 30)
+    assert parsear_fecha_legada('basura') is None
+    assert parsear_fecha_legada('') is None
+
+
+def test_listar_migraciones_ordena_por_version(tmp_path):
+    from app import listar_migraciones
+
+    for archivo in ('0010_indices.sql', '0002_catalogo.sql', 'notas.txt', 'borrador.sql'):
+        (tmp_path / archivo).write_text('SELECT 1;')
+
+    assert [(v, n) for v, n, _ in listar_migraciones(str(tmp_path))] == [
+        (2, '0002_catalogo'), (10, '0010_indices'),
+    ]
+
+    (tmp_path / '0002_repetida.sql').write_text('SELECT 1;')
+    with pytest.raises(ValueError):
+        listar_migraciones(str(tmp_path))
+
+
+def test_sentencias_migracion_respeta_bloques_dolar():
+    from app import sentencias_migracion
+
+    sentencias = sentencias_migracion('''-- sin-transaccion
+-- comentario
+DO $$
+BEGIN
+    RAISE NOTICE 'uno';
+END
+$$;
+
+CREATE INDEX CONCURRENTLY a_idx ON a (b);
+''')
+
+    assert len(sentencias) == 2
+    assert sentencias[0].startswith('DO $$') and "RAISE NOTICE 'uno';" in sentencias[0]
+    assert sentencias[1] == 'CREATE INDEX CONCURRENTLY a_idx ON a (b)'
+
+
+def test_exportar_zip_stream_arma_csv_por_tabla(monkeypatch):
+    import io
+    import zipfile
+    from datetime import datetime
+    import app as modulo
+
+    lotes = {
+        'partos': [(['id', 'fecha'], [(1, datetime(2024, 1, 5, 8, 0))]), (['id', 'fecha'], [(2, None)])],
+        'gastos': [(['id', 'monto'], [])],
+    }
+    monkeypatch.setattr(modulo, 'leer_tabla_por_lotes', lambda tabla, lote=None: iter(lotes[tabla]))
+
+    contenido = b''.join(modulo.exportar_zip_stream((('partos', 'Partos'), ('gastos', 'Gastos'))))
+    archivo = zipfile.ZipFile(io.BytesIO(contenido))
+
+    assert archivo.namelist() == ['partos.csv', 'gastos.csv']
+    assert archivo.read('partos.csv').decode().splitlines() == ['id,fecha', '1,2024-01-05 08:00:00', '2,']
+    assert archivo.read('gastos.csv').decode().splitlines() == ['id,monto']
+
+
+def test_copiar_tabla_stream_comprime_en_gzip(monkeypatch):
+    import gzip
+    import app as modulo
+
+    def copiar(tabla, destino, desde=None, hasta=None):
+        destino.write(b'id,monto\n')
+        destino.write(b'1,10\n')
+
+    monkeypatch.setattr(modulo, 'copiar_tabla', copiar)
+
+    contenido = b''.join(modulo.copiar_tabla_stream('gastos', comprimir=True))
+    assert gzip.decompress(contenido) == b'id,monto\n1,10\n'
+
+
+def test_validar_fila_importacion_aplica_reglas_del_formulario():
+    from datetime import datetime
+    import pytest
+    import app as modulo
+
+    ahora = datetime(2024, 6, 1)
+    fila = {'galpon': ' 1 ', 'poza': '2', 'destetados_hembras': '3', 'destetados_machos': '0', 'fecha_destete': '15/03/2022'}
+    assert modulo.validar_fila_importacion('destetes', fila, ahora) == ('1', '2', 3, 0, datetime(2022, 3, 15))
+
+    sin_fecha = dict(fila, fecha_destete='')
+    assert modulo.validar_fila_importacion('destetes', sin_fecha, ahora)[-1] == ahora
+
+    with pytest.raises(ValueError, match='negativo'):
+        modulo.validar_fila_importacion('destetes', dict(fila, destetados_machos='-1'), ahora)
+    with pytest.raises(ValueError, match='al menos un animal'):
+        modulo.validar_fila_importacion('destetes', dict(fila, destetados_hembras='0'), ahora)
+    with pytest.raises(ValueError, match='entero'):
+        modulo.validar_fila_importacion('destetes', dict(fila, destetados_hembras='2.5'), ahora)
+
+    gasto = {'descripcion': 'Alfalfa', 'tipo': 'alimento', 'fecha_gasto': '2024-05-01'}
+    for monto in ('nan', 'inf', '-inf', '1e400', float('nan')):
+        with pytest.raises(ValueError, match='finito'):
+            modulo.validar_fila_importacion('gastos', dict(gasto, monto=monto), ahora)
+
+
+def test_lote_eventos_informa_errores_por_evento():
+    import app as modulo
+
+    resultados = modulo.registrar_lote_eventos([
+        'no es un objeto',
+        {'clave': 'c1', 'tipo': 'cosechas', 'datos': {}},
+        {'clave': 'c2', 'tipo': 'gastos', 'datos': {'descripcion': 'maíz', 'tipo': 'alimento', 'monto': -5}},
+    ])
+
+    assert [r['estado'] for r in resultados] == ['error', 'error', 'error']
+    assert resultados[1]['error'] == 'tipo desconocido: cosechas'
+    assert resultados[2] == {'indice': 2, 'clave': 'c2', 'estado': 'error', 'error': 'monto no puede ser negativo'}
+
+
+def test_registro_modelos_guarda_solo_la_huella_actual(tmp_path, monkeypatch):
+    import app as modulo
+
+    monkeypatch.setattr(modulo, 'MODELOS_DIR', str(tmp_path))
+    modulo._guardar_modelos('vieja', (None, 1, 2))
+    modulo._guardar_modelos('nueva', (None, 3, 4))
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['granja_nueva.joblib']
+    assert modulo._cargar_modelos('nueva') == (None, 3, 4)
+    assert modulo._cargar_modelos('vieja') is None
+
+
+def test_predecir_horizonte_vectorizado_recorta_negativos():
+    import pandas as pd
+    from sklearn.linear_model import LinearRegression
+    import app as modulo
+
+    X = pd.DataFrame({'mes_num': [0.0, 1.0, 2.0]})
+    creciente = LinearRegression().fit(X, [10, 20, 30])
+    decreciente = LinearRegression().fit(X, [3, 2, 1])
+
+    horizonte = modulo.predecir_horizonte((decreciente, creciente, None), 48)
+
+    assert len(horizonte['meses']) == 48
+    assert horizonte['nacimientos'][:2] == pytest.approx([20, 30])
+    assert horizonte['mortalidad'][:2] == pytest.approx([2, 1]) and min(horizonte['mortalidad']) == 0
+    assert horizonte['ganancias'] == [0.0] * 48
+
+
+def test_modelos_poza_ajustan_y_filtran_por_serie():
+    from datetime import datetime
+    import app as modulo
+
+    meses = [datetime(2024, m, 1) for m in (1, 2, 3)]
+    series = {
+        ('1', '1', 'nacimientos'): (meses, [10.0, 12.0, 14.0]),
+        ('1', '2', 'nacimientos'): (meses, [5.0, 5.0, 5.0]),
+        ('1', '3', 'nacimientos'): (meses[:1], [7.0]),   # un solo mes: sin modelo
+    }
+
+    modelos = modulo.ajustar_modelos_poza(series)
+    assert sorted(modelos) == [('1', '1', 'nacimientos'), ('1', '2', 'nacimientos')]
+
+    resultado = modulo.predecir_series_poza(modelos, 6, galpon='1', poza='2')
+    assert len(resultado['meses']) == 6
+    assert [s['poza'] for s in resultado['series']] == ['2']
+    assert resultado['series'][0]['valores'] == pytest.approx([5.0] * 6)
+
+
+def test_estado_vistas_marca_desactualizado_tras_escrituras(monkeypatch):
+    import app as modulo
+    from datetime import datetime
+
+    class CursorFalso:
+        def execute(self, sql, parametros=None):
+            pass
+
+        def fetchone(self):
+            return {'ultima_ejecucion': datetime(2024, 5, 1, 10, 30), 'antiguedad': 150.0}
+
+    monkeypatch.setattr(modulo, 'VISTAS_INTERVALO', 900)
+    monkeypatch.setitem(modulo._vistas, 'ultima_escritura', None)
+    estado = modulo.obtener_estado_vistas(CursorFalso())
+    assert estado == {'actualizado': '01/05/2024 10:30', 'minutos': 2, 'desactualizado': False}
+
+    monkeypatch.setitem(modulo._vistas, 'pid', os.getpid())
+    monkeypatch.setitem(modulo._vistas, 'ultima_escritura', 1.0)
+    assert modulo.obtener_estado_vistas(CursorFalso())['desactualizado'] is True
+
+
+def test_api_balance_valida_parametros(client):
+    respuesta = client.get('/api/balance?granularidad=anio')
+    assert respuesta.status_code == 400
+    assert 'granularidad' in respuesta.get_json()['error']
+
+    respuesta = client.get('/api/balance?desde=2024-05-01&hasta=2024-04-01')
+    assert respuesta.status_code == 400
+
+    respuesta = client.get('/api/balance?desde=2000-01-01&hasta=2024-01-01&granularidad=dia')
+    assert respuesta.status_code == 400
+
+
+def test_rango_balance_predeterminado_cubre_doce_meses():
+    from app import rango_balance_predeterminado
+    from datetime import datetime
+
+    assert rango_balance_predeterminado(datetime(2024, 5, 17, 9, 30)) == (datetime(2023, 6, 1), datetime(2024, 5, 17))
+    assert rango_balance_predeterminado(datetime(2024, 12, 3)) == (datetime(2024, 1, 1), datetime(2024, 12, 3))
+
+
+def test_api_balance_errores_de_base_son_500(client, monkeypatch):
+    import app as modulo
+
+    def sin_base():
+        raise ValueError('No se ha configurado DATABASE_URL')
+    monkeypatch.setattr(modulo, 'get_db_connection', sin_base)
+
+    respuesta = client.get('/api/balance?desde=2024-01-01&hasta=2024-03-31')
+    assert respuesta.status_code == 500
+
+
+def test_api_listado_rechaza_cursor_alterado(client):
+    import base64
+
+    def codificar(texto):
+        return base64.urlsafe_b64encode(texto.encode('utf-8')).decode('ascii')
+
+    for despues in ('WyIy', codificar('[1, 2]'), codificar('[[1], 2]'), codificar('{"a": 1}'), codificar('["x", 2]')):
+        respuesta = client.get(f'/api/analisis/gastos?despues={despues}')
+        assert respuesta.status_code == 400, despues
+        assert respuesta.get_json()['error'] == 'Cursor de paginación no válido'
+
+
+def test_lote_eventos_malformados_no_rompen_el_lote():
+    import app as modulo
+
+    resultados = modulo.registrar_lote_eventos([
+        {'clave': 'c1', 'tipo': ['gastos'], 'datos': {}},
+        {'clave': 'c2', 'tipo': 'gastos', 'datos': [1, 2]},
+        {'clave': 'c3', 'tipo': {'a': 1}, 'datos': {}},
+    ])
+
+    assert [r['estado'] for r in resultados] == ['error', 'error', 'error']
+    assert resultados[0]['error'] == "tipo desconocido: ['gastos']"
+    assert resultados[1]['error'] == 'datos debe ser un objeto'
@@ -0,0 +1,330 @@
+"""Pruebas contra PostgreSQL
+
+Cada prueba crea una base vacía, apunta DATABASE_URL y el pool de app.py a
+ella, aplica las migraciones y la elimina al terminar.
+Requiere DATABASE_URL apuntando a un PostgreSQL de pruebas.
+"""
+import json
+import os
+import queue
+import sys
+from datetime import date, datetime, timedelta
+from urllib.parse import urlparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import pytest
+
+import app as modulo
+
+BASE_PRUEBA = f'app_prueba_{os.getpid()}'
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='requiere DATABASE_URL')
+
+
+def hace_dias(dias):
+    return (date.today() - timedelta(days=dias)).isoformat()
+
+
+def sembrar_alertas(conn):
+    """Una camada para destetar, reproductores para descarte y mortalidad alta"""
+    with conn.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO partos (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento)
+            VALUES ('1', '1', 1, 4, 0, 0, %s)
+        ''', (hace_dias(17),))
+        cursor.execute('''
+            INSERT INTO reproductores (galpon, poza, hembras, machos, tiempo_reproductores, fecha_ingreso)
+            VALUES ('1', '2', 10, 2, 3, %s)
+        ''', (hace_dias(400),))
+        cursor.execute('''
+            INSERT INTO muertes_destetados (galpon, poza, muertos_hembras, muertos_machos, fecha_muerte)
+            VALUES ('1', '3', 3, 2, %s)
+        ''', (hace_dias(1),))
+    conn.commit()
+
+
+def tipos_notificaciones(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT tipo FROM notificaciones ORDER BY tipo')
+        return [fila[0] for fila in cursor.fetchall()]
+
+
+@pytest.fixture
+def base(monkeypatch):
+    """Base vacía con el esquema de la aplicación; devuelve una conexión propia"""
+    servidor = psycopg2.connect(os.environ['DATABASE_URL'])
+    servidor.autocommit = True
+    servidor.cursor().execute(f'DROP DATABASE IF EXISTS {BASE_PRUEBA} WITH (FORCE)')
+    servidor.cursor().execute(f'CREATE DATABASE {BASE_PRUEBA}')
+
+    url = urlparse(os.environ['DATABASE_URL'])
+    monkeypatch.setenv('DATABASE_URL', url._replace(path=f'/{BASE_PRUEBA}').geturl())
+    modulo.cerrar_pool()
+    modulo.invalidar_catalogo_esquema()
+    try:
+        modulo.aplicar_migraciones()
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        yield conn
+        conn.close()
+    finally:
+        modulo.cerrar_pool()
+        modulo.invalidar_catalogo_esquema()
+        servidor.cursor().execute(f'DROP DATABASE {BASE_PRUEBA} WITH (FORCE)')
+        servidor.close()
+
+
+def test_actualizar_inventario_poza_acumula_deltas(base):
+    with base.cursor() as cursor:
+        modulo.actualizar_inventario_poza(cursor, 1, 2, nacidos=5, muertos=1)
+        modulo.actualizar_inventario_poza(cursor, '1', '2', nacidos=3)
+        modulo.actualizar_inventario_poza(cursor, '1', '2', reproductores=12, reproductores_total=12)
+        # Sin reproductores el valor actual se conserva
+        modulo.actualizar_inventario_poza(cursor, '1', '2', muertos=2)
+
+        cursor.execute('''
+            SELECT galpon, poza, reproductores, reproductores_total, nacidos, destetados, muertos, vendidos
+            FROM inventario_poza
+        ''')
+        assert cursor.fetchall() == [('1', '2', 12, 12, 8, 0, 3, 0)]
+
+        with pytest.raises(ValueError, match='desconocidos: nacimientos'):
+            modulo.actualizar_inventario_poza(cursor, '1', '2', nacimientos=1)
+
+
+def test_generador_fallido_no_revierte_los_demas(base, monkeypatch):
+    sembrar_alertas(base)
+
+    def fallido(cursor):
+        cursor.execute('SELECT columna_inexistente FROM notificaciones')
+        return cursor.fetchall()
+
+    destete, *resto = modulo.GENERADORES_NOTIFICACIONES
+    monkeypatch.setattr(modulo, 'GENERADORES_NOTIFICACIONES', (destete, ('roto', fallido), *resto))
+
+    generadas = modulo.generar_todas_las_notificaciones()
+
+    assert sorted(n['tipo'] for n in generadas) == ['descarte', 'destete', 'salud']
+    assert tipos_notificaciones(base) == ['descarte', 'destete', 'salud']
+
+
+def test_segunda_generacion_no_duplica_alertas(base):
+    sembrar_alertas(base)
+    assert len(modulo.generar_todas_las_notificaciones()) == 3
+    assert modulo.generar_todas_las_notificaciones() == []
+    assert tipos_notificaciones(base) == ['descarte', 'destete', 'salud']
+
+    # Una alerta leída ya no cuenta como pendiente: se vuelve a generar
+    with base.cursor() as cursor:
+        cursor.execute("UPDATE notificaciones SET leida = TRUE WHERE tipo = 'salud'")
+    base.commit()
+    assert [n['tipo'] for n in modulo.generar_todas_las_notificaciones()] == ['salud']
+
+
+def test_generacion_programada_una_vez_por_intervalo(base):
+    sembrar_alertas(base)
+
+    # Otro worker tiene el bloqueo: la ejecución se omite
+    otro_worker = psycopg2.connect(os.environ['DATABASE_URL'])
+    with otro_worker.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (modulo.CLAVE_BLOQUEO_NOTIFICACIONES,))
+        assert modulo.ejecutar_generacion_programada() is None
+    otro_worker.rollback()
+    otro_worker.close()
+
+    assert len(modulo.ejecutar_generacion_programada()) == 3
+    # La ejecución quedó registrada: dentro del intervalo se omite salvo que se fuerce
+    assert modulo.ejecutar_generacion_programada() is None
+    assert modulo.ejecutar_generacion_programada(forzar=True) == []
+    with base.cursor() as cursor:
+        cursor.execute("SELECT generadas, error FROM tareas_programadas WHERE nombre = 'notificaciones'")
+        assert cursor.fetchone() == (0, None)
+
+
+def test_escucha_difunde_al_conectar_y_con_cada_notify(base, monkeypatch):
+    class Salir(BaseException):
+        pass
+
+    cola = queue.Queue(maxsize=1)
+    monkeypatch.setattr(modulo, '_suscriptores', {cola})
+    difundir = modulo._difundir_notificaciones
+    instantaneas = []
+
+    def difundir_y_registrar():
+        difundir()
+        instantaneas.append(json.loads(cola.get_nowait()[1]))
+        if len(instantaneas) == 2:
+            raise Salir()
+        # Con la escucha ya conectada, otra conexión registra una alerta y avisa
+        with modulo.get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad)
+                    VALUES ('salud', 'Alerta de prueba', 'mensaje', 'alta')
+                ''')
+                modulo.avisar_cambio_notificaciones(cursor)
+
+    monkeypatch.setattr(modulo, '_difundir_notificaciones', difundir_y_registrar)
+    with pytest.raises(Salir):
+        modulo._bucle_escucha()
+
+    assert instantaneas[0] == []
+    assert [n['titulo'] for n in instantaneas[1]] == ['Alerta de prueba']
+
+
+def test_migrar_reconstruye_solo_si_la_migracion_lo_pide(base, tmp_path, monkeypatch):
+    with base.cursor() as cursor:
+        modulo.actualizar_inventario_poza(cursor, '2', '2', nacidos=1)
+        # Un destete que no pasó por inventario_poza, como las filas que copia una migración
+        cursor.execute('''
+            INSERT INTO destetes (galpon, poza, destetados_hembras, destetados_machos, fecha_destete)
+            VALUES ('1', '1', 2, 1, NOW())
+        ''')
+    base.commit()
+
+    def destetados_inventario():
+        with base.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(SUM(destetados), 0) FROM inventario_poza')
+            return cursor.fetchone()[0]
+
+    migraciones = modulo.listar_migraciones()
+    ultima = migraciones[-1][0]
+    nuevas = [
+        (ultima + 1, 'indice', 'CREATE INDEX destetes_prueba_idx ON destetes (galpon);\n'),
+        (ultima + 2, 'datos', '-- reconstruir: inventario_poza\nSELECT 1;\n'),
+    ]
+    for version, descripcion, sql in nuevas:
+        ruta = tmp_path / f'{version:04d}_{descripcion}.sql'
+        ruta.write_text(sql)
+        migraciones = migraciones + [(version, ruta.stem, str(ruta))]
+        monkeypatch.setattr(modulo, 'listar_migraciones', lambda migraciones=migraciones: migraciones)
+        assert modulo.aplicar_migraciones() == [ruta.stem]
+        # Solo la migración marcada recalcula el inventario desde el historial
+        assert destetados_inventario() == (3 if descripcion == 'datos' else 0)
+
+
+def test_refrescar_metricas_recalcula_solo_los_meses_indicados(base):
+    enero, febrero = datetime(2024, 1, 10), datetime(2024, 2, 10)
+    with base.cursor() as cursor:
+        cursor.executemany('''
+            INSERT INTO partos (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento)
+            VALUES ('1', '1', %s, %s, 0, 1, %s)
+        ''', [(1, 4, enero), (2, 5, febrero)])
+        modulo.reconstruir_metricas_mensuales(cursor)
+        # Cambios en ambos meses, pero solo se refresca febrero
+        cursor.execute('UPDATE partos SET nacidos = nacidos + 10')
+        modulo.refrescar_metricas_mensuales(cursor, 'partos', [febrero])
+        cursor.execute('''
+            SELECT mes, metrica, valor FROM metricas_mensuales
+            WHERE metrica IN ('nacidos', 'muertos_partos') ORDER BY mes, metrica
+        ''')
+        assert cursor.fetchall() == [
+            (date(2024, 1, 1), 'muertos_partos', 1), (date(2024, 1, 1), 'nacidos', 4),
+            (date(2024, 2, 1), 'muertos_partos', 1), (date(2024, 2, 1), 'nacidos', 15),
+        ]
+
+
+def test_reconstruir_metricas_bloquea_los_refrescos(base):
+    with base.cursor() as cursor:
+        modulo.reconstruir_metricas_mensuales(cursor)
+
+    # Mientras la reconstrucción no termina, un refresco de otra conexión espera
+    otra = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        with otra.cursor() as cursor:
+            cursor.execute("SET lock_timeout = '100ms'")
+            with pytest.raises(psycopg2.errors.LockNotAvailable):
+                modulo.refrescar_metricas_mensuales(cursor, 'partos', [datetime(2024, 1, 10)])
+        otra.rollback()
+        base.commit()
+        with otra.cursor() as cursor:
+            modulo.refrescar_metricas_mensuales(cursor, 'partos', [datetime(2024, 1, 10)])
+        otra.commit()
+    finally:
+        otra.close()
+
+
+def test_migrar_convierte_fechas_antes_del_umbral(base, tmp_path, monkeypatch):
+    # Una base anterior a la conversión: fecha_muerte sigue siendo TEXT
+    with base.cursor() as cursor:
+        cursor.execute('ALTER TABLE muertes_destetados ALTER COLUMN fecha_muerte TYPE TEXT')
+        cursor.execute('''
+            INSERT INTO muertes_destetados (galpon, poza, muertos_hembras, muertos_machos, fecha_muerte)
+            VALUES ('1', '1', 1, 0, 'ayer')
+        ''')
+    base.commit()
+
+    migraciones = modulo.listar_migraciones()
+    version = migraciones[-1][0] + 1
+    ruta = tmp_path / f'{version:04d}_requiere_fechas.sql'
+    ruta.write_text('SELECT 1;\n')
+    monkeypatch.setattr(modulo, 'listar_migraciones', lambda: migraciones + [(version, ruta.stem, str(ruta))])
+    monkeypatch.setattr(modulo, 'MIGRACION_REQUIERE_FECHAS', version)
+    cli = modulo.app.test_cli_runner()
+
+    def estado():
+        with base.cursor() as cursor:
+            cursor.execute('SELECT MAX(version) FROM schema_version')
+            aplicada = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'muertes_destetados' AND column_name = 'fecha_muerte'
+            ''')
+            return aplicada, cursor.fetchone()[0]
+
+    # Con una fecha inválida se detiene en el umbral sin hacer fallar el despliegue
+    resultado = cli.invoke(args=['migrar'])
+    assert resultado.exit_code == 0, resultado.output
+    assert 'fechas inválidas' in resultado.output
+    assert estado() == (version - 1, 'text')
+
+    with base.cursor() as cursor:
+        cursor.execute("UPDATE muertes_destetados SET fecha_muerte = '05/03/2024 10:00:00'")
+    base.commit()
+    resultado = cli.invoke(args=['migrar'])
+    assert resultado.exit_code == 0, resultado.output
+    assert estado() == (version, 'timestamp without time zone')
+
+
+def test_unir_partos_duplicados_refresca_las_metricas(base):
+    with base.cursor() as cursor:
+        # Duplicados de antes de la restricción única (migración 0007)
+        cursor.execute('ALTER TABLE partos DROP CONSTRAINT partos_poza_parto_uq')
+        cursor.executemany('''
+            INSERT INTO partos (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento)
+            VALUES ('1', '1', 1, %s, 0, 0, %s)
+        ''', [(4, datetime(2024, 1, 10)), (3, datetime(2024, 2, 10))])
+        modulo.reconstruir_metricas_mensuales(cursor)
+
+        assert len(modulo.unir_partos_duplicados(cursor)) == 1
+        cursor.execute('''
+            SELECT mes, metrica, valor FROM metricas_mensuales
+            WHERE metrica IN ('nacidos', 'partos') AND valor <> 0 ORDER BY mes, metrica
+        ''')
+        assert cursor.fetchall() == [(date(2024, 1, 1), 'nacidos', 7), (date(2024, 1, 1), 'partos', 1)]
+
+
+def test_vendidos_misma_regla_en_formulario_y_reconstruccion(base):
+    cliente = modulo.app.test_client()
+    cliente.post('/ventas', data={'tipo_venta': 'descarte', 'costo_venta': '90', 'origen_galpon': '1',
+                                  'origen_poza': '4', 'cuyes_vendidos': '3'})
+    cliente.post('/ventas', data={'tipo_venta': 'destetados', 'costo_venta': '50',
+                                  'hembras_vendidas': '2', 'machos_vendidos': '1'})
+    with base.cursor() as cursor:
+        # Venta de destetados antigua con poza de origen: tampoco cuenta
+        cursor.execute('''
+            INSERT INTO ventas (tipo_venta, galpon, poza, hembras_vendidas, machos_vendidos, costo_total, fecha_venta)
+            VALUES ('destetados', '1', '4', 5, 5, 100, NOW())
+        ''')
+    base.commit()
+
+    def vendidos():
+        with base.cursor() as cursor:
+            cursor.execute('SELECT galpon, poza, vendidos FROM inventario_poza WHERE vendidos <> 0')
+            return cursor.fetchall()
+
+    assert vendidos() == [('1', '4', 3)]
+    with base.cursor() as cursor:
+        modulo.reconstruir_inventario_poza(cursor)
+    base.commit()
+    assert vendidos() == [('1', '4', 3)]
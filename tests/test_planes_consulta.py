@@ -0,0 +1,275 @@
+"""Regresión de planes de consulta
+
+Aplica las migraciones en un esquema temporal, lo llena con datos de prueba y
+ejecuta los accesos frecuentes de app.py reemplazando cada consulta por su
+EXPLAIN. Falla si aparece un Seq Scan sobre una tabla con más de UMBRAL_FILAS.
+Con los mismos datos comprueba que metricas_mensuales coincide con el historial.
+Requiere DATABASE_URL apuntando a un PostgreSQL de pruebas.
+"""
+import os
+import sys
+from contextlib import contextmanager
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import pytest
+
+import app as modulo
+
+UMBRAL_FILAS = 5000
+# Accesos que recorren a propósito una tabla entera: (acceso, tabla)
+# /resultados grafica todos los meses de las métricas de mortalidad y el
+# dashboard suma inventario_poza, que tiene una fila por poza
+SEQ_SCAN_PERMITIDOS = {('resultados', 'metricas_mensuales'), ('index', 'inventario_poza')}
+ESQUEMA = f'planes_prueba_{os.getpid()}'
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='requiere DATABASE_URL')
+
+DATOS_PRUEBA = '''
+    INSERT INTO reproductores (galpon, poza, hembras, machos, tiempo_reproductores, fecha_ingreso)
+    SELECT (g % 10)::text, (g % 50)::text, 10, 2, 3, NOW() - (g || ' days')::interval
+    FROM generate_series(1, 500) g;
+
+    INSERT INTO partos (galpon, poza, numero_parto, nacidos, muertos_bebes, muertos_reproductores, fecha_nacimiento)
+    SELECT (g % 10)::text, (g % 50)::text, g, 3, 0, 0, NOW() - ((g % 1000) || ' days')::interval
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO destetes (galpon, poza, destetados_hembras, destetados_machos, fecha_destete)
+    SELECT (g % 10)::text, (g % 50)::text, 2, 1, NOW() - ((g % 1000) || ' days')::interval
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO muertes_destetados (galpon, poza, muertos_hembras, muertos_machos, fecha_muerte)
+    SELECT (g % 10)::text, (g % 50)::text, 1, 0, NOW() - ((g % 1000) || ' days')::interval
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO ventas (tipo_venta, galpon, poza, hembras_vendidas, machos_vendidos, costo_total, fecha_venta)
+    SELECT CASE WHEN g % 2 = 0 THEN 'destetados' ELSE 'descarte' END, (g % 10)::text, (g % 50)::text,
+           1, 1, 50, NOW() - ((g % 1000) || ' days')::interval
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO notificaciones (tipo, titulo, mensaje, prioridad, leida, relacion_id, relacion_tipo)
+    SELECT 'destete', 'Destete ' || g, 'mensaje', 'media', g % 100 <> 0, g, 'destete'
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO gastos (descripcion, monto, tipo, fecha_gasto)
+    SELECT 'gasto ' || g, 10, 'alimento', NOW() - ((g % 1000) || ' days')::interval
+    FROM generate_series(1, 50000) g;
+
+    INSERT INTO inventario_poza (galpon, poza)
+    SELECT DISTINCT galpon, poza FROM reproductores;
+'''
+
+
+class FilaVacia(dict):
+    """Fila sin valores: cualquier columna devuelve None y es falsa en un if"""
+
+    def __getitem__(self, clave):
+        return None
+
+
+class CursorExplain:
+    """Cursor que en lugar de ejecutar cada consulta guarda su plan"""
+
+    def __init__(self, cursor, planes):
+        self.cursor = cursor
+        self.planes = planes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, parametros=None):
+        primera = sql.lstrip().split(None, 1)[0].upper()
+        if primera not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+            return
+        self.cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, parametros)
+        self.planes.append((sql, self.cursor.fetchone()[0][0]['Plan']))
+
+    def fetchone(self):
+        return FilaVacia()
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self, tamano=None):
+        return []
+
+
+class ConexionExplain:
+    def __init__(self, conn, planes):
+        self.conn = conn
+        self.planes = planes
+
+    def cursor(self, *args, **kwargs):
+        return CursorExplain(self.conn.cursor(), self.planes)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def recorrer_plan(nodo):
+    yield nodo
+    for hijo in nodo.get('Plans', []):
+        yield from recorrer_plan(hijo)
+
+
+@pytest.fixture(scope='module')
+def base_sembrada():
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE SCHEMA {ESQUEMA}')
+    cursor.execute(f'SET search_path TO {ESQUEMA}')
+    try:
+        conn.autocommit = False
+        for _, _, ruta in modulo.listar_migraciones():
+            with open(ruta, encoding='utf-8') as archivo:
+                modulo.ejecutar_migracion(conn, cursor, archivo.read())
+            conn.commit()
+        cursor.execute(DATOS_PRUEBA)
+        modulo.reconstruir_metricas_mensuales(cursor)
+        conn.commit()
+        conn.autocommit = True
+        cursor.execute('ANALYZE')
+
+        cursor.execute('''
+            SELECT c.relname, c.reltuples FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relkind = 'r'
+        ''', (ESQUEMA,))
+        yield conn, dict(cursor.fetchall())
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        cursor.execute(f'DROP SCHEMA {ESQUEMA} CASCADE')
+        conn.close()
+
+
+@pytest.fixture
+def planes(base_sembrada, monkeypatch):
+    conn, _ = base_sembrada
+    registrados = []
+
+    @contextmanager
+    def conexion_explain():
+        yield ConexionExplain(conn, registrados)
+
+    monkeypatch.setattr(modulo, 'get_db_connection', conexion_explain)
+    modulo.app.config['TESTING'] = True
+    # Las filas vacías pueden romper las plantillas: solo interesan las consultas
+    monkeypatch.setitem(modulo.app.config, 'PROPAGATE_EXCEPTIONS', False)
+    modulo.invalidar_catalogo_pozas()
+    yield registrados
+    modulo.invalidar_catalogo_pozas()
+
+
+def cursor_explain():
+    """Cursor para llamar directamente a funciones que reciben un cursor"""
+    with modulo.get_db_connection() as conn:
+        return conn.cursor()
+
+
+ACCESOS_FRECUENTES = {
+    'buscar_partos': lambda cliente, planes: cliente.get('/buscar_partos?galpon=3&poza=13'),
+    'registrar_partos_buscar': lambda cliente, planes: cliente.post('/registrar_partos', data={
+        'action': 'buscar', 'galpon': '3', 'poza': '13'}),
+    'registrar_partos_upsert': lambda cliente, planes: cliente.post('/registrar_partos', data={
+        'action': 'registrar', 'galpon': '3', 'poza': '13', 'numero_parto': '4',
+        'nacidos': '3', 'muertos_bebes': '0', 'muertos_reproductores': '0'}),
+    'editar_parto': lambda cliente, planes: cliente.get('/editar_parto/10'),
+    'registrar_destete': lambda cliente, planes: cliente.get('/registrar_destete'),
+    'registrar_destete_post': lambda cliente, planes: cliente.post('/registrar_destete', data={
+        'galpon': '3', 'poza': '13', 'destetados_hembras': '2', 'destetados_machos': '1'}),
+    'index': lambda cliente, planes: cliente.get('/'),
+    'ventas': lambda cliente, planes: cliente.get('/ventas'),
+    'huella_modelos': lambda cliente, planes: modulo.huella_datos_modelos(cursor_explain()),
+    'huella_modelos_poza': lambda cliente, planes: modulo.huella_datos_modelos(
+        cursor_explain(), tuple(modulo.METRICAS_SERIES_POZA)),
+    'resultados': lambda cliente, planes: cliente.get('/resultados'),
+    'balance': lambda cliente, planes: cliente.get('/balance'),
+    'api_balance': lambda cliente, planes: cliente.get(
+        '/api/balance?desde=2024-01-01&hasta=2024-03-31&granularidad=dia'),
+    'analisis_datos': lambda cliente, planes: cliente.get('/analisis_datos'),
+    'recalcular_reproductores_poza': lambda cliente, planes: modulo.recalcular_reproductores_poza(
+        cursor_explain(), '3', '13'),
+    'notificaciones_destete': lambda cliente, planes: modulo.generar_notificaciones_destetes(cursor_explain()),
+    'notificaciones_salud': lambda cliente, planes: modulo.generar_notificaciones_salud(cursor_explain()),
+    'notificaciones_pendientes': lambda cliente, planes: modulo.listar_notificaciones_pendientes(cursor_explain()),
+    'listado_partos': lambda cliente, planes: cliente.get('/api/analisis/partos'),
+    'listado_partos_pagina': lambda cliente, planes: cliente.get(
+        '/api/analisis/partos?despues=' + modulo.codificar_cursor_listado(['3', '13', modulo.datetime(2024, 1, 1), 500])),
+    'listado_destetes_filtrado': lambda cliente, planes: cliente.get(
+        '/api/analisis/destetes?galpon=3&desde=2024-01-01&hasta=2024-03-31'),
+    'listado_gastos': lambda cliente, planes: cliente.get('/api/analisis/gastos'),
+    'listado_ventas': lambda cliente, planes: cliente.get('/api/analisis/ventas?desde=2024-01-01'),
+}
+
+
+@pytest.mark.parametrize('nombre', list(ACCESOS_FRECUENTES))
+def test_accesos_frecuentes_sin_seq_scan(nombre, planes, base_sembrada):
+    _, filas_por_tabla = base_sembrada
+    with modulo.app.test_client() as cliente:
+        ACCESOS_FRECUENTES[nombre](cliente, planes)
+
+    assert planes, f'{nombre} no ejecutó consultas'
+    for sql, plan in planes:
+        for nodo in recorrer_plan(plan):
+            tabla = nodo.get('Relation Name')
+            if (nombre, tabla) in SEQ_SCAN_PERMITIDOS:
+                continue
+            if nodo['Node Type'] == 'Seq Scan' and filas_por_tabla.get(tabla, 0) > UMBRAL_FILAS:
+                pytest.fail(f'{nombre}: Seq Scan sobre {tabla} ({int(filas_por_tabla[tabla])} filas)\n{sql}')
+
+
+# Agregados escritos a mano sobre las tablas de eventos: (mes, galpon, poza) -> total
+AGREGADOS_DIRECTOS = {
+    'nacidos': """
+        SELECT date_trunc('month', fecha_nacimiento)::date, galpon, poza, SUM(nacidos)
+        FROM partos GROUP BY 1, 2, 3""",
+    'muertos_partos': """
+        SELECT date_trunc('month', fecha_nacimiento)::date, galpon, poza, SUM(muertos_bebes + muertos_reproductores)
+        FROM partos GROUP BY 1, 2, 3""",
+    'partos': """
+        SELECT date_trunc('month', fecha_nacimiento)::date, galpon, poza, COUNT(*)
+        FROM partos GROUP BY 1, 2, 3""",
+    'destetados': """
+        SELECT date_trunc('month', fecha_destete)::date, galpon, poza, SUM(destetados_hembras + destetados_machos)
+        FROM destetes GROUP BY 1, 2, 3""",
+    'muertos_destetados': """
+        SELECT date_trunc('month', fecha_muerte)::date, galpon, poza, SUM(muertos_hembras + muertos_machos)
+        FROM muertes_destetados GROUP BY 1, 2, 3""",
+    'ventas_destetados': """
+        SELECT date_trunc('month', fecha_venta)::date, COALESCE(galpon, ''), COALESCE(poza, ''), SUM(costo_total)
+        FROM ventas WHERE tipo_venta = 'destetados' GROUP BY 1, 2, 3""",
+    'ventas_descarte': """
+        SELECT date_trunc('month', fecha_venta)::date, COALESCE(galpon, ''), COALESCE(poza, ''), SUM(costo_total)
+        FROM ventas WHERE tipo_venta = 'descarte' GROUP BY 1, 2, 3""",
+    'vendidos_destetados': """
+        SELECT date_trunc('month', fecha_venta)::date, COALESCE(galpon, ''), COALESCE(poza, ''),
+               SUM(hembras_vendidas + machos_vendidos)
+        FROM ventas WHERE tipo_venta = 'destetados' GROUP BY 1, 2, 3""",
+    'gastos': """
+        SELECT date_trunc('month', fecha_gasto)::date, '', '', SUM(monto)
+        FROM gastos GROUP BY 1""",
+}
+
+
+def test_metricas_mensuales_coinciden_con_el_historial(base_sembrada):
+    conn, _ = base_sembrada
+    cursor = conn.cursor()
+    metricas = [m for definicion in modulo.METRICAS_MENSUALES.values() for m in definicion]
+    assert sorted(metricas) == sorted(AGREGADOS_DIRECTOS)
+
+    for metrica, consulta in AGREGADOS_DIRECTOS.items():
+        cursor.execute(consulta)
+        esperado = {tuple(fila[:3]): fila[3] for fila in cursor.fetchall() if fila[3]}
+        cursor.execute('''
+            SELECT mes, galpon, poza, valor FROM metricas_mensuales
+            WHERE metrica = %s AND valor <> 0
+        ''', (metrica,))
+        assert {tuple(fila[:3]): fila[3] for fila in cursor.fetchall()} == esperado, metrica